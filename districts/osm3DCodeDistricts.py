@@ -18,10 +18,15 @@
 #    - pyrosm            : https://github.com/HTenkanen/pyrosm/issues/167
 #########################
 import os
+import shutil
 import subprocess
+import hashlib
 from pathlib import Path
 
-from itertools import chain
+from itertools import chain, islice
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 
 from pyrosm import OSM, data
 from pyrosm import get_data
@@ -34,12 +39,13 @@ import shapely
 shapely.speedups.disable()
 import shapely.geometry as sg
 from shapely.geometry import Point, LineString, Polygon, shape, mapping
-from shapely.ops import snap
+from shapely.ops import snap, unary_union
 from shapely.ops import transform
 
 import fiona
 import copy
 import json
+import tempfile
 import geojson
 
 import pyproj
@@ -49,7 +55,6 @@ from openlocationcode import openlocationcode as olc
 from cjio import cityjson
 
 from osgeo import gdal, ogr
-from rasterstats import zonal_stats, point_query
 
 import pydeck as pdk
 
@@ -57,6 +62,7 @@ import pyvista as pv
 import triangle as tr
 
 import matplotlib.pyplot as plt
+import matplotlib.tri as mtri
 
 import time
 from datetime import timedelta
@@ -165,57 +171,140 @@ def projVec(outfile, infile, crs):
         
 #     return area
 
+def demMosaic(jparams):
+    """
+    the source dem ~ the one raster in "in_raster", or a virtual mosaic (VRT) of all of them (whitespace separated)
+    - the mosaic is a small VRT next to "projClip_raster"; no pixels are copied, the tiles are read where and when needed
+    """
+    imgs = jparams['in_raster'].split()
+    if len(imgs) == 1:
+        return imgs[0]
+    
+    fname = os.path.splitext(jparams['projClip_raster'])[0] + '_mosaic.vrt'
+    vrt = gdal.BuildVRT(fname, imgs, srcNodata=jparams['nodata'], VRTNodata=jparams['nodata'])
+    vrt = None
+    
+    return fname
+
 def prepareDEM(extent, jparams):
     """
     gdal.Warp to (mosaic) reproject and clip raster dem
+    - "projClip_raster" ending in .vrt writes a warped VRT instead of a GeoTIFF; nothing is resampled up front,
+      every (windowed) read reprojects only the cells it asks for from the tiles under it
+    - a clipped dem is kept in "dem_cache" (default ./data/dem_cache) under demKey; the next run with the same
+      source, crs, extent, nodata and resampling copies it from there instead of warping again
+    - "dem_cache_size" (MB, default 2000): least recently used dems are removed first; "dem_cache": "False" switches it off
     """
-    a_string = jparams['in_raster']
-    imgs = a_string.split()#",") 
+    gdalConfig(jparams)
+    cache = jparams.get('dem_cache', './data/dem_cache')
+    if cache == 'False' or jparams['projClip_raster'].lower().endswith('.vrt'):
+        warpDEM(jparams['projClip_raster'], extent, jparams)
+        return
     
-    if len(imgs) == 1:
-        OutTile = gdal.Warp(jparams['projClip_raster'], 
-                            jparams['in_raster'], 
-                            dstSRS=jparams['crs'],
-                            srcNodata = jparams['nodata'],
-                            #dstNodata = 0,
-                            #-- outputBounds=[minX, minY, maxX, maxY]
-                            outputBounds = [extent[0], extent[1],
-                                            extent[2], extent[3]])
-        OutTile = None 
-     
-    if len(imgs) > 1:
-        
-        # a_string = jparams['in_raster']
-        # shapes = a_string.split(",")
-        # s = ' '.join([str(elem) for elem in shapes])
-        # c = ' '
-        # idx = [pos for pos, char in enumerate(s) if char == c]
-        # for i in idx:
-        #     new = s[:i-1] + "", "" + a_string[i+1:]
-        
-        # OutTile = gdal.Warp(jparams['projClip_raster'], 
-        #                     list(new),
-        #                     resampleAlg='bilinear',
-        #                     dstSRS=jparams['crs'],
-        #                     srcNodata = jparams['nodata'],
-        #                     #dstNodata = 0,
-        #                     #-- outputBounds=[minX, minY, maxX, maxY]
-        #                     outputBounds = [extent[0], extent[1],
-        #                                     extent[2], extent[3]])
-        # OutTile = None 
-        
-        OutTile = gdal.Warp(jparams['projClip_raster'],
-                            imgs,
-                            resampleAlg='bilinear',
-                            dstSRS=jparams['crs'],
-                            srcNodata = jparams['nodata'],
-                            #-- outputBounds=[minX, minY, maxX, maxY]
-                            outputBounds = [extent[0], extent[1], extent[2], extent[3]])
-        OutTile = None 
+    os.makedirs(cache, exist_ok=True)
+    fname = os.path.join(cache, demKey(extent, jparams) + (os.path.splitext(jparams['projClip_raster'])[1] or '.tif'))
+    if not os.path.exists(fname):
+        #-- runs in parallel (batch) may warp the same dem; each to a file of its own
+        tmp = '{}.{}.tmp'.format(fname, os.getpid())
+        warpDEM(tmp, extent, jparams)
+        os.replace(tmp, fname)
+        trimCache(cache, float(jparams.get('dem_cache_size', 2000)) * 1024 * 1024, keep=fname, 
+                  suffix=os.path.splitext(fname)[1])
+    else:
+        print('dem: {} from the cache'.format(jparams['projClip_raster']))
+        os.utime(fname, (time.time(), os.path.getmtime(fname)))
+    tmp = '{}.{}.tmp'.format(jparams['projClip_raster'], os.getpid())
+    shutil.copyfile(fname, tmp)
+    os.replace(tmp, jparams['projClip_raster'])
+
+def demKey(extent, jparams):
+    """
+    the key of a clipped dem ~ sha256 of the source rasters (absolute path, size, mtime), the crs, the extent (to the cm),
+    nodata, resampling and the output profile
+    """
+    sources = []
+    for img in jparams['in_raster'].split():
+        st = os.stat(img)
+        sources.append([os.path.abspath(img), st.st_size, st.st_mtime_ns])
+    key = [sources, jparams['crs'], [round(float(e), 2) for e in extent], str(jparams['nodata']), demResampling(jparams), 
+           demProfile(jparams)]
+    
+    return hashlib.sha256(json.dumps(key).encode('utf-8')).hexdigest()
+
+def demProfile(jparams):
+    #-- "dem_cog": "True" ~ the creation options of a Cloud-Optimized GeoTIFF; None for a plain GeoTIFF
+    #-- what shapes the file only (part of demKey); the threads to write it are set in warpDEM
+    if jparams.get('dem_cog') != 'True':
+        return None
+    return ['COMPRESS=' + jparams.get('dem_compress', 'DEFLATE'), 'PREDICTOR=YES', 'BLOCKSIZE=512', 
+            'OVERVIEWS=AUTO', 'BIGTIFF=IF_SAFER']
+
+def gdalConfig(jparams):
+    """
+    gdal settings for the warp and every read after it
+    - "gdal_cachemax" (MB): the raster block cache (gdal default: 5% of the memory)
+    - "gdal_threads" (default ALL_CPUS): threads to warp and compress
+    """
+    if jparams.get('gdal_cachemax'):
+        gdal.SetCacheMax(int(float(jparams['gdal_cachemax']) * 1024 * 1024))
+    gdal.SetConfigOption('GDAL_NUM_THREADS', str(jparams.get('gdal_threads', 'ALL_CPUS')))
+
+def demResampling(jparams):
+    #-- "dem_resampling": any gdal.Warp resampleAlg; default bilinear to mosaic, nearest for one raster
+    return jparams.get('dem_resampling', 'bilinear' if len(jparams['in_raster'].split()) > 1 else 'near')
+
+def warpDEM(fout, extent, jparams):
+    """
+    gdal.Warp to (mosaic) reproject and clip raster dem to fout
+    - "dem_cog": "True" writes a Cloud-Optimized GeoTIFF: tiled (512), compressed ("dem_compress": DEFLATE (default),
+      ZSTD, LZW, ... with a predictor) with internal overviews; the warp is a VRT in memory the COG driver copies out
+    """
+    vrt = fout.lower().endswith('.vrt')
+    cog = demProfile(jparams) if not vrt else None
+    OutTile = gdal.Warp('' if cog else fout, 
+                        demMosaic(jparams), 
+                        resampleAlg=demResampling(jparams),
+                        multithread=True,
+                        dstSRS=jparams['crs'],
+                        srcNodata = jparams['nodata'],
+                        #dstNodata = 0,
+                        #-- outputBounds=[minX, minY, maxX, maxY]
+                        outputBounds = [extent[0], extent[1], extent[2], extent[3]], 
+                        format='VRT' if (vrt or cog) else 'GTiff')
+    if cog:
+        Cog = gdal.Translate(fout, OutTile, format='COG', 
+                             creationOptions=cog + ['NUM_THREADS=' + str(jparams.get('gdal_threads', 'ALL_CPUS'))])
+        Cog = None
+    OutTile = None 
         
+def trimCache(cache, size, keep=None, suffix='.tif'):
+    """
+    remove the least recently used dems (files ending in suffix) until the cache is at most size (bytes)
+    - keep: the dem just written stays
+    """
+    entries = []
+    for each in os.scandir(cache):
+        if each.is_file() and each.name.endswith(suffix) and each.path != keep:
+            try:
+                st = each.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_atime, st.st_size, each.path))
+    total = sum(e[1] for e in entries) + (os.path.getsize(keep) if keep else 0)
+    for atime, nbytes, path in sorted(entries):
+        if total <= size:
+            break
+        #-- another run might have removed it already
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total = total - nbytes
+
 def createXYZ(fout, fin):
     """
     read raster and extract an xyz
+    ~ debug export only; the terrain points come from rasterXYZ
     """
     xyz = gdal.Translate(fout,
                          fin,
@@ -223,6 +312,66 @@ def createXYZ(fout, fin):
                          noData = float(0))
     xyz = None
 
+def rasterQuery(mx, my, gt_forward, rb, interpolate='nearest', nodata=None):
+    """
+    sample the raster at many points in one pass
+    - the window covering every point is read once and indexed with numpy
+    - 'nearest' returns the value of the cell containing the point;
+      'bilinear' interpolates between cell centres (as rasterstats.point_query)
+      and, like it, falls back to the nearest cell next to nodata
+    - rb can be a gdal band or a numpy array of the band
+    """
+    mx = np.asarray(mx, dtype='float64')
+    my = np.asarray(my, dtype='float64')
+    if mx.size == 0:
+        return np.empty(0, dtype='float64')
+    if nodata is None and hasattr(rb, 'GetNoDataValue'):
+        nodata = rb.GetNoDataValue()
+    if hasattr(rb, 'ReadAsArray'):
+        xsize, ysize = rb.XSize, rb.YSize
+    else:
+        ysize, xsize = rb.shape
+    
+    fx = (mx - gt_forward[0]) / gt_forward[1]
+    fy = (my - gt_forward[3]) / gt_forward[5]
+    
+    if interpolate == 'bilinear':
+        #-- upper-left cell of the 2x2 window around the point and the offset to its centre
+        px = np.floor(fx - 0.5).astype('int64')
+        py = np.floor(fy - 0.5).astype('int64')
+        dx = fx - 0.5 - px
+        dy = fy - 0.5 - py
+        cols = np.clip(np.stack([px, px + 1, px, px + 1]), 0, xsize - 1)
+        rows = np.clip(np.stack([py, py, py + 1, py + 1]), 0, ysize - 1)
+    else:
+        cols = np.clip(fx.astype('int64'), 0, xsize - 1)[np.newaxis]
+        rows = np.clip(fy.astype('int64'), 0, ysize - 1)[np.newaxis]
+    
+    #-- one read of the block that holds every cell we need
+    xoff, yoff = int(cols.min()), int(rows.min())
+    win_x, win_y = int(cols.max()) - xoff + 1, int(rows.max()) - yoff + 1
+    if hasattr(rb, 'ReadAsArray'):
+        block = rb.ReadAsArray(xoff, yoff, win_x, win_y)
+    else:
+        block = rb[yoff:yoff + win_y, xoff:xoff + win_x]
+    vals = block[rows - yoff, cols - xoff].astype('float64')
+    
+    if interpolate != 'bilinear':
+        return vals[0]
+    
+    ul, ur, ll, lr = vals
+    z = (ul * (1 - dx) * (1 - dy) + ur * dx * (1 - dy) + 
+         ll * (1 - dx) * dy + lr * dx * dy)
+    if nodata is not None:
+        #-- fall back to the nearest cell where the window touches nodata
+        invalid = (vals == nodata).any(axis=0)
+        near = vals[np.round(dy).astype('int64') * 2 + np.round(dx).astype('int64'), 
+                    np.arange(mx.size)]
+        z[invalid] = near[invalid]
+        z[invalid & (near == nodata)] = np.nan
+    
+    return z
+
 def assignZ(jparams): #vfname, rfname):
     """
     assign a height attribute - mean ground - to the osm vector 
@@ -236,135 +385,261 @@ def assignZ(jparams): #vfname, rfname):
     ts['building:levels'] = ts['building:levels'].astype(int)
     ts = ts[ts['building:levels'] != 0]
     
-     ##-- rasterstats
-    l = point_query(vectors=ts['geometry'].representative_point(), 
-            raster=jparams['projClip_raster'], interpolate='bilinear', 
-            nodata=0)#jparams['nodata'])
+     ##-- bilinear sample of the dem at every representative point in one read ~ as rasterstats.point_query
+    src_ds = gdal.Open(jparams['projClip_raster'])
+    rp = ts['geometry'].representative_point()
+    l = rasterQuery(rp.x, rp.y, src_ds.GetGeoTransform(), src_ds.GetRasterBand(1), 
+                    interpolate='bilinear', nodata=0)#jparams['nodata'])
+    src_ds = None
     
      ##-- assign to column
-    ts['mean'] = np.array(l)
+    ts['mean'] = l
     
     return ts
     
+def fpShape(geom):
+    """
+    a footprint as a Polygon
+    ~ LineStrings are closed; of a MultiPolygon the last polygon is kept
+    """
+    if geom.geom_type == 'LineString':
+        return Polygon(geom)
+    if geom.geom_type == 'MultiPolygon':
+        return Polygon(list(geom.geoms)[-1])
+    
+    return geom
+
+@lru_cache(maxsize=None)
+def utmToWgs84(crs):
+    """
+    one pyproj Transformer per crs ~ built once and reused
+    """
+    return pyproj.Transformer.from_crs(pyproj.CRS(crs), pyproj.CRS('EPSG:4326'), always_xy=True)
+
+def plusCodes(geoms, crs):
+    """
+    google plus_code (11 characters) at the representative_point() of each geometry
+    - all points are reprojected in one array call
+    """
+    rp = gpd.GeoSeries(list(geoms), crs=crs).representative_point()
+    lon, lat = utmToWgs84(crs).transform(rp.x.values, rp.y.values)
+    
+    return [olc.encode(y, x, 11) for x, y in zip(lon, lat)]
+
+def pyRound(s, dps=2):
+    """
+    round a column as round() does ~ numpy (Series.round) scales by 10**dps first and can take a .xx5 the other way
+    """
+    return s.map(lambda v: v if pd.isna(v) else round(float(v), dps))
+
 def writegjson(ts, jparams):#, fname):
     """
     read the rasterstats geojson and create new attributes in osm vector
     ~ ground height, relative building height and roof height.
     write the result to file.
+    - attributes are computed as columns and written in one go
     """
     storeyheight = 2.8
-        #-- iterate through the list of buildings and create GeoJSON 
-        # features rich in attributes
-    footprints = {
-        "type": "FeatureCollection",
-        "features": []
-        }
-    columns = ts.columns   
-    for i, row in ts.iterrows():
-        f = {
-        "type" : "Feature"
-        }
-
-        f["properties"] = {}      
-            #-- store all OSM attributes and prefix them with osm_ 
-        f["properties"]["osm_id"] = row.id
-        #columns = ts.columns
-        #for c in columns:
-        adr = []
-                #-- transform the OSM address to string prefix with osm_
-        if 'addr:flats' in columns and row['addr:flats'] != None:
-            adr.append(row['addr:flats'])
-        if 'addr:housenumber' in columns and row['addr:housenumber'] != None:
-            adr.append(row['addr:housenumber'])
-        if 'addr:housename' in columns and row['addr:housename'] != None:
-            adr.append(row['addr:housename'])
-        if 'addr:street' in columns and row['addr:street'] != None:
-            adr.append(row['addr:street'])
-        if 'addr:suburb' in columns and row['addr:suburb'] != None:
-            adr.append(row['addr:suburb'])
-        if 'addr:postcode' in columns and row['addr:postcode'] != None:
-            adr.append(row['addr:postcode'])
-        if 'addr:city' in columns and row['addr:city'] != None:
-            adr.append(row['addr:city'])
-        if 'addr:province' in columns and row['addr:province'] != None:
-            adr.append(row['addr:province'])
-            
+    columns = ts.columns
+    props = pd.DataFrame(index=ts.index)
+        #-- store all OSM attributes and prefix them with osm_ 
+    props['osm_id'] = ts['id']
+    
         # harvest some tags ~ we could harvest all but lets do less
-        if 'building' in columns and row['building'] != None:
-            f["properties"]["osm_building"] = row['building']
-        if 'amenity' in columns and row['amenity'] != None:
-            f["properties"]["osm_amenity"] = row['amenity']
-        if 'start_date' in columns and row['start_date'] != None:
-            f["properties"]["osm_start_date"] = row['start_date']
-        if 'shop' in columns and row['shop'] != None:
-            f["properties"]["osm_shop"] = row['shop']
-        if 'building:levels' in columns and row['building:levels'] != None:
-            f["properties"]["osm_building:levels"] = row['building:levels']
-        if 'name' in columns and row['name'] != None:
-            f["properties"]["osm_name"] = row['name']
-        if 'school' in columns and row['school'] != None:
-            f["properties"]["osm_school"] = row['school']
-        
-            
-        #f["properties"]["osm_address"] = " ".join(adr)
-        f["properties"]["osm_address"] = ' '.join(str(v) for v in adr)
-            
-        osm_shape = row["geometry"] # shape(row["geometry"][0])
-            #-- a few buildings are not polygons, rather linestrings. This converts them to polygons
-            #-- rare, but if not done it breaks the code later
-        if osm_shape.type == 'LineString':
-            osm_shape = Polygon(osm_shape)
-            #-- and multipolygons must be accounted for
-        elif osm_shape.type == 'MultiPolygon':
-            #osm_shape = Polygon(osm_shape[0])
-            for poly in osm_shape:
-                osm_shape = Polygon(poly)#[0])
-                
-        wgs84 = pyproj.CRS('EPSG:4326')
-        utm = pyproj.CRS(jparams['crs'])
-        p = osm_shape.representative_point()
-        project = pyproj.Transformer.from_crs(utm, wgs84, always_xy=True).transform
-        wgs_point = transform(project, p)
-        f["properties"]["plus_code"] = olc.encode(wgs_point.y, wgs_point.x, 11)
-        
-        f["geometry"] = mapping(osm_shape)
-            #-- finally calculate the height and store it as an attribute
-        # if row["mean"] == None:
-        #     z = 0
-        # if row["mean"] != None:
-        #     z = round(row["mean"], 2)
-        
-        f["properties"]['ground_height'] = round(row["mean"], 2)
-        f["properties"]['building_height'] = round(float(row['building:levels']) * storeyheight + 1.3, 2) 
-        f["properties"]['roof_height'] = round(f["properties"]['building_height'] + row["mean"], 2)
-        footprints['features'].append(f)
+    for c in ['building', 'amenity', 'start_date', 'shop', 'building:levels', 'name', 'school']:
+        if c in columns:
+            props['osm_%s' % c] = ts[c]
+    
+        #-- transform the OSM address to string
+    adr = pd.Series('', index=ts.index, dtype=object)
+    parts = pd.Series(0, index=ts.index)
+    for a in ['addr:flats', 'addr:housenumber', 'addr:housename', 'addr:street', 
+              'addr:suburb', 'addr:postcode', 'addr:city', 'addr:province']:
+        if a in columns:
+            has = ts[a].notna()
+            sep = np.where(parts[has] > 0, ' ', '')
+            adr[has] = adr[has] + sep + ts.loc[has, a].astype(str)
+            parts[has] += 1
+    props['osm_address'] = adr
+    
+        #-- a few buildings are not polygons, rather linestrings. This converts them to polygons
+        #-- rare, but if not done it breaks the code later; and multipolygons must be accounted for
+    osm_shape = ts['geometry'].apply(fpShape)
+    
+        #-- google plus_code ~ for all buildings at once
+    props['plus_code'] = plusCodes(osm_shape, jparams['crs'])
+    
+        #-- finally calculate the height and store it as an attribute
+    props['ground_height'] = pyRound(ts['mean'])
+    props['building_height'] = pyRound(ts['building:levels'].astype(float) * storeyheight + 1.3)
+    props['roof_height'] = pyRound(props['building_height'] + ts['mean'])
                 
-    #-- store the data as GeoJSON
+    #-- store the data as GeoJSON ~ missing attributes are left out of each feature
+    footprints = gpd.GeoDataFrame(props, geometry=list(osm_shape))
     with open(jparams['gjson-z_out'], 'w') as outfile:
-        json.dump(footprints, outfile)
+        outfile.write(footprints.to_json(na='drop', drop_id=True))
 
-def getXYZ(dis, aoi, jparams):
+def rasterWindow(src_ds, bounds=None):
     """
-    read xyz to gdf
+    the pixel window (xoff, yoff, xsize, ysize) of the raster covering bounds [minx, miny, maxx, maxy]
+    ~ the whole raster when bounds is None; north-up rasters (as from gdal.Warp)
     """
-    df = pd.read_csv(jparams['xyz'], 
-                     delimiter = ' ', header=None,
-                     names=["x", "y", "z"])
+    if bounds is None:
+        return 0, 0, src_ds.RasterXSize, src_ds.RasterYSize
+    gt = src_ds.GetGeoTransform()
+    c = sorted([(bounds[0] - gt[0]) / gt[1], (bounds[2] - gt[0]) / gt[1]])
+    r = sorted([(bounds[3] - gt[3]) / gt[5], (bounds[1] - gt[3]) / gt[5]])
+    xoff = min(max(0, int(np.floor(c[0]))), src_ds.RasterXSize)
+    yoff = min(max(0, int(np.floor(r[0]))), src_ds.RasterYSize)
+    xend = min(src_ds.RasterXSize, max(xoff, int(np.ceil(c[1]))))
+    yend = min(src_ds.RasterYSize, max(yoff, int(np.ceil(r[1]))))
     
-    geometry = [Point(xy) for xy in zip(df.x, df.y)]
-    #df = df.drop(['Lon', 'Lat'], axis=1)
-    gdf = gpd.GeoDataFrame(df, crs=jparams['crs'], geometry=geometry)
+    return xoff, yoff, xend - xoff, yend - yoff
+
+def rasterXYZ(fin, bounds=None):
+    """
+    x, y (cell centre) and z of every raster cell ~ or of the cells in the window over bounds
+    - straight from the geotransform and the band; no .xyz text round trip
+    """
+    src_ds = gdal.Open(fin)
+    gt = src_ds.GetGeoTransform()
+    xoff, yoff, w, h = rasterWindow(src_ds, bounds)
+    if w == 0 or h == 0:
+        z = np.empty((h, w))
+    else:
+        z = src_ds.GetRasterBand(1).ReadAsArray(xoff, yoff, w, h)
+    src_ds = None
     
-    _symdiff = gpd.overlay(aoi, dis, how='symmetric_difference')
-    _mask = gdf.within(_symdiff.loc[0, 'geometry'])
-    gdf = gdf.loc[_mask]
+    cols = xoff + np.arange(z.shape[1]) + 0.5
+    rows = yoff + np.arange(z.shape[0])[:, np.newaxis] + 0.5
+    x = gt[0] + cols * gt[1] + rows * gt[2]
+    y = gt[3] + cols * gt[4] + rows * gt[5]
+    
+    return x, y, z
+
+def rasterMask(aoi, dis, fin, bounds=None):
+    """
+    burn the aoi and then the footprints into a grid aligned to the raster dem ~ or to its window over bounds
+    - True where the cell centre is inside the aoi and outside every footprint
+    """
+    src_ds = gdal.Open(fin)
+    gt = src_ds.GetGeoTransform()
+    xoff, yoff, w, h = rasterWindow(src_ds, bounds)
+    if w == 0 or h == 0:
+        return np.zeros((h, w), dtype=bool)
+    mem_ds = gdal.GetDriverByName('MEM').Create('', w, h, 1, gdal.GDT_Byte)
+    mem_ds.SetGeoTransform((gt[0] + xoff * gt[1] + yoff * gt[2], gt[1], gt[2], 
+                            gt[3] + xoff * gt[4] + yoff * gt[5], gt[4], gt[5]))
+    mem_ds.SetProjection(src_ds.GetProjection())
+    src_ds = None
     
-    #gdf['z'] = gdf['z'].replace([jparams['nodata']], float(0))
-    gdf = gdf[gdf['z'] != jparams['nodata']]
-    gdf = gdf.round(2)
-    gdf.reset_index(drop=True, inplace=True)
+    ogr_ds = ogr.GetDriverByName('Memory').CreateDataSource('')
+    for name, geoms, burn in [('aoi', [aoi.geometry.iloc[0]], 1), ('footprints', list(dis.geometry), 0)]:
+        lyr = ogr_ds.CreateLayer(name, geom_type=ogr.wkbUnknown)
+        for geom in geoms:
+            feat = ogr.Feature(lyr.GetLayerDefn())
+            feat.SetGeometry(ogr.CreateGeometryFromWkb(bytes(geom.wkb)))
+            lyr.CreateFeature(feat)
+            feat = None
+        #-- default rasterize burns the cells whose centre is inside the polygon
+        gdal.RasterizeLayer(mem_ds, [1], lyr, burn_values=[burn])
     
-    return gdf
+    mask = mem_ds.GetRasterBand(1).ReadAsArray().astype(bool)
+    ogr_ds = None
+    mem_ds = None
+    
+    return mask
+
+class TerrainMesh:
+    """
+    the triangulation input in preallocated arrays ~ vertices (x, y, z) float64, segments int32, holes (x, y, z) float64
+    - every stage appends into it in place; the sizes given up front are room reserved for what comes later,
+      an array short of room grows by what is asked on top of the room it had (at least double)
+    - vertices, segments, holes: views of the part filled so far; Triangle, the CityJSON writer and pvPlot read them as they are
+    """
+    def __init__(self, vertices=0, segments=0, holes=0):
+        self._v = np.empty((vertices, 3), dtype='float64')
+        self._s = np.empty((segments, 2), dtype='int32')
+        self._h = np.empty((holes, 3), dtype='float64')
+        self.nv = self.ns = self.nh = 0
+    
+    @staticmethod
+    def _room(a, used, n):
+        if used + n <= len(a):
+            return a
+        b = np.empty((len(a) + max(n, len(a)), a.shape[1]), dtype=a.dtype)
+        b[:used] = a[:used]
+        return b
+    
+    def newVertices(self, n):
+        #-- the next n rows to fill in place ~ returns the index of the first and the (n, 3) view
+        self._v = self._room(self._v, self.nv, n)
+        start = self.nv
+        self.nv += n
+        return start, self._v[start:self.nv]
+    
+    def addVertices(self, xyz):
+        xyz = np.asarray(xyz, dtype='float64').reshape(-1, 3)
+        start, v = self.newVertices(len(xyz))
+        v[:] = xyz
+        return start
+    
+    def addSegments(self, idx, offset=0):
+        idx = np.asarray(idx, dtype='int32').reshape(-1, 2)
+        self._s = self._room(self._s, self.ns, len(idx))
+        np.add(idx, offset, out=self._s[self.ns:self.ns + len(idx)])
+        self.ns += len(idx)
+        return self._s[self.ns - len(idx):self.ns]
+    
+    def addHoles(self, xyz):
+        xyz = np.asarray(xyz, dtype='float64').reshape(-1, 3)
+        self._h = self._room(self._h, self.nh, len(xyz))
+        self._h[self.nh:self.nh + len(xyz)] = xyz
+        self.nh += len(xyz)
+    
+    def keepVertices(self, keep, start=0):
+        #-- drop the vertices from start on where keep is False ~ in place; the segments follow the vertices left
+        sel = np.concatenate([np.arange(start), start + np.flatnonzero(keep), np.arange(start + len(keep), self.nv)])
+        remap = np.full(self.nv, -1, dtype='int32')
+        remap[sel] = np.arange(len(sel), dtype='int32')
+        self._v[:len(sel)] = self._v[sel]
+        self.nv = len(sel)
+        self._s[:self.ns] = remap[self._s[:self.ns]]
+    
+    @property
+    def vertices(self):
+        return self._v[:self.nv]
+    
+    @property
+    def segments(self):
+        return self._s[:self.ns]
+    
+    @property
+    def holes(self):
+        return self._h[:self.nh]
+
+def getXYZ(dis, aoi, jparams, mesh):
+    """
+    append the terrain points of the raster dem to the mesh (TerrainMesh) ~ returns how many
+    - "terrain_filter": "raster" (default) keeps the cells through a burnt aoi/footprint mask;
+      "vector" tests every point against the aoi - footprints symmetric difference
+    """
+    x, y, z = rasterXYZ(jparams['projClip_raster'])
+    _valid = z != jparams['nodata']
+    if jparams.get('terrain_filter', 'raster') == 'vector':
+        _symdiff = gpd.overlay(aoi, dis, how='symmetric_difference')
+        _valid[_valid] = gpd.GeoSeries(gpd.points_from_xy(x[_valid], y[_valid])).within(_symdiff.loc[0, 'geometry']).values
+    else:
+        _valid &= rasterMask(aoi, dis, jparams['projClip_raster'])
+    
+    #-- straight into the mesh; no DataFrame / Point geometry in between
+    n = int(_valid.sum())
+    start, v = mesh.newVertices(n)
+    for i, a in enumerate((x, y, z)):
+        v[:, i] = a[_valid]
+    np.round(v, 2, out=v)
+    
+    return n
 
 def getosmBld(jparams):
     """
@@ -378,13 +653,7 @@ def getosmBld(jparams):
     dis.set_crs(epsg=int(jparams['crs'][-5:]), inplace=True, allow_override=True)
  
     # remove duplicate vertices within tolerance 0.2 
-    for index, row in dis.iterrows():
-        tmp_gdf = dis.copy()
-        tmp_gdf['distance'] = tmp_gdf.distance(row['geometry'])
-        closest_geom = list(tmp_gdf.sort_values('distance')['geometry'])[1]
-        # I took 1 because index 0 would be the row itself
-        snapped_geom = snap(row['geometry'], closest_geom, 0.2)
-        dis.loc[index, 'geometry'] = snapped_geom
+    dis = snapBld(dis, 0.2)
 
      #-- save
     dis.to_file(jparams['gjson-z_out'], driver='GeoJSON')
@@ -396,6 +665,31 @@ def getosmBld(jparams):
     
     return dis, hs
 
+def snapBld(dis, tolerance):
+    """
+    snap each building to its closest neighbour within tolerance
+    - candidates come from the spatial index; only nearby pairs are measured and snapped
+    """
+    geoms = list(dis.geometry)
+    snapped = list(geoms)
+    sidx = dis.sindex
+    
+    for i, geom in enumerate(geoms):
+        minx, miny, maxx, maxy = geom.bounds
+        #-- neighbours may already have moved by up to tolerance; search twice as wide
+        d = 2 * tolerance
+        cand = sorted(j for j in sidx.intersection((minx - d, miny - d, maxx + d, maxy + d)) if j != i)
+        if len(cand) == 0:
+            continue
+        dist = [snapped[j].distance(geom) for j in cand]
+        k = int(np.argmin(dist))
+        if dist[k] <= tolerance:
+            snapped[i] = snap(geom, snapped[cand[k]], tolerance)
+    
+    dis['geometry'] = gpd.GeoSeries(snapped, index=dis.index, crs=dis.crs)
+    
+    return dis
+
 # def getosmArea(filen):
 #     """
 #     read osm area to gdf and buffer
@@ -499,13 +793,19 @@ def getAOIVertices(buffer, fname):
     dps = 2
     segs = {}
     
+    src_ds = gdal.Open(fname)
+    gt_forward = src_ds.GetGeoTransform()
+    rb = src_ds.GetRasterBand(1)
+    
     for ids, row in buffer.iterrows():
         oring = list(row.geometry.exterior.coords)
+        #-- every vertex of the ring in one (bilinear) read
+        zs = rasterQuery([x for x, y in oring], [y for x, y in oring], gt_forward, rb, 
+                         interpolate='bilinear')
        
         coords_rounded = []
         po = []
-        for x, y in oring:
-            [z] = point_query(Point(x, y), raster=fname)#, interpolate='bilinear', nodata=0)
+        for (x, y), z in zip(oring, zs):
             # if z == None:
             #     rounded_z = float(0)
             # if z != None:
@@ -535,6 +835,7 @@ def getAOIVertices(buffer, fname):
                         segs[key] = 1
                     else:
                         segs[key] += 1
+    src_ds = None
                         
     ca = pd.DataFrame.from_dict(segs, orient="index").reset_index()
     ca.rename(columns={'index':'coords'}, inplace=True)
@@ -547,40 +848,42 @@ def getAOIVertices(buffer, fname):
     
     return acoi, ca
 
-def appendCoords(gdf, ac):
-    df2 = gdf.append(ac, ignore_index=True)
+def createSgmts(ac, c, mesh):
+    """
+    append the vertices of ac and the segments between them to the mesh
+    - returns the segments added: indices of vertices [from, to]
+    """
+    start = mesh.addVertices(ac[['x', 'y', 'z']].values)
     
-    return df2
+    return mesh.addSegments(sgmtIndex(ac, c), start)
 
-def createSgmts(ac, c, gdf, idx):
+def sgmtIndex(ac, c):
     """
-    create a segment list for Triangle
-    - indices of vertices [from, to]
+    look up the [from, to] vertex indices of every segment in one pass
+    - (x, y) of the vertices are hashed once; no scan of ac per segment
     """
+    sg = np.array(c['coords'].tolist(), dtype='float64').reshape(-1, 4)
     
-    l = len(gdf) #- 1
+    key = pd.MultiIndex.from_arrays([ac['x'].values, ac['y'].values])
+    index_f = key.get_indexer(pd.MultiIndex.from_arrays([sg[:, 0], sg[:, 1]]))
+    index_t = key.get_indexer(pd.MultiIndex.from_arrays([sg[:, 2], sg[:, 3]]))
+    if (index_f == -1).any() or (index_t == -1).any():
+        raise ValueError("segment end point not found among the vertices")
     
-    for i, row in c.iterrows():
-        frx, fry = row.coords[0], row.coords[1]
-        tox, toy = row.coords[2], row.coords[3]
+    return np.stack([ac.index.values[index_f], ac.index.values[index_t]], axis=1).astype('int32')
 
-        [index_f] = (ac[(ac['x'] == frx) & (ac['y'] == fry)].index.values)
-        [index_t] = (ac[(ac['x'] == tox) & (ac['y'] == toy)].index.values)
-        idx.append([l + index_f, l + index_t])
-    
-    return idx
-
-def executeDelaunay(hs, df3, idx):
+def executeDelaunay(mesh):
     """
     perform Triangle ~ constrained Delaunay with concavitities removed
-    - return the simplices: indices of vertices that create the triangles
+    - the vertices, segments and holes of the mesh go in as they are
+    - return the simplices: indices of vertices that create the triangles; and the vertices of Triangle ~
+      those of the mesh and after them the ones it adds where segments cross (see addCrossings)
     """      
-    holes = hs[['x', 'y']].round(3).values.tolist()
-    pts = df3[['x', 'y']].values #, 'z']].values
-        
-    A = dict(vertices=pts, segments=idx, holes=holes)
+    A = dict(vertices=mesh.vertices[:, :2], segments=mesh.segments)
+    if mesh.nh > 0:
+        A['holes'] = mesh.holes[:, :2]
     Tr = tr.triangulate(A, 'pVV')  # the VV will print stats in the cmd
-    t = Tr.get('triangles').tolist()
+    t = Tr.get('triangles')
     
      #-- matplotlib for basic 2D plot
     #plt.figure(figsize=(8, 8))
@@ -588,23 +891,101 @@ def executeDelaunay(hs, df3, idx):
     #tr.plot(ax, **Tr)
     #plt.show()
       
-    return t
+    return t, Tr['vertices']
+
+def addCrossings(mesh, V, fname):
+    """
+    append the vertices Triangle added where segments cross (footprints that overlap) to the mesh ~ returns how many
+    - the height is the dem under them (bilinear), as tileTerrain does
+    """
+    extra = V[mesh.nv:]
+    if len(extra) > 0:
+        src_ds = gdal.Open(fname)
+        z = rasterQuery(extra[:, 0], extra[:, 1], src_ds.GetGeoTransform(), src_ds.GetRasterBand(1), 
+                        interpolate='bilinear')
+        src_ds = None
+        mesh.addVertices(np.column_stack([extra, np.round(z, 2)]))
+    
+    return len(extra)
+    
+def thinTerrain(dem, fixed, segments, holes, tolerance, rounds=30):
+    """
+    greedy insertion ~ the dem points (n, 3) a TIN needs to stay within tolerance (m) of every dem point
+    - fixed (m, 3): the constraint vertices (footprints, aoi) are always in; with their segments (indices into fixed) and holes
+    - starts from the outline of the dem points (the extremes of every row and column) so the domain does not change;
+      every round inserts the worst point of each triangle that is off by more than tolerance
+    - returns the mask of the dem points to keep and the largest vertical error of the TIN over all dem points
+    """
+    n = len(dem)
+    keep = np.zeros(n, dtype=bool)
+    if n == 0:
+        return keep, 0.0
+    xy = pd.DataFrame({'x': dem[:, 0], 'y': dem[:, 1]})
+    for a, b in (('y', 'x'), ('x', 'y')):
+        g = xy.groupby(a)[b]
+        keep[g.idxmin().values] = True
+        keep[g.idxmax().values] = True
+    segments = np.asarray(segments, dtype='int32').reshape(-1, 2)
     
-def pvPlot(t, pv_pts, idx, hs):
+    for r in range(rounds + 1):
+        pts = np.concatenate([dem[keep], fixed])
+        A = dict(vertices=pts[:, :2], segments=segments + int(keep.sum()))
+        if len(holes) > 0:
+            A['holes'] = holes
+        Tr = tr.triangulate(A, 'p')
+        V = Tr['vertices']
+        z = pts[:, 2]
+        if len(V) > len(pts):
+            #-- vertices Triangle adds where segments cross ~ the height of the nearest constraint vertex
+            extra = V[len(pts):]
+            near = ((extra[:, np.newaxis, :] - fixed[np.newaxis, :, :2]) ** 2).sum(axis=2).argmin(axis=1)
+            z = np.concatenate([z, fixed[near, 2]])
+        
+        others = np.flatnonzero(~keep)
+        tin = mtri.Triangulation(V[:, 0], V[:, 1], Tr['triangles'])
+        zi = mtri.LinearTriInterpolator(tin, z)(dem[others, 0], dem[others, 1])
+        #-- a point outside the TIN goes in
+        err = np.abs(np.ma.filled(zi, np.inf) - dem[others, 2])
+        worst = float(err.max()) if len(err) > 0 else 0.0
+        if worst <= tolerance:
+            return keep, worst
+        bad = np.flatnonzero(err > tolerance)
+        if r == rounds:
+            keep[others[bad]] = True
+            return keep, float(err[err <= tolerance].max(initial=0.0))
+        
+        #-- the worst point of every triangle
+        t = tin.get_trifinder()(dem[others[bad], 0], dem[others[bad], 1])
+        order = np.lexsort((-err[bad], t))
+        first = np.r_[True, t[order][1:] != t[order][:-1]] | (t[order] == -1)
+        keep[others[bad[order[first]]]] = True
+
+def decimateTerrain(mesh, n, tolerance):
+    """
+    thin the first n vertices (the dem points) of the mesh with thinTerrain ~ in place
+    - the constraint vertices after them stay; the segments follow the vertices left
+    - returns the dem points kept and the largest vertical error (m)
+    """
+    V = mesh.vertices
+    keep, err = thinTerrain(V[:n], V[n:], mesh.segments - n, mesh.holes[:, :2], tolerance)
+    mesh.keepVertices(keep)
+    
+    return int(keep.sum()), err
+    
+def pvPlot(t, mesh):
     """
     3D plot with PyVista
+    - the vertices, segments and holes (at ground height) of the mesh
     """
-    l = np.vstack(idx)
-    l = l.reshape([-1, 2])
-    twos = np.array([[2]] * len(idx))
-    lines = np.append(twos, l, axis=1)
+    twos = np.full((mesh.ns, 1), 2, dtype='int32')
+    lines = np.append(twos, mesh.segments, axis=1)
     
-    trin = pv.PolyData(pv_pts)
-    polygon2 = pv.PolyData(pv_pts)
+    trin = pv.PolyData(mesh.vertices)
+    polygon2 = pv.PolyData(mesh.vertices)
     holes = pv.PolyData()
     # Make sure it has the same points as the mesh being triangulated
-    trin.points = pv_pts
-    holes = hs[['x', 'y', 'ground_height']].values
+    trin.points = mesh.vertices
+    holes = mesh.holes
     
     faces = np.insert(t, 0, np.full((1, len(t)), 3), axis=1)
     trin.faces = faces
@@ -635,34 +1016,29 @@ def output_cityjson(extent, minz, maxz, T, pts, jparams):
     """
     basic function to produce LoD1 City Model
     - buildings and terrain
+    - streamed to file: metadata, the terrain and one Building at a time
+    - vertices are deduplicated as they are added; no cleaning pass
     """
-     ##- open fiona object
-    c = fiona.open(jparams['gjson-z_out'])
-    lsgeom = [] #-- list of the geometries
-    lsattributes = [] #-- list of the attributes
-    for each in c:
-        lsgeom.append(shape(each['geometry'])) #-- geom are casted to Fiona's 
-        lsattributes.append(each['properties'])
-        
-    cm = doVcBndGeom(lsgeom, lsattributes, extent, minz, maxz, T, pts, jparams)    
-    json_str = json.dumps(cm, indent=2)
-    fout = open(jparams['cjsn_out'], "w")
-    fout.write(json_str)  
-     ##- close fiona object
-    c.close()
-    
-    #clean cityjson
-    cm = cityjson.load(jparams['cjsn_out'])
-    cm.remove_duplicate_vertices()
-    cityjson.save(cm, jparams['cjsn_CleanOut'])
-
-def doVcBndGeom(lsgeom, lsattributes, extent, minz, maxz, T, pts, jparams): 
+    cm = doVcBndGeom(extent, minz, maxz, jparams)
+    T = add_terrain_v(pts, T, cm)
+    
+     ##- open fiona object ~ features are read as the buildings are written
+    with fiona.open(jparams['gjson-z_out']) as c:
+        #-- geom are casted to Fiona's 
+        features = ((shape(each['geometry']), dict(each['properties'])) for each in c)
+        buildings = doBldGeom(features, cm, workers=int(jparams.get('workers', 1)))
+        writeCityjson(jparams['cjsn_CleanOut'], cm, T, buildings)
+
+def doVcBndGeom(extent, minz, maxz, jparams, translate=None): 
     #-- create the JSON data structure for the City Model
     cm = {}
     cm["type"] = "CityJSON"
     cm["version"] = "1.0"
-    cm["CityObjects"] = {}
-    cm["vertices"] = []
+    #-- vertices are shared and stored as integers ~ x = (v * scale) + translate
+    if translate is None:
+        translate = [extent[0], extent[1], minz]
+    cm["vertices"] = VertexIndex(translate)
+    cm["transform"] = cm["vertices"].transform()
     #-- Metadata is added manually
     cm["metadata"] = {
     "datasetTitle": jparams['cjsn_title'],
@@ -724,52 +1100,34 @@ def doVcBndGeom(lsgeom, lsattributes, extent, minz, maxz, T, pts, jparams):
     #"metadataStandard": jparams['metaStan'],
     #"metadataStandardVersion": jparams['metaStanV']
     }
-      ##-- do terrain
-    add_terrain_v(pts, cm)
-    grd = {}
-    grd['type'] = 'TINRelief'
-    grd['geometry'] = [] #-- a cityobject can have >1 
-      #-- the geometry
-    g = {} 
-    g['type'] = 'CompositeSurface'
-    g['lod'] = 1
-    allsurfaces = [] #-- list of surfaces
-    add_terrain_b(T, allsurfaces)
-    g['boundaries'] = allsurfaces
-      #-- add the geom 
-    grd['geometry'].append(g)
-      #-- insert the terrain as one new city object
-    cm['CityObjects']['terrain_id-1'] = grd
-    
-     #-- then buildings
-    k = 1
-    for (i, geom) in enumerate(lsgeom):
+
+    return cm
+
+def doBldGeom(features, cm, batch=1000, workers=1):
+    """
+    generate the Building CityObjects ~ (osm_id, building)
+    - footprints are extruded by extrudeBld, a chunk of batch at a time and in parallel when workers > 1
+    - the vertices of each chunk are added to cm['vertices'] in input order
+    """
+    blds = bldFootprints(features)
+    for chunk, extruded in extrudeBatches(blds, batch, workers):
+        #-- hand the buildings over to the writer
+        yield from bldBatch([(attributes, V, surfaces) for (attributes, args), (V, surfaces) in zip(chunk, extruded)], cm)
+
+def bldFootprints(features):
+    """
+    prepare each footprint for extrudeBld ~ (attributes, args)
+    - oriented rings, the height stacks at the exterior vertices, roof/floor/ground heights
+    """
+    for (i, (geom, attributes)) in enumerate(features):
         footprint = geom
-        #-- one building
-        oneb = {}
-        oneb['type'] = 'Building'
-        oneb['attributes'] = {}
-        for k, v in list(lsattributes[i].items()):
-            if v is None:
-                del lsattributes[i][k]
-            #oneb['attributes'][k] = lsattributes[i][k]
-        for a in lsattributes[i]:
-            oneb['attributes'][a] = lsattributes[i][a]
-        
-        oneb['geometry'] = [] #-- a cityobject can have > 1
-        #-- the geometry
-        g = {} 
-        g['type'] = 'Solid'
-        g['lod'] = 1
-        allsurfaces = [] #-- list of surfaces forming the oshell of the solid
+        attributes = {k: v for k, v in attributes.items() if v is not None}
         #-- exterior ring of each footprint
         oring = list(footprint.exterior.coords)
         oring.pop() #-- remove last point since first==last
         if footprint.exterior.is_ccw == False:
             #-- to get proper orientation of the normals
             oring.reverse() 
-        extrude_walls(oring, lsattributes[i]['roof_height'], lsattributes[i]['ground_height'],
-                      allsurfaces, cm)
         #-- interior rings of each footprint
         irings = []
         interiors = list(footprint.interiors)
@@ -780,79 +1138,525 @@ def doVcBndGeom(lsgeom, lsattributes, extent, minz, maxz, T, pts, jparams):
                 #-- to get proper orientation of the normals
                 iring.reverse() 
             irings.append(iring)
-            extrude_walls(iring, lsattributes[i]['roof_height'], lsattributes[i]['ground_height'],
-                          allsurfaces, cm)
-        #-- top-bottom surfaces
-        extrude_roof_ground(oring, irings, lsattributes[i]['roof_height'], 
-                            False, allsurfaces, cm)
-        extrude_roof_ground(oring, irings, lsattributes[i]['ground_height'], 
-                            True, allsurfaces, cm)
-        #-- add the extruded geometry to the geometry
-        g['boundaries'] = []
-        g['boundaries'].append(allsurfaces)
-        #-- add the geom to the building 
-        oneb['geometry'].append(g)
-        #-- insert the building as one new city object
-        cm['CityObjects'][lsattributes[i]['osm_id']] = oneb
-        #cm['CityObjects']['building_id-', [k]['osm_id']] = oneb
-        k =+ 1
+        #-- walls, roof and floor between the ground and roof heights
+        edges = [[attributes['ground_height'], attributes['roof_height']]] * len(oring)
+        yield attributes, (oring, irings, edges, attributes['roof_height'], 
+                           attributes['ground_height'], attributes['ground_height'])
 
-    return cm
+def extrudeBld(oring, irings, edges, height, bottom, ground):
+    """
+    extrusion kernel ~ one footprint to a block of vertices and the surfaces over it
+    - oring and irings are oriented rings without the closing vertex
+    - edges: the stack of heights at each vertex of oring; the walls run up these stacks
+    - interior walls from ground to height; roof at height and floor at bottom
+    - returns the (m, 3) vertex block and the surfaces as indices into the block
+    """
+    oring = np.asarray(oring, dtype='float64')[:, :2]
+    irings = [np.asarray(each, dtype='float64')[:, :2] for each in irings]
+    n = len(oring)
+    k = np.fromiter((len(e) for e in edges), dtype='int64', count=n)
+    off = np.concatenate([[0], np.cumsum(k)])
+    blocks = [np.column_stack([np.repeat(oring, k, axis=0), 
+                               np.fromiter((z for e in edges for z in e), dtype='float64', count=off[-1])])]
+    base = int(off[-1])
+    #-- exterior walls ~ up the stack at one end and down the other
+    if (k == 2).all():
+        a = np.arange(n)
+        b = np.roll(a, -1)
+        surfaces = [[w] for w in np.stack([2 * a, 2 * b, 2 * b + 1, 2 * a + 1], axis=1).tolist()]
+    else:
+        surfaces = []
+        k, off = k.tolist(), off.tolist()
+        for a in range(n):
+            b = (a + 1) % n
+            if k[a] > 2 or k[b] > 2 or (k[a] == 2 and k[b] == 2):
+                surfaces.append([[off[a]] + list(range(off[b], off[b] + k[b])) 
+                                 + list(range(off[a] + k[a] - 1, off[a], -1))])
+    #-- interior walls ~ rectangles
+    for iring in irings:
+        m = len(iring)
+        blocks.append(np.column_stack([np.vstack([iring, iring]), np.repeat([ground, height], m)]))
+        g = base + np.arange(m)
+        g1 = base + np.roll(np.arange(m), -1)
+        surfaces.extend([w] for w in np.stack([g, g1, g1 + m, g + m], axis=1).tolist())
+        base = base + 2 * m
+    #-- roof and floor ~ the floor is reversed
+    rings = [oring] + irings
+    for z, reverse in ((height, False), (bottom, True)):
+        s = []
+        for ring in rings:
+            r = list(range(base, base + len(ring)))
+            s.append(r[::-1] if reverse else r)
+            base = base + len(ring)
+        surfaces.append(s)
+    xy = np.concatenate(rings)
+    blocks.append(np.column_stack([np.vstack([xy, xy]), np.repeat([height, bottom], len(xy))]))
+    
+    return np.concatenate(blocks), surfaces
 
-def add_terrain_v(pts, cm):
-    #cm['vertices'] = pts
-    for p in pts:
-        cm['vertices'].append([p[0], p[1], p[2]])
+def bldBatch(batch, cm):
+    """
+    add the vertices of a batch of extruded buildings at once
+    - yield the Building CityObjects with their surfaces indexed to cm['vertices']
+    """
+    if len(batch) == 0:
+        return
+    ids = cm['vertices'].addBlock(np.concatenate([V for attributes, V, surfaces in batch]))
+    o = 0
+    for attributes, V, surfaces in batch:
+        m = ids[o:o + len(V)]
+        oneb = {}
+        oneb['type'] = 'Building'
+        oneb['attributes'] = attributes
+        #-- the geometry
+        g = {} 
+        g['type'] = 'Solid'
+        g['lod'] = 1
+        g['boundaries'] = [[[[m[j] for j in r] for r in s] for s in surfaces]]
+        oneb['geometry'] = [g]
+        o = o + len(V)
+        yield attributes['osm_id'], oneb
+
+def extrudeChunk(chunk):
+    """
+    extrude a chunk of footprints ~ the unit of work of the process pool
+    """
+    return [extrudeBld(*args) for args in chunk]
+
+def extrudeBatches(blds, batch, workers):
+    """
+    extrude (attributes, args) footprints in chunks of batch ~ (chunk, extruded)
+    - workers > 1: chunks are extruded in a process pool, at most 2 per worker in flight
+    - chunks come back in input order so the merged City Model is the same as the serial one
+    """
+    chunks = iter(lambda: list(islice(blds, batch)), [])
+    if workers <= 1:
+        for chunk in chunks:
+            yield chunk, extrudeChunk([args for attributes, args in chunk])
+        return
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        pending = deque()
+        for chunk in chunks:
+            pending.append((chunk, ex.submit(extrudeChunk, [args for attributes, args in chunk])))
+            if len(pending) >= 2 * workers:
+                chunk, fut = pending.popleft()
+                yield chunk, fut.result()
+        while len(pending) > 0:
+            chunk, fut = pending.popleft()
+            yield chunk, fut.result()
+
+class VertexIndex:
+    """
+    the vertices of the City Model ~ shared and quantized to the transform
+    - addBlock() returns the index of each vertex (a list); a vertex already present (at the scale, 0.001 m) keeps its index
+    - the integer vertices are spooled to a temporary binary file; only the index stays in memory
+    """
+    def __init__(self, translate, scale=0.001, size=100000):
+        self.translate = [float(t) for t in translate]
+        self.scale = scale
+        self.size = size
+        self.index = {}
+        self.tmp = tempfile.TemporaryFile()
+        self.buf = []
+    
+    def addBlock(self, V):
+        #-- quantize the whole block in one go; only the lookup is per vertex
+        q = np.rint((np.asarray(V, dtype='float64').reshape(-1, 3) - self.translate) / self.scale).astype('int64')
+        n = len(self.index)
+        index = self.index
+        ids = [index.setdefault(key, len(index)) for key in zip(*q.T.tolist())]
+        #-- the new vertices are the last entries of the index
+        self.buf.extend(reversed(list(islice(reversed(index), len(index) - n))))
+        if len(self.buf) >= self.size:
+            self.flush()
+        
+        return ids
+    
+    def __len__(self):
+        return len(self.index)
+    
+    def transform(self):
+        return {"scale": [self.scale, self.scale, self.scale], "translate": self.translate}
+    
+    def flush(self):
+        if len(self.buf) > 0:
+            self.tmp.write(np.asarray(self.buf, dtype='int64').tobytes())
+            self.buf = []
+    
+    def blocks(self):
+        self.flush()
+        self.tmp.seek(0)
+        while True:
+            b = self.tmp.read(self.size * 24)
+            if not b:
+                break
+            yield np.frombuffer(b, dtype='int64').reshape(-1, 3)
+    
+    def close(self):
+        self.tmp.close()
+
+def writeCityjson(fname, cm, T, buildings):
+    """
+    stream the City Model to file
+    - the header, the terrain, each building as it is generated and, last, the spooled vertices
+    """
+    with open(fname, 'w') as fout:
+        fout.write('{')
+        for k, v in cm.items():
+            if k not in ('CityObjects', 'vertices'):
+                fout.write('%s: %s, ' % (json.dumps(k), json.dumps(v)))
+        
+        ##-- terrain ~ triangles in chunks
+        fout.write('"CityObjects": {"terrain_id-1": {"type": "TINRelief", "geometry": '
+                   '[{"type": "CompositeSurface", "lod": 1, "boundaries": [')
+        for k in range(0, len(T), 100000):
+            allsurfaces = [] #-- list of surfaces
+            add_terrain_b(T[k:k + 100000].tolist(), allsurfaces)
+            fout.write((', ' if k else '') + json.dumps(allsurfaces)[1:-1])
+        fout.write(']}]}')
+        
+        ##-- then buildings
+        for oid, oneb in buildings:
+            fout.write(', %s: %s' % (json.dumps(str(oid)), json.dumps(oneb)))
+        
+        ##-- and the vertices
+        fout.write('}, "vertices": [')
+        first = True
+        for block in cm['vertices'].blocks():
+            if len(block) == 0:
+                continue
+            fout.write(('' if first else ', ') + json.dumps(block.tolist())[1:-1])
+            first = False
+        fout.write(']}')
+    cm['vertices'].close()
+
+def add_terrain_v(pts, T, cm):
+    """
+    add the terrain vertices the triangles use
+    - return the triangles re-indexed to the shared vertices
+    """
+    T = np.asarray(T, dtype='int64').reshape(-1, 3)
+    used = np.unique(T)
+    vi = np.full(len(pts), -1, dtype='int64')
+    vi[used] = cm['vertices'].addBlock(pts[used])
+    
+    return vi[T]
     
 def add_terrain_b(T, allsurfaces):
     for i in T:
         allsurfaces.append([[i[0], i[1], i[2]]]) 
     
-def extrude_roof_ground(orng, irngs, height, reverse, allsurfaces, cm):
-    oring = copy.deepcopy(orng)
-    irings = copy.deepcopy(irngs)
-    if reverse == True:
-        oring.reverse()
-        for each in irings:
-            each.reverse()
-    for (i, pt) in enumerate(oring):
-        cm['vertices'].append([pt[0], pt[1], height])
-        oring[i] = (len(cm['vertices']) - 1)
-    for (i, iring) in enumerate(irings):
-        for (j, pt) in enumerate(iring):
-            cm['vertices'].append([pt[0], pt[1], height])
-            irings[i][j] = (len(cm['vertices']) - 1)
-    output = []
-    output.append(oring)
-    for each in irings:
-        output.append(each)
-    allsurfaces.append(output)
-
-def extrude_walls(ring, height, ground, allsurfaces, cm):
-    #-- each edge become a wall, ie a rectangle
-    for (j, v) in enumerate(ring[:-1]):
-        l = []
-        cm['vertices'].append([ring[j][0],   ring[j][1],   ground])
-        cm['vertices'].append([ring[j+1][0], ring[j+1][1], ground])
-        cm['vertices'].append([ring[j+1][0], ring[j+1][1], height])
-        cm['vertices'].append([ring[j][0],   ring[j][1],   height])
-        t = len(cm['vertices'])
-        allsurfaces.append([[t-4, t-3, t-2, t-1]])    
-    #-- last-first edge
-    l = []
-    cm['vertices'].append([ring[-1][0], ring[-1][1], ground])
-    cm['vertices'].append([ring[0][0],  ring[0][1],  ground])
-    cm['vertices'].append([ring[0][0],  ring[0][1],  height])
-    cm['vertices'].append([ring[-1][0], ring[-1][1], height])
-    t = len(cm['vertices'])
-    allsurfaces.append([[t-4, t-3, t-2, t-1]])
+def tileGrid(extent, size):
+    """
+    cut the extent into a grid of tiles of size ~ [(i, j, [minx, miny, maxx, maxy]), ...]
+    - tile edges are counted from the extent origin so neighbours share them exactly
+    """
+    nx = max(1, int(np.ceil((extent[2] - extent[0]) / size)))
+    ny = max(1, int(np.ceil((extent[3] - extent[1]) / size)))
+    xs = [extent[0] + i * size for i in range(nx)] + [extent[2]]
+    ys = [extent[1] + j * size for j in range(ny)] + [extent[3]]
+    
+    return [(i, j, [xs[i], ys[j], xs[i + 1], ys[j + 1]]) for j in range(ny) for i in range(nx)]
+
+def tileBox(bounds, step):
+    """
+    the tile as a polygon with a vertex every step (about) along its edges
+    - each edge is spaced from its lower coordinate, so neighbours put the same vertices on the seam
+    """
+    minx, miny, maxx, maxy = bounds
+    xs = np.linspace(minx, maxx, max(1, int(np.ceil((maxx - minx) / step))) + 1).tolist()
+    ys = np.linspace(miny, maxy, max(1, int(np.ceil((maxy - miny) / step))) + 1).tolist()
+    ring = ([(x, miny) for x in xs[:-1]] + [(maxx, y) for y in ys[:-1]] 
+            + [(x, maxy) for x in xs[::-1][:-1]] + [(minx, y) for y in ys[::-1][:-1]])
+    
+    return Polygon(ring)
+
+def tileJobs(extent, aoi, buffer, features, jparams):
+    """
+    the work of each tile ~ (tile, aoi, buffer, footprints)
+    - aoi and buffer are clipped around the tile; footprints are those that touch it 
+    """
+    size = float(jparams['tile_size'])
+    src_ds = gdal.Open(jparams['projClip_raster'])
+    step = abs(src_ds.GetGeoTransform()[1])
+    src_ds = None
+    sidx = gpd.GeoSeries([geom for geom, attributes in features]).sindex
+    for (i, j, bounds) in tileGrid(extent, size):
+        #-- a margin of one step keeps the buffer edges across the seam as they are
+        clip = sg.box(bounds[0] - step, bounds[1] - step, bounds[2] + step, bounds[3] + step)
+        fps = [features[k] for k in sorted(sidx.intersection(bounds))]
+        yield (i, j, bounds), step, aoi.intersection(clip), buffer.intersection(clip), fps
+
+def tileTerrain(bounds, step, aoi, buffer, fps, jparams):
+    """
+    constrained terrain of one tile ~ (pts, triangles)
+    - the tile domain: the densified tile box inside the buffer, less the footprints
+    - its boundary become segments; footprint vertices keep the ground height (the highest
+      where footprints share a vertex); the rest of the boundary is sampled (bilinear) from the dem
+    - dem cells strictly inside the tile and inside the aoi, outside the footprints, fill the domain;
+      thinned with thinTerrain when "terrain_tolerance" is set
+    """
+    dps = 2
+    geoms = [geom for geom, attributes in fps]
+    tile = tileBox(bounds, step).intersection(buffer)
+    dom = tile
+    if len(geoms) > 0:
+        dom = dom.difference(unary_union(geoms))
+    polys = [g for g in getattr(dom, 'geoms', [dom]) if g.geom_type == 'Polygon' and not g.is_empty]
+    if len(polys) == 0:
+        return np.empty((0, 3)), np.empty((0, 3), dtype='int32')
+    
+     ##-- ground height at the footprint vertices
+    zbld = {}
+    for geom, attributes in sorted(fps, key=lambda f: f[1]['ground_height']):
+        for ring in [geom.exterior] + list(geom.interiors):
+            for x, y in ring.coords:
+                zbld[(round(x, dps), round(y, dps))] = round(attributes['ground_height'], dps)
+    
+     ##-- boundary vertices and segments
+    vertices = {}
+    segs = set()
+    for poly in polys:
+        for ring in [poly.exterior] + list(poly.interiors):
+            r = [vertices.setdefault((round(x, dps), round(y, dps)), len(vertices)) for x, y in ring.coords[:-1]]
+            segs.update((min(a, b), max(a, b)) for a, b in zip(r, r[1:] + r[:1]) if a != b)
+    #-- a hole seed inside every footprint cut out of the tile (as hs); a courtyard is ground, not a hole
+    holes = []
+    for geom in geoms:
+        cut = geom.intersection(tile)
+        holes.extend(g.representative_point().coords[0] for g in getattr(cut, 'geoms', [cut]) 
+                     if g.geom_type == 'Polygon' and not g.is_empty)
+    bxy = np.array(list(vertices), dtype='float64').reshape(-1, 2)
+    if len(bxy) < 3:
+        return np.empty((0, 3)), np.empty((0, 3), dtype='int32')
+    
+    src_ds = gdal.Open(jparams['projClip_raster'])
+    gt_forward = src_ds.GetGeoTransform()
+    rb = src_ds.GetRasterBand(1)
+    bz = rasterQuery(bxy[:, 0], bxy[:, 1], gt_forward, rb, interpolate='bilinear')
+    bz = np.array([zbld.get(key, round(float(z), dps)) for key, z in zip(vertices, bz)])
+    
+     ##-- dem cells
+    x, y, z = rasterXYZ(jparams['projClip_raster'], bounds)
+    _valid = z != jparams['nodata']
+    #-- strictly inside the tile; cells on a seam would belong to neither neighbour's boundary
+    _valid &= (x > bounds[0] + 0.01) & (x < bounds[2] - 0.01) & (y > bounds[1] + 0.01) & (y < bounds[3] - 0.01)
+    if not aoi.is_empty:
+        _valid &= rasterMask(gpd.GeoDataFrame(geometry=[aoi]), gpd.GeoDataFrame(geometry=geoms), 
+                             jparams['projClip_raster'], bounds)
+    else:
+        _valid[:] = False
+    df = pd.DataFrame({'x': x[_valid], 'y': y[_valid], 'z': z[_valid].astype('float64')}).round(dps)
+    df = df[~pd.MultiIndex.from_arrays([df['x'], df['y']]).isin(list(vertices))]
+    
+    nb = len(bxy)
+    mesh = TerrainMesh(nb + len(df), len(segs), len(holes))
+    mesh.addVertices(np.column_stack([bxy, bz]))
+    mesh.addVertices(df[['x', 'y', 'z']].values)
+    mesh.addSegments(sorted(segs))
+    mesh.addHoles([(hx, hy, np.nan) for hx, hy in holes])
+    if jparams.get('terrain_tolerance') and len(df) > 0:
+        V = mesh.vertices
+        keep, err = thinTerrain(V[nb:], V[:nb], mesh.segments, mesh.holes[:, :2], float(jparams['terrain_tolerance']))
+        mesh.keepVertices(keep, nb)
+    
+    A = dict(vertices=mesh.vertices[:, :2], segments=mesh.segments)
+    if mesh.nh > 0:
+        A['holes'] = mesh.holes[:, :2]
+    Tr = tr.triangulate(A, 'p')
+    t = Tr.get('triangles', np.empty((0, 3), dtype='int32'))
+    
+    #-- vertices Triangle adds where segments cross
+    extra = Tr['vertices'][mesh.nv:]
+    if len(extra) > 0:
+        ez = rasterQuery(extra[:, 0], extra[:, 1], gt_forward, rb, interpolate='bilinear')
+        mesh.addVertices(np.column_stack([extra, np.round(ez, dps)]))
+    src_ds = None
     
+    return mesh.vertices, t
+
+def processTile(job, translate, jparams):
+    """
+    the pipeline on one tile ~ terrain, buildings and a CityJSON of its own in "tile_dir"
+    - a building belongs to the tile that holds its representative_point()
+    - returns (file, minz, maxz, buildings); None for an empty tile
+    """
+    (i, j, bounds), step, aoi, buffer, fps = job
+    pts, T = tileTerrain(bounds, step, aoi, buffer, fps, jparams)
+    
+    own = []
+    for geom, attributes in fps:
+        rp = geom.representative_point()
+        if bounds[0] <= rp.x < bounds[2] and bounds[1] <= rp.y < bounds[3]:
+            own.append((geom, attributes))
+    if len(T) == 0 and len(own) == 0:
+        return None
+    
+    zs = list(pts[:, 2]) + [a['ground_height'] for g, a in own] + [a['roof_height'] for g, a in own]
+    minz, maxz = float(np.nanmin(zs)), float(np.nanmax(zs))
+    
+    fname = os.path.join(jparams['tile_dir'], 'tile_%d_%d.city.json' % (i, j))
+    #-- every tile is on the transform of the whole extent ~ the same seam vertex is the same integer vertex
+    cm = doVcBndGeom(bounds, minz, maxz, jparams, translate=translate)
+    T = add_terrain_v(pts, T, cm)
+    writeCityjson(fname, cm, T, doBldGeom(own, cm))
+    
+    return fname, minz, maxz, len(own)
+
+def tileKey(job, translate, jparams):
+    """
+    fingerprint of a tile ~ its bounds, the clipped aoi and buffer, the footprints (geometry and attributes), 
+    the dem window under it and the parameters that shape it ("terrain_tolerance" and the cjsn_* metadata)
+    """
+    (i, j, bounds), step, aoi, buffer, fps = job
+    #-- not the output file names
+    params = {k: v for k, v in jparams.items() 
+              if k == 'terrain_tolerance' or (k.startswith('cjsn_') and k != 'cjsn_CleanOut')}
+    h = hashlib.sha256(json.dumps([bounds, step, translate, jparams['nodata'], params], 
+                                  sort_keys=True, default=str).encode('utf-8'))
+    for geom in (aoi, buffer):
+        h.update(b'' if geom.is_empty else geom.wkb)
+    for geom, attributes in fps:
+        h.update(geom.wkb)
+        h.update(json.dumps(attributes, sort_keys=True, default=str).encode('utf-8'))
+    
+    #-- the dem a cell around the tile ~ the bilinear boundary heights reach that far
+    src_ds = gdal.Open(jparams['projClip_raster'])
+    xoff, yoff, w, hgt = rasterWindow(src_ds, [bounds[0] - 2 * step, bounds[1] - 2 * step, 
+                                               bounds[2] + 2 * step, bounds[3] + 2 * step])
+    h.update(json.dumps(src_ds.GetGeoTransform()).encode('utf-8'))
+    if w > 0 and hgt > 0:
+        h.update(src_ds.GetRasterBand(1).ReadAsArray(xoff, yoff, w, hgt).tobytes())
+    src_ds = None
+    
+    return h.hexdigest()
+
+def tileChanged(jobs, translate, jparams, previous, manifest):
+    """
+    pass the jobs of tiles that changed since previous (the manifest of the last run) ~ (tile id, job)
+    - manifest is filled with [fingerprint, tile]; an unchanged tile keeps the tile of the last run
+    """
+    for job in jobs:
+        tid = '%d_%d' % job[0][:2]
+        key = tileKey(job, translate, jparams)
+        old = previous.get(tid)
+        if old is not None and old[0] == key and (old[1] is None or os.path.exists(old[1][0])):
+            manifest[tid] = old
+        else:
+            manifest[tid] = [key, None]
+            yield tid, job
+
+def tileCityjson(aoi, buffer, extent, jparams):
+    """
+    tiled district mode ~ the extent is cut into tiles of "tile_size" and each is triangulated and built on its own
+    - one tile in memory per worker; tiles run in "workers" processes, at most 2 per worker in flight
+    - "tile_merge": "True" stitches the tiles into "cjsn_CleanOut"
+    - "incremental": "True" only rebuilds the tiles whose inputs changed since the last run (tile_dir/manifest.json)
+    - returns the (file, minz, maxz, buildings) of the tiles that are not empty
+    """
+    os.makedirs(jparams['tile_dir'], exist_ok=True)
+    translate = [extent[0], extent[1], 0.0]
+    workers = int(jparams.get('workers', 1))
+    
+    with fiona.open(jparams['gjson-z_out']) as c:
+        features = [(shape(each['geometry']), dict(each['properties'])) for each in c]
+    jobs = tileJobs(extent, aoi.geometry.iloc[0], buffer.geometry.iloc[0], features, jparams)
+    
+    manifest = {}
+    mname = os.path.join(jparams['tile_dir'], 'manifest.json')
+    if jparams.get('incremental') == 'True':
+        previous = {}
+        if os.path.exists(mname):
+            with open(mname) as f:
+                previous = json.load(f)
+        jobs = tileChanged(jobs, translate, jparams, previous, manifest)
+    else:
+        jobs = (('%d_%d' % job[0][:2], job) for job in jobs)
+    
+    done = {}
+    if workers <= 1:
+        done = {tid: processTile(job, translate, jparams) for tid, job in jobs}
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            pending = deque()
+            for tid, job in jobs:
+                pending.append((tid, ex.submit(processTile, job, translate, jparams)))
+                if len(pending) >= 2 * workers:
+                    tid, fut = pending.popleft()
+                    done[tid] = fut.result()
+            while len(pending) > 0:
+                tid, fut = pending.popleft()
+                done[tid] = fut.result()
+    
+    if jparams.get('incremental') == 'True':
+        for tid, tile in done.items():
+            manifest[tid][1] = tile
+        tmp = '{}.{}.tmp'.format(mname, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp, mname)
+        print('incremental: {} of {} tiles rebuilt'.format(len(done), len(manifest)))
+        done = {tid: tile for tid, (key, tile) in manifest.items()}
+    tiles = [t for t in done.values() if t is not None]
+    
+    if jparams.get('tile_merge') == 'True' and len(tiles) > 0:
+        mergeTiles(tiles, extent, translate, jparams)
+    
+    return tiles
+
+def reindexBnd(b, vi):
+    """
+    boundaries of a CityObject on new vertex indices
+    """
+    return [reindexBnd(x, vi) for x in b] if isinstance(b, list) else vi[b]
+
+def mergeTiles(tiles, extent, translate, jparams):
+    """
+    stitch the tiles into one City Model ~ "cjsn_CleanOut"
+    - all tiles are on one transform; their vertices go through one VertexIndex so the seams are shared
+    - each tile keeps its own TINRelief (terrain_id-i_j); one tile in memory at a time
+    """
+    minz = min(t[1] for t in tiles)
+    maxz = max(t[2] for t in tiles)
+    cm = doVcBndGeom(extent, minz, maxz, jparams, translate=translate)
+    
+    with open(jparams['cjsn_CleanOut'], 'w') as fout:
+        fout.write('{')
+        for k, v in cm.items():
+            if k not in ('CityObjects', 'vertices'):
+                fout.write('%s: %s, ' % (json.dumps(k), json.dumps(v)))
+        fout.write('"CityObjects": {')
+        first = True
+        for fname, tminz, tmaxz, n in tiles:
+            with open(fname) as f:
+                t = json.load(f)
+            V = np.array(t['vertices'], dtype='float64').reshape(-1, 3) * t['transform']['scale'] + t['transform']['translate']
+            vi = cm['vertices'].addBlock(V)
+            tid = os.path.basename(fname).split('.')[0].replace('tile_', '')
+            for oid, obj in t['CityObjects'].items():
+                if obj['type'] == 'TINRelief':
+                    oid = 'terrain_id-' + tid
+                for g in obj['geometry']:
+                    g['boundaries'] = reindexBnd(g['boundaries'], vi)
+                fout.write(('' if first else ', ') + '%s: %s' % (json.dumps(oid), json.dumps(obj)))
+                first = False
+        
+        fout.write('}, "vertices": [')
+        first = True
+        for block in cm['vertices'].blocks():
+            if len(block) == 0:
+                continue
+            fout.write(('' if first else ', ') + json.dumps(block.tolist())[1:-1])
+            first = False
+        fout.write(']}')
+    cm['vertices'].close()
+
 def write275obj(jparams):
     """
     export 2.75D wavefront.obj surface
     """
     
-    cm1 = cityjson.load(jparams['cjsn_out'])
+    cm1 = cityjson.load(jparams['cjsn_CleanOut'])
     with open(jparams['obj-2_75D'], 'w+') as f:
         re = cm1.export2obj()
         f.write(re.getvalue())
@@ -13,8 +13,8 @@ import time
 from datetime import timedelta
 
 from osm3DCodeDistricts import getOsmPBF, projVec, prepareDEM, assignZ, getosmBld, writegjson,\
-    getXYZ, getBldVertices, getAOIVertices, appendCoords, createSgmts, executeDelaunay, \
-        pvPlot, writeObj, output_cityjson, createXYZ, write275obj
+    getXYZ, getBldVertices, getAOIVertices, TerrainMesh, createSgmts, executeDelaunay, addCrossings, \
+        decimateTerrain, pvPlot, writeObj, output_cityjson, createXYZ, write275obj, tileCityjson
     
 def main():
     start = time.time()
@@ -42,38 +42,46 @@ def main():
     os.makedirs(path, exist_ok=True)
 
     prepareDEM(extent, jparams)
-    createXYZ(jparams['xyz'], jparams['projClip_raster'])
+    if jparams.get('xyz_export') == 'True':
+        createXYZ(jparams['xyz'], jparams['projClip_raster'])
     ts = assignZ(jparams) # jparams['gjson-proj_out'], jparams['projClip_raster'])
     writegjson(ts, jparams)
     
     dis, hs = getosmBld(jparams)
     
-    gdf = getXYZ(dis, aoi_proj, jparams)
-    ac, c = getBldVertices(dis)
-    df2 = appendCoords(gdf, ac)
-    
-    idx = []
-    idx = createSgmts(ac, c, gdf, idx)
-    
-    acoi, ca = getAOIVertices(buffer, jparams['projClip_raster'])
+    if jparams.get('tile_size'):
+         #-- tiled: terrain and buildings per tile; stitched into one City Model with "tile_merge"
+        tileCityjson(aoi_proj, buffer, extent, jparams)
+        if jparams.get('tile_merge') == 'True':
+            write275obj(jparams)
+    else:
+        ac, c = getBldVertices(dis)
+        acoi, ca = getAOIVertices(buffer, jparams['projClip_raster'])
         
-    idx = createSgmts(acoi, ca, df2, idx)
-    df3 = appendCoords(df2, acoi)
-    pts = df3[['x', 'y', 'z']].values
-    
-     #-- change the dtype to 'float64'
-    #pts = pts.astype('float64')
+         #-- one preallocated mesh: dem points, then footprint and aoi vertices with their segments
+        mesh = TerrainMesh(len(ac) + len(acoi), len(c) + len(ca), len(hs))
+        n = getXYZ(dis, aoi_proj, jparams, mesh)
+        createSgmts(ac, c, mesh)
+        createSgmts(acoi, ca, mesh)
+        mesh.addHoles(hs[['x', 'y', 'ground_height']].round({'x': 3, 'y': 3}).values)
+        if jparams.get('terrain_tolerance'):
+             #-- thin the dem points to those the surface needs within "terrain_tolerance" (m)
+            m, err = decimateTerrain(mesh, n, float(jparams['terrain_tolerance']))
+            print('terrain: {} of {} dem points within {} m (largest error {:.3f} m)'.format(m, n, jparams['terrain_tolerance'], err))
 
-    t = executeDelaunay(hs, df3, idx)
+        t, V = executeDelaunay(mesh)
+        #-- where footprints overlap Triangle adds vertices; the triangles index them after the mesh vertices
+        addCrossings(mesh, V, jparams['projClip_raster'])
+        pts = mesh.vertices
     
-     #-- check terrain with a plot
-    pvPlot(t, pts, idx, hs)
+         #-- check terrain with a plot
+        pvPlot(t, mesh)
 
-    minz = df3['z'].min()
-    maxz = df3['z'].max()
-    #writeObj(pts, t, 'wvft_cput3d.obj') ~ this will write the terrain surface only
-    output_cityjson(extent, minz, maxz, t, pts, jparams)
-    write275obj(jparams)
+        minz = pts[:, 2].min()
+        maxz = pts[:, 2].max()
+        #writeObj(pts, t, 'wvft_cput3d.obj') ~ this will write the terrain surface only
+        output_cityjson(extent, minz, maxz, t, pts, jparams)
+        write275obj(jparams)
     
     #if jparams['inter'] == 'True':
         #write_interactive(area, jparams)
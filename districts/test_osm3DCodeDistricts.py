@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+# env/osm3D_d-env
+######################
+# tests for osm3DCodeDistricts ~ the tiled mode on a synthetic dem and footprints
+#
+# python -m pytest test_osm3DCodeDistricts.py
+#####################
+
+import os
+import json
+
+import numpy as np
+import geopandas as gpd
+from shapely.geometry import box, mapping, Polygon
+from shapely.ops import snap
+from osgeo import gdal
+
+from osm3DCodeDistricts import tileCityjson, writegjson, snapBld
+
+EXTENT = [0.0, 0.0, 400.0, 400.0]
+
+def demTif(fname, step=5.0):
+    n = int((EXTENT[2] - EXTENT[0]) / step)
+    x = np.arange(n) * step
+    z = 50.0 + 0.02 * x[np.newaxis, :] + 0.01 * x[::-1, np.newaxis]
+    ds = gdal.GetDriverByName('GTiff').Create(fname, n, n, 1, gdal.GDT_Float32)
+    ds.SetGeoTransform((EXTENT[0], step, 0.0, EXTENT[3], 0.0, -step))
+    band = ds.GetRasterBand(1)
+    band.WriteArray(z)
+    band.SetNoDataValue(-9999)
+    ds.FlushCache()
+    ds = None
+
+def footprints(fname, roofs):
+    features = []
+    for k, roof in enumerate(roofs):
+        x, y = 40 + (k % 8) * 40, 40 + (k // 8) * 40
+        features.append({'type': 'Feature', 'geometry': mapping(box(x, y, x + 12, y + 9)),
+                         'properties': {'osm_id': k + 1, 'osm_building': 'house', 
+                                        'ground_height': 55.0, 'roof_height': roof}})
+    with open(fname, 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': features}, f)
+
+def tileParams(tmp_path, name, incremental):
+    jparams = {k: 'test' for k in ['cjsn_title', 'cjsn_referenceDate', 'cjsn_referenceSystem', 'cjsn_contactName', 
+                                   'cjsn_emailAddress', 'cjsn_contactType', 'cjsn_website', 'cjsn_+meta-description', 
+                                   'cjsn_+meta-sourceSpatialResolution', 'cjsn_+meta-sourceReferenceSystem', 
+                                   'cjsn_+meta-sourceCitation']}
+    jparams.update({'projClip_raster': str(tmp_path / 'dem.tif'), 'nodata': -9999, 
+                    'gjson-z_out': str(tmp_path / 'footprints.geojson'), 'tile_size': 100, 'tile_merge': 'True', 
+                    'workers': 1, 'incremental': incremental, 'tile_dir': str(tmp_path / name), 
+                    'cjsn_CleanOut': str(tmp_path / (name + '.city.json'))})
+    
+    return jparams
+
+def test_incremental_tiles(tmp_path):
+    demTif(str(tmp_path / 'dem.tif'))
+    aoi = gpd.GeoDataFrame(geometry=[box(20, 20, 380, 380)])
+    buffer = gpd.GeoDataFrame(geometry=[box(10, 10, 390, 390)])
+    roofs = [60.0 + k % 5 for k in range(56)]
+    
+    inc = tileParams(tmp_path, 'inc', 'True')
+    footprints(inc['gjson-z_out'], roofs)
+    for t in tileCityjson(aoi, buffer, EXTENT, inc):
+        #-- a tile written again gets a new mtime
+        os.utime(t[0], (0, 0))
+    
+    #-- one house higher ~ only the tiles it touches are built again
+    roofs[9] = roofs[9] + 3
+    footprints(inc['gjson-z_out'], roofs)
+    tiles = tileCityjson(aoi, buffer, EXTENT, inc)
+    rebuilt = [t[0] for t in tiles if os.path.getmtime(t[0]) > 0]
+    assert 1 <= len(rebuilt) <= 4 and len(rebuilt) < len(tiles)
+    
+    full = tileParams(tmp_path, 'full', 'False')
+    tileCityjson(aoi, buffer, EXTENT, full)
+    with open(inc['cjsn_CleanOut'], 'rb') as a, open(full['cjsn_CleanOut'], 'rb') as b:
+        assert a.read() == b.read()
+
+def test_writegjson(tmp_path):
+    #-- the attributes of the baseline iterrows() loop; missing tags no longer come through as NaN / 'nan'
+    x0, y0 = 260000.0, 6240000.0
+    ts = gpd.GeoDataFrame({'id': [1, 2, 3], 'building': ['house', 'yes', None], 'building:levels': ['2', '1', '3'], 
+                           'name': ['Kerk', None, None], 'addr:housenumber': ['12', None, '5'], 
+                           'addr:street': ['Main Road', None, 'Long St'], 
+                           #-- 1 * 2.8 + 1.3 + 99.875 is 103.975 ~ round() takes it down, numpy up
+                           'mean': [101.234, 99.875, 100.005]}, 
+                          geometry=[box(x0 + k * 20, y0, x0 + k * 20 + 10, y0 + 8) for k in range(3)], crs='EPSG:32734')
+    fname = str(tmp_path / 'footprints.geojson')
+    writegjson(ts, {'crs': 'EPSG:32734', 'gjson-z_out': fname})
+    
+    with open(fname) as f:
+        features = json.load(f)['features']
+    assert [f['properties'] for f in features] == [
+        {'osm_id': 1, 'osm_building': 'house', 'osm_building:levels': '2', 'osm_name': 'Kerk', 
+         'osm_address': '12 Main Road', 'plus_code': '4FRW2CW3+Q54', 
+         'ground_height': 101.23, 'building_height': 6.9, 'roof_height': 108.13},
+        {'osm_id': 2, 'osm_building': 'yes', 'osm_building:levels': '1', 'osm_address': '', 
+         'plus_code': '4FRW2CW3+Q73', 'ground_height': 99.88, 'building_height': 4.1, 'roof_height': 103.97},
+        {'osm_id': 3, 'osm_building:levels': '3', 'osm_address': '5 Long St', 
+         'plus_code': '4FRW2CW3+Q92', 'ground_height': 100.0, 'building_height': 9.7, 'roof_height': 109.7}]
+
+def test_snapBld():
+    #-- rows of houses 0.05 - 0.15 m apart with corners a little off; none touching (the one case the baseline got wrong)
+    rng = np.random.default_rng(3)
+    geoms = []
+    for row in range(4):
+        x = 0.0
+        for k in range(6):
+            w = 8 + rng.random() * 4
+            jitter = rng.random(4) * 0.03
+            geoms.append(Polygon([(x, row * 30), (x + w, row * 30 + jitter[0]), (x + w + jitter[1], row * 30 + 10), 
+                                  (x + jitter[2], row * 30 + 10 + jitter[3])]))
+            x = x + w + 0.05 + rng.random() * 0.1
+    dis = gpd.GeoDataFrame(geometry=geoms, crs='EPSG:32734')
+    
+    #-- the baseline: distance to every building, the closest other one
+    old = dis.copy()
+    for index, row in old.iterrows():
+        tmp_gdf = old.copy()
+        tmp_gdf['distance'] = tmp_gdf.distance(row['geometry'])
+        closest_geom = list(tmp_gdf.sort_values('distance')['geometry'])[1]
+        old.loc[index, 'geometry'] = snap(row['geometry'], closest_geom, 0.2)
+    
+    new = snapBld(dis.copy(), 0.2)
+    assert any(not a.equals_exact(b, 0) for a, b in zip(dis.geometry, new.geometry))
+    assert all(a.equals_exact(b, 0) for a, b in zip(old.geometry, new.geometry))
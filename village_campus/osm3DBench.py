@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+# env/osm3D_vc-env
+######################
+# benchmark for osm3DCode ~ offline, on synthetic footprints and DEMs (and one real DEM)
+# github: https://github.com/AdrianKriger/osm_LoD1_3DCityModel
+#
+# python osm3DBench.py --sizes 50 500 5000 --res 25 10 5
+#   - every case runs the osm3DMain stages with the two overpass stages replaced by synthetic ones
+#   - results are appended to bench/history.jsonl with the git commit; each case is compared
+#     with its last run on another commit
+#####################
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+import numpy as np
+import geopandas as gpd
+from shapely.geometry import Polygon, box
+
+from osgeo import gdal, osr
+
+import time
+from datetime import datetime
+
+from osm3DCode import getOsmArea
+from osm3DMain import STAGES, RunReport, runStages
+
+NODATA = 3.402823466385289e+38
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mwe', 'LO19_050M_3318CD.tif')
+
+def synthDEM(fname, bounds, res, crs):
+    """
+    a synthetic GeoTIFF DEM over bounds [minx, miny, maxx, maxy] ~ rolling hills on a slope; north-up
+    """
+    w = int(np.ceil((bounds[2] - bounds[0]) / res))
+    h = int(np.ceil((bounds[3] - bounds[1]) / res))
+    x = bounds[0] + (np.arange(w) + 0.5) * res
+    y = bounds[3] - (np.arange(h)[:, np.newaxis] + 0.5) * res
+    z = 40 + 0.01 * (x - bounds[0]) + 6 * np.sin((x - bounds[0]) / 350) * np.cos((y - bounds[1]) / 270)
+
+    ds = gdal.GetDriverByName('GTiff').Create(fname, w, h, 1, gdal.GDT_Float32, ['TILED=YES', 'COMPRESS=DEFLATE'])
+    ds.SetGeoTransform([bounds[0], res, 0, bounds[3], 0, -res])
+    srs = osr.SpatialReference()
+    srs.SetFromUserInput(crs)
+    ds.SetProjection(srs.ExportToWkt())
+    band = ds.GetRasterBand(1)
+    band.SetNoDataValue(NODATA)
+    band.WriteArray(z.astype('float32'))
+    ds = None
+
+def synthLot(x0, y0, kind, levels):
+    """
+    the osm buildings on one 40 m lot ~ [(geometry, building, tags), ...]
+    - 0 a house; 1 a house with a courtyard; 2 two houses on a shared wall;
+      3 two houses joined by a bridge; 4 a house with a roof (carport) against it
+    - shared walls carry the same vertices on both sides, as in osm
+    """
+    def tags(n, **kw):
+        return dict({'building:levels': str(n)}, **kw)
+
+    if kind == 0:
+        return [(box(x0 + 5, y0 + 5, x0 + 17 + levels * 2, y0 + 15 + levels * 3), 'house', tags(levels))]
+    if kind == 1:
+        return [(Polygon(box(x0 + 5, y0 + 5, x0 + 30, y0 + 30).exterior.coords,
+                         [box(x0 + 12, y0 + 12, x0 + 23, y0 + 23).exterior.coords]), 'apartments', tags(levels + 1))]
+    if kind == 2:
+        return [(box(x0 + 5, y0 + 5, x0 + 17, y0 + 20), 'house', tags(levels)),
+                (box(x0 + 17, y0 + 5, x0 + 30, y0 + 20), 'house', tags(levels + 1))]
+    if kind == 3:
+        a = Polygon([(x0 + 3, y0 + 5), (x0 + 13, y0 + 5), (x0 + 13, y0 + 15), (x0 + 13, y0 + 20),
+                     (x0 + 13, y0 + 30), (x0 + 3, y0 + 30)])
+        b = Polygon([(x0 + 25, y0 + 5), (x0 + 35, y0 + 5), (x0 + 35, y0 + 30), (x0 + 25, y0 + 30),
+                     (x0 + 25, y0 + 20), (x0 + 25, y0 + 15)])
+        return [(a, 'office', tags(3)), (b, 'office', tags(3)),
+                (box(x0 + 13, y0 + 15, x0 + 25, y0 + 20), 'bridge', tags(3, min_height='4'))]
+
+    house = Polygon([(x0 + 5, y0 + 5), (x0 + 20, y0 + 5), (x0 + 20, y0 + 10), (x0 + 20, y0 + 20),
+                     (x0 + 20, y0 + 25), (x0 + 5, y0 + 25)])
+    return [(house, 'house', tags(levels)), (box(x0 + 20, y0 + 10, x0 + 30, y0 + 20), 'roof', tags(1))]
+
+def synthFootprints(n, origin, crs, seed=0):
+    """
+    about n synthetic osm buildings on a square grid of 40 m lots from origin ~ the frame requestOsmBld returns
+    - returns the buildings and the aoi (the grid and a 20 m margin)
+    """
+    rng = np.random.default_rng(seed)
+    side = int(np.ceil(np.sqrt(n / 1.6)))
+    rows = []
+    i = 0
+    while len(rows) < n:
+        x0 = origin[0] + (i % side) * 40.0
+        y0 = origin[1] + (i // side) * 40.0
+        for geom, bld, tags in synthLot(x0, y0, int(rng.integers(5)), int(rng.integers(1, 4))):
+            tags = dict(tags, building=bld)
+            rows.append({'type': 'way', 'id': len(rows) + 1, 'tags': tags, 'bld': bld,
+                         'properties': {'type': 'way', 'id': len(rows) + 1, 'tags': tags}, 'geometry': geom})
+        i = i + 1
+    ts = gpd.GeoDataFrame(rows, geometry='geometry', crs=crs)
+
+    minx, miny, maxx, maxy = ts.total_bounds
+    aoi = gpd.GeoDataFrame({'type': ['way'], 'tags': [{'name': 'bench'}], 'id': [0]},
+                           geometry=[box(minx - 20, miny - 20, maxx + 20, maxy + 20)], crs=crs)
+
+    return ts, aoi
+
+def fixtureOrigin(fname, crs, n):
+    """
+    lower-left of a grid of about n buildings centred on a raster ~ in crs
+    """
+    ds = gdal.Open(fname)
+    gt = ds.GetGeoTransform()
+    cx = gt[0] + gt[1] * ds.RasterXSize / 2 + gt[2] * ds.RasterYSize / 2
+    cy = gt[3] + gt[4] * ds.RasterXSize / 2 + gt[5] * ds.RasterYSize / 2
+    src, dst = osr.SpatialReference(), osr.SpatialReference()
+    src.ImportFromWkt(ds.GetProjection())
+    dst.SetFromUserInput(crs)
+    for s in (src, dst):
+        if hasattr(s, 'SetAxisMappingStrategy'):
+            s.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    x, y, z = osr.CoordinateTransformation(src, dst).TransformPoint(cx, cy)
+    ds = None
+    half = np.ceil(np.sqrt(n / 1.6)) * 20.0
+
+    return x - half, y - half
+
+def benchParams(case, out, crs, in_raster, workers):
+    d = os.path.join(out, case)
+    os.makedirs(d, exist_ok=True)
+    jparams = {
+        "crs": crs,
+        "osm_type": "way",
+        "aoi": os.path.join(d, "aoi.geojson"),
+        "osm_bldings": os.path.join(d, "fp_proj_z.geojson"),
+        "in_raster": in_raster,
+        "nodata": NODATA,
+        "projClip_raster": os.path.join(d, "clip.tif"),
+        "xyz": os.path.join(d, "rasElev.xyz"),
+        "cjsn_solid": os.path.join(d, "citjsn.json"),
+        "report": os.path.join(d, "report"),
+        "workers": workers,
+        "topology_errors": 0,
+        #-- every run warps the dem; a cached dem would make prepareDEM incomparable across the history
+        "dem_cache": "False",
+        }
+    for k in ['cjsn_title', 'cjsn_referenceDate', 'cjsn_referenceSystem', 'cjsn_contactName', 'cjsn_emailAddress',
+              'cjsn_contactType', 'cjsn_website', 'cjsn_+meta-description', 'cjsn_+meta-sourceSpatialResolution',
+              'cjsn_+meta-sourceReferenceSystem', 'cjsn_+meta-sourceCitation']:
+        jparams[k] = 'osm3DBench'
+
+    return jparams
+
+def benchStages(ts, aoi):
+    """
+    the osm3DMain stages with synthetic buildings and aoi in place of the overpass requests
+    """
+    def stageOsmBld(state, jparams, report):
+        return {'ts': ts.copy()}
+
+    def stageOsmAoi(state, jparams, report):
+        aoi_, aoibuffer, extent = report.call(getOsmArea, aoi.copy(), jparams['aoi'], 'way', jparams['crs'])
+        return {'aoi': aoi_, 'aoibuffer': aoibuffer, 'extent': extent}
+
+    stages = dict(STAGES)
+    stages['osm_bld'] = dict(STAGES['osm_bld'], run=stageOsmBld)
+    stages['osm_aoi'] = dict(STAGES['osm_aoi'], run=stageOsmAoi)
+
+    return stages
+
+def runCase(case, ts, aoi, jparams):
+    report = RunReport(jparams['report'])
+    start = time.time()
+    timings, restored = runStages(benchStages(ts, aoi), jparams, report)
+    total = time.time() - start
+    report.write(case, timings, restored)
+
+    return {'case': case, 'buildings': len(ts), 'total': total, 'stages': timings, 'functions': report.rows}
+
+def gitCommit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def readHistory(fname):
+    if not os.path.exists(fname):
+        return []
+    with open(fname) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def compareRun(run, history, tolerance):
+    """
+    the stages of run slower than tolerance times those of the last run of the case on another commit
+    - prints the comparison; returns the regressions [(stage, before, now), ...]
+    """
+    before = [h for h in history if h['case'] == run['case'] and h['commit'] != run['commit']]
+    print('')
+    print('{} ~ {} buildings, {:.2f} s'.format(run['case'], run['buildings'], run['total']))
+    if len(before) == 0:
+        for name, seconds in run['stages'].items():
+            print('  {:<12}{:>10.3f}'.format(name, seconds))
+        return []
+
+    base = before[-1]
+    slow = []
+    print('  {:<12}{:>10}{:>10}  ({})'.format('', base['commit'], run['commit'], base['date']))
+    for name, seconds in run['stages'].items():
+        was = base['stages'].get(name)
+        flag = ''
+        #-- stages under 50 ms are noise
+        if was is not None and seconds > tolerance * was and seconds > 0.05:
+            slow.append((name, was, seconds))
+            flag = '  REGRESSION x{:.2f}'.format(seconds / was)
+        print('  {:<12}{:>10}{:>10.3f}{}'.format(name, '-' if was is None else '{:.3f}'.format(was), seconds, flag))
+
+    return slow
+
+def main():
+    parser = argparse.ArgumentParser(description='offline benchmark of the village/campus pipeline')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50, 500, 5000],
+                        help='buildings per case (50 ... 100000)')
+    parser.add_argument('--res', type=float, nargs='+', default=[25, 10, 5], help='synthetic DEM resolutions (m)')
+    parser.add_argument('--crs', default='EPSG:32734')
+    parser.add_argument('--fixture', default=FIXTURE, help='a real DEM to run the sizes on as well ("" to skip)')
+    parser.add_argument('--out', default='./bench')
+    parser.add_argument('--history', default=None, help='default: <out>/history.jsonl')
+    parser.add_argument('--tolerance', type=float, default=1.25, help='slower than this times the last run is a regression')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--fail', action='store_true', help='exit 1 on a regression')
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    history_file = args.history or os.path.join(args.out, 'history.jsonl')
+    history = readHistory(history_file)
+    commit = gitCommit()
+    date = datetime.now().isoformat(timespec='seconds')
+    origin = (260000.0, 6240000.0)
+
+    cases = []
+    for n in args.sizes:
+        ts, aoi = synthFootprints(n, origin, args.crs)
+        for res in args.res:
+            case = 'synthetic-{:g}m-{}'.format(res, n)
+            jparams = benchParams(case, args.out, args.crs, os.path.join(args.out, case, 'dem.tif'), args.workers)
+            #-- the dem covers the extent getOsmArea makes (aoi + 400 m) and a margin
+            minx, miny, maxx, maxy = aoi.total_bounds
+            synthDEM(jparams['in_raster'], [minx - 500, miny - 500, maxx + 500, maxy + 500], res, args.crs)
+            cases.append((case, ts, aoi, jparams))
+        if args.fixture:
+            case = 'fixture-{}-{}'.format(os.path.splitext(os.path.basename(args.fixture))[0], n)
+            ts_f, aoi_f = synthFootprints(n, fixtureOrigin(args.fixture, args.crs, n), args.crs)
+            cases.append((case, ts_f, aoi_f, benchParams(case, args.out, args.crs, args.fixture, args.workers)))
+
+    regressions = 0
+    for case, ts, aoi, jparams in cases:
+        run = runCase(case, ts, aoi, jparams)
+        run.update({'commit': commit, 'date': date, 'python': sys.version.split()[0]})
+        regressions = regressions + len(compareRun(run, history, args.tolerance))
+        with open(history_file, 'a') as f:
+            f.write(json.dumps(run, default=float) + '\n')
+
+    if regressions > 0:
+        print('\n{} stage(s) slower than {}x'.format(regressions, args.tolerance))
+        if args.fail:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
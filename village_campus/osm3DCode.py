@@ -20,7 +20,13 @@
 #    - cityjson community: https://github.com/cityjson
 #########################
 import os
-from itertools import chain
+import shutil
+import time
+import hashlib
+from itertools import chain, islice
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
 
 import requests
 #import overpass
@@ -41,19 +47,20 @@ from shapely.ops import transform
 import fiona
 import copy
 import json
+import tempfile
 #import geojson
 
 import pyproj
 
 from openlocationcode import openlocationcode as olc
 
-from cjio import cityjson
 
 from osgeo import gdal, ogr
 
 import triangle as tr
 
 import matplotlib.pyplot as plt
+import matplotlib.tri as mtri
 
 #import time
 #from datetime import timedelta
@@ -61,31 +68,183 @@ import matplotlib.pyplot as plt
 import warnings
 warnings.filterwarnings('ignore')
 
+@lru_cache(maxsize=None)
+def overpassSession(pool):
+    """
+    one requests.Session for every overpass request ~ keep-alive connections, pool connections per host
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    
+    return session
+
+def overpassFetch(url, query, jparams):
+    """
+    request from overpass ~ with exponential backoff
+    - busy (429, 502, 503, 504), connection errors, timeouts and error remarks are tried again;
+      "osm_retries" (default 4) times, waiting "osm_backoff" (default 2) seconds doubled every attempt
+    - returns the raw response and the parsed json
+    """
+    session = overpassSession(int(jparams.get('osm_workers', 2)))
+    timeout = float(jparams.get('osm_timeout', 90))
+    retries = int(jparams.get('osm_retries', 4))
+    backoff = float(jparams.get('osm_backoff', 2))
+    
+    for attempt in range(retries + 1):
+        wait = backoff * 2 ** attempt
+        try:
+            #-- the server gets [timeout:] to finish; give it some slack to send the response
+            r = session.get(url, params={'data': query}, timeout=timeout + 30)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+        else:
+            if r.status_code in (429, 502, 503, 504):
+                error = 'HTTP {}'.format(r.status_code)
+                if r.headers.get('Retry-After', '').isdigit():
+                    wait = max(wait, int(r.headers['Retry-After']))
+            else:
+                r.raise_for_status()
+                data = r.json()
+                #-- overpass reports timeouts and memory errors in a remark with a 200
+                error = data.get('remark', '')
+                if 'error' not in error:
+                    return r.content, data
+        if attempt == retries:
+            raise RuntimeError('overpass: {} ({} attempts)'.format(error, retries + 1))
+        time.sleep(wait)
+
+def overpassQuery(query, jparams):
+    """
+    run an overpass query ~ through an on-disk response cache
+    - "overpass_url": the overpass instance (default overpass-api.de); a local stand-in works as well
+    - responses are kept in "osm_cache" (default ./data/osm_cache) as the sha256 of url and query;
+      "osm_cache": "False" switches the cache off
+    - "osm_cache_ttl" (hours, default 24): older responses are requested again
+    - "osm_cache_size" (MB, default 500): least recently used responses are removed first
+    - "osm_offline": "True" answers from the cache only ~ expired or not
+    """
+    url = jparams.get('overpass_url', 'http://overpass-api.de/api/interpreter')
+    cache = jparams.get('osm_cache', './data/osm_cache')
+    offline = jparams.get('osm_offline') == 'True'
+    if cache == 'False':
+        if offline:
+            raise RuntimeError('"osm_offline" needs the "osm_cache"')
+        return overpassFetch(url, query, jparams)[1]
+    
+    os.makedirs(cache, exist_ok=True)
+    fname = os.path.join(cache, hashlib.sha256((url + '\n' + query).encode('utf-8')).hexdigest() + '.json')
+    
+    if os.path.exists(fname):
+        age = time.time() - os.path.getmtime(fname)
+        if offline or age < float(jparams.get('osm_cache_ttl', 24)) * 3600:
+            with open(fname, 'rb') as f:
+                content = f.read()
+            #-- last use in atime (lru); mtime stays the time of the request (ttl)
+            os.utime(fname, (time.time(), os.path.getmtime(fname)))
+            return json.loads(content)
+    if offline:
+        raise RuntimeError('"osm_offline": no cached response for this query in {}'.format(cache))
+    
+    content, data = overpassFetch(url, query, jparams)
+    #-- workers (-j) may fetch the same query; each to a file of its own
+    tmp = '{}.{}.tmp'.format(fname, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(content)
+    os.replace(tmp, fname)
+    trimCache(cache, float(jparams.get('osm_cache_size', 500)) * 1024 * 1024, keep=fname)
+    
+    return data
+
+def trimCache(cache, size, keep=None, suffix='.json'):
+    """
+    remove the least recently used entries (responses, dems: files ending in suffix) until the cache is at most size (bytes)
+    - keep: the entry just written stays
+    """
+    entries = []
+    for each in os.scandir(cache):
+        if each.is_file() and each.name.endswith(suffix) and each.path != keep:
+            try:
+                st = each.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_atime, st.st_size, each.path))
+    total = sum(e[1] for e in entries) + (os.path.getsize(keep) if keep else 0)
+    for atime, nbytes, path in sorted(entries):
+        if total <= size:
+            break
+        #-- a sub-query in another thread might have removed it already
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total = total - nbytes
+        
+def osmBounds(jparams):
+    """
+    bounding box (south, west, north, east) of the focus area
+    """
+    query = """
+    [out:json][timeout:25];
+    area[name='{0}'] ->.b;
+    {1}(area.b)[name='{2}'];
+    out bb;
+    """.format(jparams['LargeArea'], jparams['osm_type'], jparams['FocusArea'])
+    
+    bb = [e['bounds'] for e in overpassQuery(query, jparams)['elements'] if 'bounds' in e]
+    if not bb:
+        raise ValueError("overpass: no {} '{}' in '{}'".format(jparams['osm_type'], 
+                                                                jparams['FocusArea'], jparams['LargeArea']))
+    
+    return (min(b['minlat'] for b in bb), min(b['minlon'] for b in bb), 
+            max(b['maxlat'] for b in bb), max(b['maxlon'] for b in bb))
+
+def osmTiles(bounds, size):
+    """
+    split (south, west, north, east) into a grid of bboxes of at most size (degree)
+    """
+    s, w, n, e = bounds
+    rows = max(1, int(np.ceil((n - s) / size)))
+    cols = max(1, int(np.ceil((e - w) / size)))
+    lat = np.linspace(s, n, rows + 1)
+    lon = np.linspace(w, e, cols + 1)
+    
+    return [(lat[i], lon[j], lat[i + 1], lon[j + 1]) for i in range(rows) for j in range(cols)]
+
 def requestOsmBld(jparams):
     """
     request osm for building footprints
+    - the focus area bbox is split into "osm_tile" (degree, default 0.02) sub-queries;
+      requested "osm_workers" (default 2) at a time over one session
+    - ways and relations over more than one bbox are kept once (by osm id)
     """  
     query = """
-    [out:json][timeout:25];
+    [out:json][timeout:{4}];
     area[name='{0}'] ->.b;
     // -- target area ~ can be way or relation
     {1}(area.b)[name='{2}'];
     map_to_area -> .a;
         // I want all buildings ~ with levels tagged
-        (way['building'](area.a);
+        (way['building'](area.a)({3});
         // and relation type=multipolygon ~ to removed courtyards from buildings
-        relation['building']["type"="multipolygon"](area.a);
+        relation['building']["type"="multipolygon"](area.a)({3});
     );
-    out geom 2500;
-    //out body;
-    //>;
-    //out skel qt;
-    """.format(jparams['LargeArea'], jparams['osm_type'], jparams['FocusArea'])
+    out geom;
+    """
+    tiles = osmTiles(osmBounds(jparams), float(jparams.get('osm_tile', 0.02)))
+    queries = [query.format(jparams['LargeArea'], jparams['osm_type'], jparams['FocusArea'],
+                            '{:.7f},{:.7f},{:.7f},{:.7f}'.format(*bb), int(jparams.get('osm_timeout', 90))) 
+               for bb in tiles]
     
-    url = "http://overpass-api.de/api/interpreter"
-    r = requests.get(url, params={'data': query})
-
-    shapes_with_props = osm2geojson.json2shapes(r.json())
+    elements = {}
+    with ThreadPoolExecutor(max_workers=int(jparams.get('osm_workers', 2))) as executor:
+        #-- in order; the first copy of a building over a bbox edge is kept
+        for data in executor.map(lambda q: overpassQuery(q, jparams), queries):
+            for e in data['elements']:
+                elements.setdefault((e['type'], e['id']), e)
+    
+    shapes_with_props = osm2geojson.json2shapes({'elements': list(elements.values())})
 
     geom = [i['shape'] for i in shapes_with_props]
     ts = gpd.GeoDataFrame(shapes_with_props, crs="EPSG:4326", geometry=geom)
@@ -125,9 +284,7 @@ def requestOsmAoi(jparams):
         out geom;
         """.format(jparams['LargeArea'], jparams['osm_type'], jparams['FocusArea'])
     
-    url = "http://overpass-api.de/api/interpreter"
-    r = requests.get(url, params={'data': query})
-    area = osm2geojson.json2shapes(r.json())
+    area = osm2geojson.json2shapes(overpassQuery(query, jparams))
 
     geom = [i['shape'] for i in area]
     aoi = gpd.GeoDataFrame(area, crs="EPSG:4326", geometry=geom)
@@ -141,63 +298,239 @@ def requestOsmAoi(jparams):
         
     return aoi
     
+def demMosaic(jparams):
+    """
+    the source dem ~ the one raster in "in_raster", or a virtual mosaic (VRT) of all of them (whitespace separated)
+    - the mosaic is a small VRT next to "projClip_raster"; no pixels are copied, the tiles are read where and when needed
+    """
+    imgs = jparams['in_raster'].split()
+    if len(imgs) == 1:
+        return imgs[0]
+    
+    fname = os.path.splitext(jparams['projClip_raster'])[0] + '_mosaic.vrt'
+    vrt = gdal.BuildVRT(fname, imgs, srcNodata=jparams['nodata'], VRTNodata=jparams['nodata'])
+    vrt = None
+    
+    return fname
+
 def prepareDEM(extent, jparams):
     """
-    gdal.Warp to reproject and clip raster dem
+    gdal.Warp to (mosaic) reproject and clip raster dem
+    - "projClip_raster" ending in .vrt writes a warped VRT instead of a GeoTIFF; nothing is resampled up front,
+      every (windowed) read reprojects only the cells it asks for from the tiles under it
+    - a clipped dem is kept in "dem_cache" (default ./data/dem_cache) under demKey; the next run with the same
+      source, crs, extent, nodata and resampling copies it from there instead of warping again
+    - "dem_cache_size" (MB, default 2000): least recently used dems are removed first; "dem_cache": "False" switches it off
+    """
+    gdalConfig(jparams)
+    cache = jparams.get('dem_cache', './data/dem_cache')
+    if cache == 'False' or jparams['projClip_raster'].lower().endswith('.vrt'):
+        warpDEM(jparams['projClip_raster'], extent, jparams)
+        return
+    
+    os.makedirs(cache, exist_ok=True)
+    fname = os.path.join(cache, demKey(extent, jparams) + (os.path.splitext(jparams['projClip_raster'])[1] or '.tif'))
+    if not os.path.exists(fname):
+        #-- runs in parallel (batch) may warp the same dem; each to a file of its own
+        tmp = '{}.{}.tmp'.format(fname, os.getpid())
+        warpDEM(tmp, extent, jparams)
+        os.replace(tmp, fname)
+        trimCache(cache, float(jparams.get('dem_cache_size', 2000)) * 1024 * 1024, keep=fname, 
+                  suffix=os.path.splitext(fname)[1])
+    else:
+        print('dem: {} from the cache'.format(jparams['projClip_raster']))
+        os.utime(fname, (time.time(), os.path.getmtime(fname)))
+    tmp = '{}.{}.tmp'.format(jparams['projClip_raster'], os.getpid())
+    shutil.copyfile(fname, tmp)
+    os.replace(tmp, jparams['projClip_raster'])
+
+def demKey(extent, jparams):
+    """
+    the key of a clipped dem ~ sha256 of the source rasters (absolute path, size, mtime), the crs, the extent (to the cm),
+    nodata, resampling and the output profile
+    """
+    sources = []
+    for img in jparams['in_raster'].split():
+        st = os.stat(img)
+        sources.append([os.path.abspath(img), st.st_size, st.st_mtime_ns])
+    key = [sources, jparams['crs'], [round(float(e), 2) for e in extent], str(jparams['nodata']), demResampling(jparams), 
+           demProfile(jparams)]
+    
+    return hashlib.sha256(json.dumps(key).encode('utf-8')).hexdigest()
+
+def demProfile(jparams):
+    #-- "dem_cog": "True" ~ the creation options of a Cloud-Optimized GeoTIFF; None for a plain GeoTIFF
+    #-- what shapes the file only (part of demKey); the threads to write it are set in warpDEM
+    if jparams.get('dem_cog') != 'True':
+        return None
+    return ['COMPRESS=' + jparams.get('dem_compress', 'DEFLATE'), 'PREDICTOR=YES', 'BLOCKSIZE=512', 
+            'OVERVIEWS=AUTO', 'BIGTIFF=IF_SAFER']
+
+def gdalConfig(jparams):
+    """
+    gdal settings for the warp and every read after it
+    - "gdal_cachemax" (MB): the raster block cache (gdal default: 5% of the memory)
+    - "gdal_threads" (default ALL_CPUS): threads to warp and compress
+    """
+    if jparams.get('gdal_cachemax'):
+        gdal.SetCacheMax(int(float(jparams['gdal_cachemax']) * 1024 * 1024))
+    gdal.SetConfigOption('GDAL_NUM_THREADS', str(jparams.get('gdal_threads', 'ALL_CPUS')))
+
+def demResampling(jparams):
+    #-- "dem_resampling": any gdal.Warp resampleAlg; default bilinear to mosaic, nearest for one raster
+    return jparams.get('dem_resampling', 'bilinear' if len(jparams['in_raster'].split()) > 1 else 'near')
+
+def warpDEM(fout, extent, jparams):
+    """
+    gdal.Warp to (mosaic) reproject and clip raster dem to fout
+    - "dem_cog": "True" writes a Cloud-Optimized GeoTIFF: tiled (512), compressed ("dem_compress": DEFLATE (default),
+      ZSTD, LZW, ... with a predictor) with internal overviews; the warp is a VRT in memory the COG driver copies out
     """
     #ds = gdal.Open(jparams['in_raster'])
     #prj = ds.GetProjection()
     
     gdal.SetConfigOption("GTIFF_SRS_SOURCE", "GEOKEYS")
     
-    OutTile = gdal.Warp(jparams['projClip_raster'], 
-                        jparams['in_raster'], 
+    vrt = fout.lower().endswith('.vrt')
+    cog = demProfile(jparams) if not vrt else None
+    OutTile = gdal.Warp('' if cog else fout, 
+                        demMosaic(jparams), 
                         #srcSRS=prj,
+                        resampleAlg=demResampling(jparams),
+                        multithread=True,
                         dstSRS=jparams['crs'],
                         srcNodata = jparams['nodata'],
                         #dstNodata = 60,
                          #-- outputBounds=[minX, minY, maxX, maxY]
                         outputBounds = [extent[0], extent[1],
-                                        extent[2], extent[3]])
+                                        extent[2], extent[3]], 
+                        format='VRT' if (vrt or cog) else 'GTiff')
+    if cog:
+        Cog = gdal.Translate(fout, OutTile, format='COG', 
+                             creationOptions=cog + ['NUM_THREADS=' + str(jparams.get('gdal_threads', 'ALL_CPUS'))])
+        Cog = None
     OutTile = None 
       
 def createXYZ(fout, fin):
     """
     read raster and extract an xyz
+    ~ debug export only; the terrain points come from rasterXYZ
     """
     xyz = gdal.Translate(fout,
                          fin,
                          format = 'XYZ')
     xyz = None
     
-def rasterQuery(geom, gt_forward, rb):
+def rasterQuery(mx, my, gt_forward, rb, interpolate='nearest', nodata=None):
+    """
+    sample the raster at many points in one pass
+    - the window covering every point is read once and indexed with numpy
+    - 'nearest' returns the value of the cell containing the point;
+      'bilinear' interpolates between cell centres (as rasterstats.point_query)
+      and, like it, falls back to the nearest cell next to nodata
+    - rb can be a gdal band or a numpy array of the band
+    """
+    mx = np.asarray(mx, dtype='float64')
+    my = np.asarray(my, dtype='float64')
+    if mx.size == 0:
+        return np.empty(0, dtype='float64')
+    if nodata is None and hasattr(rb, 'GetNoDataValue'):
+        nodata = rb.GetNoDataValue()
+    if hasattr(rb, 'ReadAsArray'):
+        xsize, ysize = rb.XSize, rb.YSize
+    else:
+        ysize, xsize = rb.shape
     
-    mx = geom.representative_point().x
-    my = geom.representative_point().y
+    fx = (mx - gt_forward[0]) / gt_forward[1]
+    fy = (my - gt_forward[3]) / gt_forward[5]
     
-    px = int((mx - gt_forward[0]) / gt_forward[1])
-    py = int((my - gt_forward[3]) / gt_forward[5])
-
-    intval = rb.ReadAsArray(px, py, 1, 1)
+    if interpolate == 'bilinear':
+        #-- upper-left cell of the 2x2 window around the point and the offset to its centre
+        px = np.floor(fx - 0.5).astype('int64')
+        py = np.floor(fy - 0.5).astype('int64')
+        dx = fx - 0.5 - px
+        dy = fy - 0.5 - py
+        cols = np.clip(np.stack([px, px + 1, px, px + 1]), 0, xsize - 1)
+        rows = np.clip(np.stack([py, py, py + 1, py + 1]), 0, ysize - 1)
+    else:
+        cols = np.clip(fx.astype('int64'), 0, xsize - 1)[np.newaxis]
+        rows = np.clip(fy.astype('int64'), 0, ysize - 1)[np.newaxis]
     
-    return intval[0][0]
+    #-- one read of the block that holds every cell we need
+    xoff, yoff = int(cols.min()), int(rows.min())
+    win_x, win_y = int(cols.max()) - xoff + 1, int(rows.max()) - yoff + 1
+    if hasattr(rb, 'ReadAsArray'):
+        block = rb.ReadAsArray(xoff, yoff, win_x, win_y)
+    else:
+        block = rb[yoff:yoff + win_y, xoff:xoff + win_x]
+    vals = block[rows - yoff, cols - xoff].astype('float64')
     
-def mtPlot02(blds, jparams):
-    "highlight crossing rds and blds --topological errors"
+    if interpolate != 'bilinear':
+        return vals[0]
+    
+    ul, ur, ll, lr = vals
+    z = (ul * (1 - dx) * (1 - dy) + ur * dx * (1 - dy) + 
+         ll * (1 - dx) * dy + lr * dx * dy)
+    if nodata is not None:
+        #-- fall back to the nearest cell where the window touches nodata
+        invalid = (vals == nodata).any(axis=0)
+        near = vals[np.round(dy).astype('int64') * 2 + np.round(dx).astype('int64'), 
+                    np.arange(mx.size)]
+        z[invalid] = near[invalid]
+        z[invalid & (near == nodata)] = np.nan
     
-    blds_copy = blds.copy()
+    return z
 
-    new_df1 = blds_copy.loc[blds_copy.overlaps(blds_copy.unary_union)].reset_index(drop=True)  
+def ringsQuery(rings, gt_forward, rb, interpolate='nearest'):
+    """
+    sample the raster at the vertices of many rings in one pass
+    - returns one z array per ring
+    """
+    if len(rings) == 0:
+        return []
+    xy = np.concatenate([np.asarray(r, dtype='float64')[:, :2] for r in rings])
+    z = rasterQuery(xy[:, 0], xy[:, 1], gt_forward, rb, interpolate)
+    
+    return np.split(z, np.cumsum([len(r) for r in rings])[:-1])
     
-    fig, ax = plt.subplots(figsize=(11, 11))
+def topologyErrors(blds):
+    """
+    the footprints whose interior crosses that of another footprint ~ sharing a wall is fine
+    - bridges and rooves (building=bridge / roof) stand over other footprints by design; they are left out
+    """
+    geoms = blds.geometry.values
+    sidx = blds.sindex
+    if 'bld' in blds.columns:
+        over = blds['bld'].isin(['bridge', 'roof']).values
+    else:
+        over = np.zeros(len(blds), dtype=bool)
+    bad = set()
+    for i, geom in enumerate(geoms):
+        if over[i]:
+            continue
+        for k in sidx.intersection(geom.bounds):
+            if k > i and not over[k] and geom.relate_pattern(geoms[k], '2********'):
+                bad.update((i, int(k)))
     
-    blds.plot(ax=ax, facecolor='none', edgecolor='purple', alpha=0.2)
-    if len(new_df1) > 0:
-        new_df1.plot(ax=ax, edgecolor='red', facecolor='none')
+    return sorted(bad)
+
+def mtPlot02(blds, jparams):
+    """
+    highlight crossing rds and blds --topological errors
+    - "topology_plot": "True" saves the figure to ./data/topologyFig.png
+    """
+    new_df1 = blds.iloc[topologyErrors(blds)].reset_index(drop=True)
     
-    p = './data/topologyFig.png'
-    plt.savefig(p, dpi=300)
-    plt.show()
+    if jparams.get('topology_plot') == 'True':
+        fig, ax = plt.subplots(figsize=(11, 11))
+        
+        blds.plot(ax=ax, facecolor='none', edgecolor='purple', alpha=0.2)
+        if len(new_df1) > 0:
+            new_df1.plot(ax=ax, edgecolor='red', facecolor='none')
+        
+        p = './data/topologyFig.png'
+        plt.savefig(p, dpi=300)
+        plt.close(fig)
     
     return new_df1
      
@@ -208,153 +541,254 @@ def assignZ(ts, gt_forward, rb):
     """
     ts.drop(ts.index[ts['type'] == 'node'], inplace = True)
     
-    ts['mean'] = ts.apply(lambda row : rasterQuery(row.geometry, gt_forward, rb), axis = 1)
+    rp = ts.representative_point()
+    ts['mean'] = rasterQuery(rp.x, rp.y, gt_forward, rb)
         
     return ts
     
+def fpShape(geom):
+    """
+    a footprint as a Polygon
+    ~ LineStrings are closed; of a MultiPolygon the last polygon is kept
+    """
+    if geom.geom_type == 'LineString':
+        return Polygon(geom)
+    if geom.geom_type == 'MultiPolygon':
+        return Polygon(list(geom.geoms)[-1])
+    
+    return geom
+
+@lru_cache(maxsize=None)
+def utmToWgs84(crs):
+    """
+    one pyproj Transformer per crs ~ built once and reused
+    """
+    return pyproj.Transformer.from_crs(pyproj.CRS(crs), pyproj.CRS('EPSG:4326'), always_xy=True)
+
+def plusCodes(geoms, crs):
+    """
+    google plus_code (11 characters) at the representative_point() of each geometry
+    - all points are reprojected in one array call
+    """
+    rp = gpd.GeoSeries(list(geoms), crs=crs).representative_point()
+    lon, lat = utmToWgs84(crs).transform(rp.x.values, rp.y.values)
+    
+    return [olc.encode(y, x, 11) for x, y in zip(lon, lat)]
+
+def pyRound(s, dps=2):
+    """
+    round a column as round() does ~ numpy (Series.round) scales by 10**dps first and can take a .xx5 the other way
+    """
+    return s.map(lambda v: v if pd.isna(v) else round(float(v), dps))
+
 def writegjson(ts, jparams):
     """
     read the building gpd and create new attributes in osm vector
     ~ ground height, relative building height and roof height.
     write the result to .geojson
+    - attributes are computed as columns and written in one go
     """
     #-- take care of non-Polygon LineString's 
-    for i, row in ts.iterrows():
-        if row.geometry.geom_type == 'LineString' and len(row.geometry.coords) < 3:
-            ts = ts.drop(ts.index[i])
+    short = ts.geometry.apply(lambda g: g.geom_type == 'LineString' and len(g.coords) < 3)
+    ts = ts.loc[~short]
+    
+    #-- at a minimum we only want building:levels tagged
+    keep = (ts['type'] != 'node') & ts['tags'].apply(lambda t: t is not None and 'building:levels' in t)
+    ts = ts.loc[keep]
     
     storeyheight = 2.8
-    #-- iterate through the list of buildings and create GeoJSON features rich in attributes
-    footprints = {
-        "type": "FeatureCollection",
-        "features": []
-        }
+    adr_tags = ['addr:flats', 'addr:housenumber', 'addr:housename', 'addr:street', 
+                'addr:suburb', 'addr:postcode', 'addr:city', 'addr:province']
     
-    for i, row in ts.iterrows():
-        f = {
-        "type" : "Feature"
-        }
-        #-- at a minimum we only want building:levels tagged
-        if row['type'] != 'node' and row['tags'] != None and 'building:levels' in row['tags']:
+    #-- one column per osm tag
+    tags = pd.DataFrame(list(ts['tags']), index=ts.index)
+    bridge = ts['bld'] == 'bridge'
+    roof = ts['bld'] == 'roof'
+    other = ~(bridge | roof)
     
-            f["properties"] = {}
-            
-            #-- store all OSM attributes and prefix them with osm_ 
-            f["properties"]["osm_id"] = row.id
-            for p in row.tags:
-                #-- store OSM attributes and prefix them with osm_
-                f["properties"]["osm_%s" % p] = row.tags[p]
-                #-- we dont want addresses on bridges and rooves
-                if row['bld'] != 'bridge' and row['bld'] != 'roof':
-                    adr = []
-                    #-- transform the OSM address to string prefix with osm_
-                    if 'addr:flats'in row.tags:
-                        adr.append(row.tags['addr:flats'])
-                    if 'addr:housenumber'in row.tags:
-                        adr.append(row.tags['addr:housenumber'])
-                    if 'addr:housename'in row.tags:
-                        adr.append(row.tags['addr:housename'])
-                    if 'addr:street' in row.tags:
-                        adr.append(row.tags['addr:street'])
-                    if 'addr:suburb' in row.tags:
-                        adr.append(row.tags['addr:suburb'])
-                    if 'addr:postcode' in row.tags:
-                        adr.append(row.tags['addr:postcode'])
-                    if 'addr:city' in row.tags:
-                        adr.append(row.tags['addr:city'])
-                    if 'addr:province' in row.tags:
-                        adr.append(row.tags['addr:province'])
-    
-                f["properties"]["osm_address"] = " ".join(adr)
-            
-            osm_shape = shape(row["geometry"])
-            #-- a few buildings are not polygons, rather linestrings. This converts them to polygons
-            #-- rare, but if not done it breaks the code later
-            if osm_shape.geom_type == 'LineString':
-                osm_shape = Polygon(osm_shape)
-            #-- and multipolygons must be accounted for
-            elif osm_shape.geom_type == 'MultiPolygon':
-                polys = list(osm_shape.geoms) 
-                for poly in polys:
-                    osm_shape = Polygon(poly)#[0])
-            
-            f["geometry"] = mapping(osm_shape)
-            f["properties"]["footprint"] = mapping(osm_shape)
-            
-            #-- google plus_code
-            wgs84 = pyproj.CRS('EPSG:4326')
-            utm = pyproj.CRS(jparams['crs'])
-            p = osm_shape.representative_point()
-            project = pyproj.Transformer.from_crs(utm, wgs84, always_xy=True).transform
-            wgs_point = transform(project, p)
-            f["properties"]["plus_code"] = olc.encode(wgs_point.y, wgs_point.x, 11)
-            
-            if row['bld'] == 'bridge':
-                f["properties"]['ground_height'] = round(row["mean"], 2)
-            #print('id: ', f["properties"]["osm_id"], row.tags['building:levels'])
-                if row['tags']['min_height'] != None:
-                    f["properties"]['bottom_bridge_height'] = round(float(row.tags['min_height']) + row["mean"], 2)
-                else:
-                    f["properties"]['bottom_bridge_height'] = round((float(row.tags['building:min_level']) * storeyheight) + row["mean"], 2)
-                f["properties"]['building_height'] = round(float(row.tags['building:levels']) * storeyheight, 2)
-                f["properties"]['roof_height'] = round(f["properties"]['building_height'] + row["mean"], 2)
-            if row['bld'] == 'roof':
-                f["properties"]['ground_height'] = round(row["mean"], 2)
-                f["properties"]['bottom_roof_height'] = round(float(row.tags['building:levels']) * storeyheight + row["mean"], 2) 
-                f["properties"]['roof_height'] = round(f["properties"]['bottom_roof_height'] + 1.5, 2)
-            if row['bld'] != 'bridge' and row['bld'] != 'roof':
-                f["properties"]['ground_height'] = round(row["mean"], 2)
-                f["properties"]['building_height'] = round(float(row.tags['building:levels']) * storeyheight + 1.3, 2) 
-                f["properties"]['roof_height'] = round(f["properties"]['building_height'] + row["mean"], 2)
-                   
-                f["properties"]['ground_height'] = round(row["mean"], 2)
-                f["properties"]['building_height'] = round(float(row.tags['building:levels']) * storeyheight + 1.3, 2) 
-                f["properties"]['roof_height'] = round(f["properties"]['building_height'] + row["mean"], 2)
-            
-            footprints['features'].append(f)
-            
-    for value in footprints['features']:
-        if 'osm_addr:flats' in value["properties"]:
-            del value["properties"]["osm_addr:flats"]
-        if 'osm_addr:housenumber' in value["properties"]:
-            del value["properties"]["osm_addr:housenumber"]
-        if 'osm_addr:housename' in value["properties"]:
-            del value["properties"]["osm_addr:housename"]
-        if 'osm_addr:street' in value["properties"]:
-            del value["properties"]["osm_addr:street"]
-        if 'osm_addr:suburb' in value["properties"]:
-            del value["properties"]["osm_addr:suburb"]
-        if 'osm_addr:postcode' in value["properties"]:
-            del value["properties"]["osm_addr:postcode"]
-        if 'osm_addr:city' in value["properties"]:
-            del value["properties"]["osm_addr:city"]
-        if 'osm_addr:province' in value["properties"]:
-            del value["properties"]["osm_addr:province"]
-                
-    #-- store the data as GeoJSON
+    #-- store all OSM attributes and prefix them with osm_ ~ the address components become osm_address
+    props = tags.drop(columns=[a for a in adr_tags if a in tags.columns]).add_prefix('osm_')
+    props.insert(0, 'osm_id', ts['id'])
+    
+    #-- transform the OSM address to string: housenumber street suburb postalcode city province
+    adr = pd.Series('', index=ts.index, dtype=object)
+    parts = pd.Series(0, index=ts.index)
+    for a in adr_tags:
+        if a in tags.columns:
+            has = tags[a].notna()
+            sep = np.where(parts[has] > 0, ' ', '')
+            adr[has] = adr[has] + sep + tags.loc[has, a].astype(str)
+            parts[has] += 1
+    #-- we dont want addresses on bridges and rooves
+    props['osm_address'] = adr.where(other)
+    
+    #-- a few buildings are not polygons, rather linestrings. This converts them to polygons
+    #-- rare, but if not done it breaks the code later; and multipolygons must be accounted for
+    osm_shape = ts.geometry.apply(fpShape)
+    props['footprint'] = osm_shape.apply(mapping)
+    
+    #-- google plus_code ~ for all buildings at once
+    props['plus_code'] = plusCodes(osm_shape, jparams['crs'])
+    
+    #-- heights
+    mean = ts['mean'].astype('float64')
+    levels = pd.to_numeric(tags['building:levels'])
+    nan = pd.Series(np.nan, index=ts.index)
+    
+    props['ground_height'] = pyRound(mean)
+    if bridge.any():
+        min_height = pd.to_numeric(tags.get('min_height', nan))
+        min_level = pd.to_numeric(tags.get('building:min_level', nan))
+        bottom = (min_height + mean).where(min_height.notna(), min_level * storeyheight + mean)
+        props['bottom_bridge_height'] = pyRound(bottom).where(bridge)
+    bottom_roof = pyRound(levels * storeyheight + mean)
+    if roof.any():
+        props['bottom_roof_height'] = bottom_roof.where(roof)
+    building_height = pyRound(levels * storeyheight + 1.3)
+    building_height[bridge] = pyRound(levels * storeyheight)
+    props['building_height'] = building_height.where(~roof)
+    props['roof_height'] = pyRound(building_height + mean).where(~roof, pyRound(bottom_roof + 1.5))
+    
+    #-- store the data as GeoJSON ~ missing attributes are left out of each feature
+    footprints = gpd.GeoDataFrame(props, geometry=list(osm_shape))
     with open(jparams['osm_bldings'], 'w') as outfile:
-        json.dump(footprints, outfile)
+        outfile.write(footprints.to_json(na='drop', drop_id=True))
+
+def rasterXYZ(fin):
+    """
+    x, y (cell centre) and z of every raster cell
+    - straight from the geotransform and the band; no .xyz text round trip
+    """
+    src_ds = gdal.Open(fin)
+    gt = src_ds.GetGeoTransform()
+    z = src_ds.GetRasterBand(1).ReadAsArray()
+    src_ds = None
+    
+    cols = np.arange(z.shape[1]) + 0.5
+    rows = np.arange(z.shape[0])[:, np.newaxis] + 0.5
+    x = gt[0] + cols * gt[1] + rows * gt[2]
+    y = gt[3] + cols * gt[4] + rows * gt[5]
+    
+    return x, y, z
 
-def getXYZ(dis, aoi, jparams):
+def rasterMask(aoi, dis, fin):
     """
-    read xyz to gdf
+    burn the aoi and then the footprints into a grid aligned to the raster dem
+    - True where the cell centre is inside the aoi and outside every footprint
     """
-    df = pd.read_csv(jparams['xyz'], 
-                     delimiter = ' ', header=None,
-                     names=["x", "y", "z"])
+    src_ds = gdal.Open(fin)
+    mem_ds = gdal.GetDriverByName('MEM').Create('', src_ds.RasterXSize, src_ds.RasterYSize, 1, gdal.GDT_Byte)
+    mem_ds.SetGeoTransform(src_ds.GetGeoTransform())
+    mem_ds.SetProjection(src_ds.GetProjection())
+    src_ds = None
+    
+    ogr_ds = ogr.GetDriverByName('Memory').CreateDataSource('')
+    for name, geoms, burn in [('aoi', [aoi.geometry.iloc[0]], 1), ('footprints', list(dis.geometry), 0)]:
+        lyr = ogr_ds.CreateLayer(name, geom_type=ogr.wkbUnknown)
+        for geom in geoms:
+            feat = ogr.Feature(lyr.GetLayerDefn())
+            feat.SetGeometry(ogr.CreateGeometryFromWkb(bytes(geom.wkb)))
+            lyr.CreateFeature(feat)
+            feat = None
+        #-- default rasterize burns the cells whose centre is inside the polygon
+        gdal.RasterizeLayer(mem_ds, [1], lyr, burn_values=[burn])
     
-    geometry = [Point(xy) for xy in zip(df.x, df.y)]
-    #df = df.drop(['Lon', 'Lat'], axis=1)
-    gdf = gpd.GeoDataFrame(df, crs=jparams['crs'], geometry=geometry)
+    mask = mem_ds.GetRasterBand(1).ReadAsArray().astype(bool)
+    ogr_ds = None
+    mem_ds = None
+    
+    return mask
+
+class TerrainMesh:
+    """
+    the triangulation input in preallocated arrays ~ vertices (x, y, z) float64, segments int32, holes (x, y, z) float64
+    - every stage appends into it in place; the sizes given up front are room reserved for what comes later,
+      an array short of room grows by what is asked on top of the room it had (at least double)
+    - vertices, segments, holes: views of the part filled so far; Triangle, the CityJSON writer and pvPlot read them as they are
+    """
+    def __init__(self, vertices=0, segments=0, holes=0):
+        self._v = np.empty((vertices, 3), dtype='float64')
+        self._s = np.empty((segments, 2), dtype='int32')
+        self._h = np.empty((holes, 3), dtype='float64')
+        self.nv = self.ns = self.nh = 0
+    
+    @staticmethod
+    def _room(a, used, n):
+        if used + n <= len(a):
+            return a
+        b = np.empty((len(a) + max(n, len(a)), a.shape[1]), dtype=a.dtype)
+        b[:used] = a[:used]
+        return b
+    
+    def newVertices(self, n):
+        #-- the next n rows to fill in place ~ returns the index of the first and the (n, 3) view
+        self._v = self._room(self._v, self.nv, n)
+        start = self.nv
+        self.nv += n
+        return start, self._v[start:self.nv]
+    
+    def addVertices(self, xyz):
+        xyz = np.asarray(xyz, dtype='float64').reshape(-1, 3)
+        start, v = self.newVertices(len(xyz))
+        v[:] = xyz
+        return start
+    
+    def addSegments(self, idx, offset=0):
+        idx = np.asarray(idx, dtype='int32').reshape(-1, 2)
+        self._s = self._room(self._s, self.ns, len(idx))
+        np.add(idx, offset, out=self._s[self.ns:self.ns + len(idx)])
+        self.ns += len(idx)
+        return self._s[self.ns - len(idx):self.ns]
+    
+    def addHoles(self, xyz):
+        xyz = np.asarray(xyz, dtype='float64').reshape(-1, 3)
+        self._h = self._room(self._h, self.nh, len(xyz))
+        self._h[self.nh:self.nh + len(xyz)] = xyz
+        self.nh += len(xyz)
+    
+    def keepVertices(self, keep, start=0):
+        #-- drop the vertices from start on where keep is False ~ in place; the segments follow the vertices left
+        sel = np.concatenate([np.arange(start), start + np.flatnonzero(keep), np.arange(start + len(keep), self.nv)])
+        remap = np.full(self.nv, -1, dtype='int32')
+        remap[sel] = np.arange(len(sel), dtype='int32')
+        self._v[:len(sel)] = self._v[sel]
+        self.nv = len(sel)
+        self._s[:self.ns] = remap[self._s[:self.ns]]
+    
+    @property
+    def vertices(self):
+        return self._v[:self.nv]
+    
+    @property
+    def segments(self):
+        return self._s[:self.ns]
+    
+    @property
+    def holes(self):
+        return self._h[:self.nh]
+
+def getXYZ(dis, aoi, jparams, mesh):
+    """
+    append the terrain points of the raster dem to the mesh (TerrainMesh) ~ returns how many
+    - "terrain_filter": "raster" (default) keeps the cells through a burnt aoi/footprint mask;
+      "vector" tests every point against the aoi - footprints symmetric difference
+    """
+    x, y, z = rasterXYZ(jparams['projClip_raster'])
+    _valid = z != jparams['nodata']
+    if jparams.get('terrain_filter', 'raster') == 'vector':
+        _symdiff = gpd.overlay(aoi, dis, how='symmetric_difference')
+        _valid[_valid] = gpd.GeoSeries(gpd.points_from_xy(x[_valid], y[_valid])).within(_symdiff.loc[0, 'geometry']).values
+    else:
+        _valid &= rasterMask(aoi, dis, jparams['projClip_raster'])
     
-    _symdiff = gpd.overlay(aoi, dis, how='symmetric_difference')
-    _mask = gdf.within(_symdiff.loc[0, 'geometry'])
-    gdf = gdf.loc[_mask]
-    gdf = gdf[gdf['z'] != jparams['nodata']]
-    gdf = gdf.round(2)
-    gdf.reset_index(drop=True, inplace=True)
+    #-- straight into the mesh; no DataFrame / Point geometry in between
+    n = int(_valid.sum())
+    start, v = mesh.newVertices(n)
+    for i, a in enumerate((x, y, z)):
+        v[:, i] = a[_valid]
+    np.round(v, 2, out=v)
     
-    return gdf
+    return n
 
 def getOsmBld(jparams):
     """
@@ -364,27 +798,7 @@ def getOsmBld(jparams):
     dis = gpd.read_file(jparams['osm_bldings'])
     dis.set_crs(epsg=int(jparams['crs'][-5:]), inplace=True, allow_override=True)
     
-    dict_vertices = {}
-    cols = [c for c in ['bottom_bridge_height', 'bottom_roof_height', 'roof_height'] if c in dis.columns]
-    
-    for i, row in dis.iterrows():
-        oring = list(row.geometry.exterior.coords)
-        if row.geometry.exterior.is_ccw == False:
-            oring.reverse()
-        #name = row['osm_id']
-        for (j, v) in enumerate(oring[:-1]):
-            vertex = (oring[j][0], oring[j][1])
-            attr = [row[c] for c in cols]
-            attr = [x for x in attr if not np.isnan(x)]  # Remove np.nan values
-            if vertex in dict_vertices.keys():
-                dict_vertices[vertex][row['osm_id']] = attr
-            else:
-                dict_vertices[vertex] = {row['osm_id']: attr}
-    
-    result = {}
-    for k1, d in dict_vertices.items():
-        for k2 in d:
-            result.setdefault(k2, {})[k1] = sorted(list(set([j for i in d.values() for j in i])))
+    result = heightStacks(dis)
     
 # =============================================================================
 #     ##-- the topojson simplify from the very first function (line 98) does this; but lets keep it for now
@@ -408,6 +822,40 @@ def getOsmBld(jparams):
     
     return dis, hs, result
 
+def heightStacks(dis):
+    """
+    the heights at every exterior vertex of every footprint ~ {osm_id: {(x, y): [heights]}}
+    - a vertex shared by footprints gets the (sorted, unique) bottom_bridge / bottom_roof / roof heights of all of them
+    - vertices in the order of the (counter-clockwise) ring; bldFootprints reads them that way
+    - one array of all vertices grouped by coordinate; no per vertex dictionaries
+    """
+    cols = [c for c in ['bottom_bridge_height', 'bottom_roof_height', 'roof_height'] if c in dis.columns]
+    
+    rings = []
+    for geom in dis.geometry:
+        oring = np.asarray(geom.exterior.coords)[:-1, :2]
+        rings.append(oring if geom.exterior.is_ccw else oring[::-1])
+    n = [len(r) for r in rings]
+    xy = np.concatenate(rings) if len(rings) > 0 else np.empty((0, 2))
+    oid = np.repeat(dis['osm_id'].values, n).tolist()
+    codes, uniques = pd.MultiIndex.from_arrays([xy[:, 0], xy[:, 1]]).factorize()
+    
+    #-- every (vertex, height) once ~ sorted per vertex
+    h = dis[cols].to_numpy(dtype='float64')
+    long = pd.DataFrame({'v': np.repeat(codes, len(cols)), 'h': np.repeat(h, n, axis=0).ravel()})
+    long = long.dropna().drop_duplicates().sort_values(['v', 'h'])
+    v = long['v'].to_numpy()
+    cut = np.flatnonzero(np.diff(v)) + 1
+    stacks = [[] for k in range(len(uniques))]
+    for k, hs in zip(v[np.r_[0, cut]].tolist() if len(v) > 0 else [], np.split(long['h'].to_numpy(), cut)):
+        stacks[k] = hs.tolist()
+    
+    result = {}
+    for k, vertex, c in zip(oid, zip(xy[:, 0].tolist(), xy[:, 1].tolist()), codes.tolist()):
+        result.setdefault(k, {})[vertex] = list(stacks[c])
+    
+    return result
+
 def getOsmArea(aoi, outFile, b_type, crs):
     """
     read osm area to gdf and buffer
@@ -445,21 +893,25 @@ def getBldVertices(dis, gt_forward, rb): #
     dps = 3
     segs = set()
     
+    #-- gather every ring first so the dem is sampled once for all vertices
+    rings = []
+    exterior = []
     for ids, row in dis.iterrows():
-        oring = list(row.geometry.exterior.coords)
-        coords_rounded = [(round(x, dps), round(y, dps), round(float(rasterQuery2(x, y, gt_forward, rb)), 2)) for x, y in oring]
+        rings.append(list(row.geometry.exterior.coords))
+        exterior.append(True)
+        for interior in row.geometry.interiors:
+            rings.append(list(interior.coords))
+            exterior.append(False)
+    zs = ringsQuery(rings, gt_forward, rb)
+    
+    for oring, z, ext in zip(rings, zs, exterior):
+        coords_rounded = [(round(x, dps), round(y, dps), round(float(v), 2)) for (x, y), v in zip(oring, z)]
         all_coords.extend(coords_rounded)
-        zbld = [z for x, y, z in coords_rounded]
-        min_zbld.append(min(zbld))
+        if ext:
+            zbld = [z for x, y, z in coords_rounded]
+            min_zbld.append(min(zbld))
         
         segs.update({(x1, y1, x2, y2) if (x1 < x2) else (x2, y2, x1, y1) for (x1, y1, z1), (x2, y2, z2) in zip(coords_rounded[:-1], coords_rounded[1:])})
-        
-        for interior in row.geometry.interiors:
-            oring = list(interior.coords)
-            coords_rounded = [(round(x, dps), round(y, dps), round(float(rasterQuery2(x, y, gt_forward, rb)), 2)) for x, y in oring]
-            all_coords.extend(coords_rounded)
-            
-            segs.update({(x1, y1, x2, y2) if (x1 < x2) else (x2, y2, x1, y1) for (x1, y1, z1), (x2, y2, z2) in zip(coords_rounded[:-1], coords_rounded[1:])})
     
     c = pd.DataFrame.from_dict({"coords": list(segs)}).groupby("coords").size().reset_index(name="count")
     
@@ -468,15 +920,6 @@ def getBldVertices(dis, gt_forward, rb): #
         
     return ac, c, min_zbld
 
-def rasterQuery2(mx, my, gt_forward, rb):
-    
-    px = int((mx - gt_forward[0]) / gt_forward[1])
-    py = int((my - gt_forward[3]) / gt_forward[5])
-
-    intval = rb.ReadAsArray(px, py, 1, 1)
-
-    return intval[0][0]
-
 def getAOIVertices(aoi, gt_forward, rb): 
     """
     retrieve vertices from aoi ~ without duplicates 
@@ -486,19 +929,17 @@ def getAOIVertices(aoi, gt_forward, rb):
     dps = 3
     segs = set()
     
+    rings = []
     for ids, row in aoi.iterrows():
-        oring = list(row.geometry.exterior.coords)
-        coords_rounded = [(round(x, dps), round(y, dps), round(float(rasterQuery2(x, y, gt_forward, rb)), 2)) for x, y in oring]
+        rings.append(list(row.geometry.exterior.coords))
+        rings.extend(list(interior.coords) for interior in row.geometry.interiors)
+    zs = ringsQuery(rings, gt_forward, rb)
+    
+    for oring, z in zip(rings, zs):
+        coords_rounded = [(round(x, dps), round(y, dps), round(float(v), 2)) for (x, y), v in zip(oring, z)]
         aoi_coords.extend(coords_rounded)
         
         segs.update({(x1, y1, x2, y2) if (x1 < x2) else (x2, y2, x1, y1) for (x1, y1, z1), (x2, y2, z2) in zip(coords_rounded[:-1], coords_rounded[1:])})
-        
-        for interior in row.geometry.interiors:
-            oring = list(interior.coords)
-            coords_rounded = [(round(x, dps), round(y, dps), round(float(rasterQuery2(x, y, gt_forward, rb)), 2)) for x, y in oring]
-            aoi_coords.extend(coords_rounded)
-            
-            segs.update({(x1, y1, x2, y2) if (x1 < x2) else (x2, y2, x1, y1) for (x1, y1, z1), (x2, y2, z2) in zip(coords_rounded[:-1], coords_rounded[1:])})
     
     ca = pd.DataFrame.from_dict({"coords": list(segs)}).groupby("coords").size().reset_index(name="count")
     
@@ -507,44 +948,43 @@ def getAOIVertices(aoi, gt_forward, rb):
     
     return acoi, ca
 
-def concatCoords(gdf, ac):
-    df2 = pd.concat([gdf, ac])
+def createSgmts(ac, c, mesh):
+    """
+    append the vertices of ac and the segments between them to the mesh
+    - returns the segments added: indices of vertices [from, to]
+    """
+    start = mesh.addVertices(ac[['x', 'y', 'z']].values)
     
-    return df2
+    return mesh.addSegments(sgmtIndex(ac, c), start)
 
-def createSgmts(ac, c, gdf, idx):
+def sgmtIndex(ac, c):
     """
-    create a segment list for Triangle
-    - indices of vertices [from, to]
+    look up the [from, to] vertex indices of every segment in one pass
+    - (x, y) of the vertices are hashed once; no scan of ac per segment
     """
+    sg = np.array(c['coords'].tolist(), dtype='float64').reshape(-1, 4)
     
-    l = len(gdf) #- 1
-    lr = 0
-    idx01 = []
-    
-    for i, row in c.iterrows():
-        frx, fry = row.coords[0], row.coords[1]
-        tox, toy = row.coords[2], row.coords[3]
-
-        [index_f] = (ac[(ac['x'] == frx) & (ac['y'] == fry)].index.values)
-        [index_t] = (ac[(ac['x'] == tox) & (ac['y'] == toy)].index.values)
-        idx.append([l + index_f, l + index_t])
-        idx01.append([lr + index_f, lr + index_t])
+    key = pd.MultiIndex.from_arrays([ac['x'].values, ac['y'].values])
+    index_f = key.get_indexer(pd.MultiIndex.from_arrays([sg[:, 0], sg[:, 1]]))
+    index_t = key.get_indexer(pd.MultiIndex.from_arrays([sg[:, 2], sg[:, 3]]))
+    if (index_f == -1).any() or (index_t == -1).any():
+        raise ValueError("segment end point not found among the vertices")
     
-    return idx, idx01
+    return np.stack([ac.index.values[index_f], ac.index.values[index_t]], axis=1).astype('int32')
 
-def executeDelaunay(hs, df4, idx):
+def executeDelaunay(mesh):
     """
     perform Triangle ~ constrained Delaunay with concavitities removed
-    - return the simplices: indices of vertices that create the triangles
+    - the vertices, segments and holes of the mesh go in as they are
+    - return the simplices: indices of vertices that create the triangles; and the vertices of Triangle ~
+      those of the mesh and after them the ones it adds where segments cross (see addCrossings)
     """      
-    holes = hs[['x', 'y']].round(3).values.tolist()
-    pts = df4[['x', 'y']].values #, 'z']].values
-        
-    A = dict(vertices=pts, segments=idx, holes=holes)
+    A = dict(vertices=mesh.vertices[:, :2], segments=mesh.segments)
+    if mesh.nh > 0:
+        A['holes'] = mesh.holes[:, :2]
     #Tr = tr.triangulate(A, 'pVV')  # the VV will print stats in the cmd
     Tr = tr.triangulate(A, 'p') 
-    t = Tr.get('triangles').tolist()
+    t = Tr.get('triangles')
     
      #-- matplotlib for basic 2D plot
     #plt.figure(figsize=(8, 8))
@@ -552,65 +992,172 @@ def executeDelaunay(hs, df4, idx):
     #tr.plot(ax, **Tr)
     #plt.show()
       
-    return t
+    return t, Tr['vertices']
+
+def addCrossings(mesh, V, gt_forward, rb):
+    """
+    append the vertices Triangle added where segments cross (footprints that overlap) to the mesh ~ returns how many
+    - the height is the dem under them (bilinear), as tileTerrain does
+    """
+    extra = V[mesh.nv:]
+    if len(extra) > 0:
+        z = rasterQuery(extra[:, 0], extra[:, 1], gt_forward, rb, interpolate='bilinear')
+        mesh.addVertices(np.column_stack([extra, np.round(z, 2)]))
+    
+    return len(extra)
        
-def extrudeRoofGround(orng, irngs, height, reverse, allsurfaces, cm):
-    oring = copy.deepcopy(orng)
-    irings = copy.deepcopy(irngs)
-    if reverse == True:
-        oring.reverse()
-        for each in irings:
-            each.reverse()
-    for (i, pt) in enumerate(oring):
-        cm['vertices'].append([round(pt[0], 3), round(pt[1], 3), height])
-        oring[i] = (len(cm['vertices']) - 1)
-    for (i, iring) in enumerate(irings):
-        for (j, pt) in enumerate(iring):
-            cm['vertices'].append([round(pt[0], 3), round(pt[1], 3), height])
-            irings[i][j] = (len(cm['vertices']) - 1)
-    output = []
-    output.append(oring)
-    for each in irings:
-        output.append(each)
-    allsurfaces.append(output)
+def thinTerrain(dem, fixed, segments, holes, tolerance, rounds=30):
+    """
+    greedy insertion ~ the dem points (n, 3) a TIN needs to stay within tolerance (m) of every dem point
+    - fixed (m, 3): the constraint vertices (footprints, aoi) are always in; with their segments (indices into fixed) and holes
+    - starts from the outline of the dem points (the extremes of every row and column) so the domain does not change;
+      every round inserts the worst point of each triangle that is off by more than tolerance
+    - returns the mask of the dem points to keep and the largest vertical error of the TIN over all dem points
+    """
+    n = len(dem)
+    keep = np.zeros(n, dtype=bool)
+    if n == 0:
+        return keep, 0.0
+    xy = pd.DataFrame({'x': dem[:, 0], 'y': dem[:, 1]})
+    for a, b in (('y', 'x'), ('x', 'y')):
+        g = xy.groupby(a)[b]
+        keep[g.idxmin().values] = True
+        keep[g.idxmax().values] = True
+    segments = np.asarray(segments, dtype='int32').reshape(-1, 2)
+    
+    for r in range(rounds + 1):
+        pts = np.concatenate([dem[keep], fixed])
+        A = dict(vertices=pts[:, :2], segments=segments + int(keep.sum()))
+        if len(holes) > 0:
+            A['holes'] = holes
+        Tr = tr.triangulate(A, 'p')
+        V = Tr['vertices']
+        z = pts[:, 2]
+        if len(V) > len(pts):
+            #-- vertices Triangle adds where segments cross ~ the height of the nearest constraint vertex
+            extra = V[len(pts):]
+            near = ((extra[:, np.newaxis, :] - fixed[np.newaxis, :, :2]) ** 2).sum(axis=2).argmin(axis=1)
+            z = np.concatenate([z, fixed[near, 2]])
+        
+        others = np.flatnonzero(~keep)
+        tin = mtri.Triangulation(V[:, 0], V[:, 1], Tr['triangles'])
+        zi = mtri.LinearTriInterpolator(tin, z)(dem[others, 0], dem[others, 1])
+        #-- a point outside the TIN goes in
+        err = np.abs(np.ma.filled(zi, np.inf) - dem[others, 2])
+        worst = float(err.max()) if len(err) > 0 else 0.0
+        if worst <= tolerance:
+            return keep, worst
+        bad = np.flatnonzero(err > tolerance)
+        if r == rounds:
+            keep[others[bad]] = True
+            return keep, float(err[err <= tolerance].max(initial=0.0))
+        
+        #-- the worst point of every triangle
+        t = tin.get_trifinder()(dem[others[bad], 0], dem[others[bad], 1])
+        order = np.lexsort((-err[bad], t))
+        first = np.r_[True, t[order][1:] != t[order][:-1]] | (t[order] == -1)
+        keep[others[bad[order[first]]]] = True
 
+def decimateTerrain(mesh, n, tolerance):
+    """
+    thin the first n vertices (the dem points) of the mesh with thinTerrain ~ in place
+    - the constraint vertices after them stay; the segments follow the vertices left
+    - returns the dem points kept and the largest vertical error (m)
+    """
+    V = mesh.vertices
+    keep, err = thinTerrain(V[:n], V[n:], mesh.segments - n, mesh.holes[:, :2], tolerance)
+    mesh.keepVertices(keep)
+    
+    return int(keep.sum()), err
+    
 def outputCityjsonB(extent, minz, maxz, T, pts, jparams, min_zbld, result):
     """
     basic function to produce LoD1 City Model
     - buildings and terrain
+    - streamed to file: metadata, the terrain and one Building at a time
+    - vertices are deduplicated as they are added; no cleaning pass
+    - "incremental": "True" ~ buildings that did not change since the last run are taken from its SolidStore
     """
-     ##- open building ---fiona object
-    c = fiona.open(jparams['osm_bldings'])
-    lsgeom = [] #-- list of the geometries
-    lsattributes = [] #-- list of the attributes
-    for each in c:
-        lsgeom.append(shape(each['geometry'])) #-- geom are cast to Fiona's 
-        lsattributes.append(each['properties'])
-           
-    cm = doVcBndGeomB(lsgeom, lsattributes, extent, minz, maxz, T, pts, jparams, min_zbld, result)
+    cm = doVcBndGeomB(extent, minz, maxz, jparams)
+    T = add_terrain_v(pts, T, cm)
+    
+    store = None
+    if jparams.get('incremental') == 'True':
+        store = SolidStore(jparams['cjsn_solid'])
     
-    json_str = json.dumps(cm, indent=2)
-    fout = open(jparams['cjsn_out'], "w")
-    fout.write(json_str)  
-    ##- close fiona object
-    c.close() 
+     ##- open building ---fiona object ~ features are read as the buildings are written
+    with fiona.open(jparams['osm_bldings']) as c:
+        #-- geom are cast to Fiona's 
+        features = ((shape(each['geometry']), dict(each['properties'])) for each in c)
+        buildings = doBldGeomB(features, cm, min_zbld, result, workers=int(jparams.get('workers', 1)), store=store)
+        writeCityjson(jparams['cjsn_solid'], cm, T, buildings)
     
-    ##--clean cityjson
-    cm = cityjson.load(jparams['cjsn_out'])
-    cityjson.save(cm, jparams['cjsn_solid'])
+    if store is not None:
+        store.close()
+        print('incremental: {} of {} buildings from the last run'.format(store.kept, len(store.buildings)))
 
-def doVcBndGeomB(lsgeom, lsattributes, extent, minz, maxz, T, pts, jparams, min_zbld, result): 
+class SolidStore:
+    """
+    the extruded buildings of the last run ~ next to the City Model, so a run does not read the City Model back
+    - <cjsn_solid>.solids: the vertex block of every building (float64, as extrudeBld returns it)
+    - <cjsn_solid>.manifest.json: {osm_id: [fingerprint, first vertex, vertices, surfaces]}
+    - get() the building of the last run when the fingerprint is the same; add() every building of this run
+    - close() replaces the last run with this one
+    """
+    def __init__(self, fname):
+        base = os.path.splitext(fname)[0]
+        self.mname = base + '.manifest.json'
+        self.sname = base + '.solids'
+        self.previous = {}
+        self.old = None
+        if os.path.exists(self.mname) and os.path.exists(self.sname):
+            with open(self.mname) as f:
+                self.previous = json.load(f)['buildings']
+            if os.path.getsize(self.sname) > 0:
+                #-- only the blocks of the unchanged buildings are read
+                self.old = np.memmap(self.sname, dtype='float64', mode='r').reshape(-1, 3)
+        self.buildings = {}
+        self.keys = {}
+        self.kept = 0
+        self.offset = 0
+        self.tname = '{}.{}.tmp'.format(self.sname, os.getpid())
+        self.tmp = open(self.tname, 'wb')
+    
+    def get(self, oid, key):
+        self.keys[oid] = key
+        old = self.previous.get(oid)
+        if old is None or old[0] != key or self.old is None:
+            return None
+        self.kept = self.kept + 1
+        
+        return np.array(self.old[old[1]:old[1] + old[2]]), old[3]
+    
+    def add(self, oid, V, surfaces):
+        V = np.ascontiguousarray(V, dtype='float64')
+        self.tmp.write(V.tobytes())
+        self.buildings[oid] = [self.keys[oid], self.offset, len(V), surfaces]
+        self.offset = self.offset + len(V)
+    
+    def close(self):
+        self.tmp.close()
+        #-- let go of the map before the file is replaced
+        self.old, self.previous = None, {}
+        os.replace(self.tname, self.sname)
+        tmp = '{}.{}.tmp'.format(self.mname, os.getpid())
+        with open(tmp, 'w') as f:
+            #-- json.dumps is the c encoder; json.dump to a file is not
+            f.write(json.dumps({'buildings': self.buildings}))
+        os.replace(tmp, self.mname)
+
+def doVcBndGeomB(extent, minz, maxz, jparams): 
     
     #-- create the JSON data structure for the City Model
     cm = {}
     cm["type"] = "CityJSON"
     cm["version"] = "1.1"
-    # cm["transform"] = {
-    #     "scale": [0.001, 0.001, 0.001],
-    #     "translate": [extent[0], extent[0], minz]
-    #     },
-    cm["CityObjects"] = {}
-    cm["vertices"] = []
+    #-- vertices are shared and stored as integers ~ x = (v * scale) + translate
+    cm["vertices"] = VertexIndex([extent[0], extent[1], minz])
+    cm["transform"] = cm["vertices"].transform()
     
     ##-- Metadata is added manually
     cm["metadata"] = {
@@ -667,50 +1214,65 @@ def doVcBndGeomB(lsgeom, lsattributes, extent, minz, maxz, T, pts, jparams, min_
                  }
             }]
         }
-    },
-        
-    ##-- do terrain
-    add_terrain_v(pts, cm)
-    grd = {}
-    grd['type'] = 'TINRelief'
-    grd['geometry'] = [] #-- a cityobject can have >1 
-      #-- the geometry
-    g = {} 
-    g['type'] = 'CompositeSurface'
-    g['lod'] = 1
-    allsurfaces = [] #-- list of surfaces
-    add_terrain_b(T, allsurfaces)
-    g['boundaries'] = allsurfaces
-    #-- add the geom 
-    grd['geometry'].append(g)
-    #-- insert the terrain as one new city object
-    cm['CityObjects']['terrain01'] = grd
+    }
     
+    return cm
+
+def doBldGeomB(features, cm, min_zbld, result, batch=1000, workers=1, store=None):
+    """
+    generate the Building CityObjects ~ (osm_id, building)
+    - footprints are extruded by extrudeBld, a chunk of batch at a time and in parallel when workers > 1
+    - the vertices of each chunk are added to cm['vertices'] in input order
+    - store (SolidStore): a building with the same fingerprint as in the last run is taken from it
+      instead of extruded; every building goes into it for the next run
+    """
+    blds = bldFootprints(features, min_zbld, result)
+    kept = {}
+    if store is not None:
+        blds = bldChanged(blds, store, kept)
+    for chunk, extruded in extrudeBatches(blds, batch, workers):
+        #-- unchanged buildings come through the chunk without args
+        extruded = [kept.pop(str(attributes['osm_id'])) if args is None else e
+                    for (attributes, args), e in zip(chunk, extruded)]
+        if store is not None:
+            for (attributes, args), (V, surfaces) in zip(chunk, extruded):
+                store.add(str(attributes['osm_id']), V, surfaces)
+        #-- hand the buildings over to the writer
+        yield from bldBatch([(attributes, V, surfaces) for (attributes, args), (V, surfaces) in zip(chunk, extruded)], cm)
+
+def bldKey(attributes, args):
+    """
+    fingerprint of a building ~ its attributes and all extrudeBld gets: the footprint, the height
+    stacks (with the heights of the neighbours) and the dem sampled under the footprint
+    """
+    return hashlib.sha256(json.dumps([attributes, args], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def bldChanged(blds, store, kept):
+    """
+    pass (attributes, args) through with the fingerprint recorded in store
+    - a building unchanged since the last run comes through as (attributes, None); its solid goes to kept
+    """
+    for attributes, args in blds:
+        oid = str(attributes['osm_id'])
+        solid = store.get(oid, bldKey(attributes, args))
+        if solid is not None:
+            kept[oid] = solid
+            yield attributes, None
+        else:
+            yield attributes, args
+
+def bldFootprints(features, min_zbld, result):
+    """
+    prepare each footprint for extrudeBld ~ (attributes, args)
+    - oriented rings, the height stacks at the exterior vertices, roof/floor/ground heights
+    """
     count = 0
-    ##-- then buildings
-    for (i, geom) in enumerate(lsgeom):
+    for (i, (geom, attributes)) in enumerate(features):
         
-        poly = list(result[lsattributes[i]['osm_id']].values())  #--- a list with the heights at each vertex
-
+        poly = list(result[attributes['osm_id']].values())  #--- a list with the heights at each vertex
+        attributes = {k: v for k, v in attributes.items() if v is not None}
         
         footprint = geom
-        #-- one building
-        oneb = {}
-        oneb['type'] = 'Building'
-        oneb['attributes'] = {}
-        for k, v in list(lsattributes[i].items()):
-            if v is None:
-                del lsattributes[i][k]
-            #oneb['attributes'][k] = lsattributes[i][k]
-        for a in lsattributes[i]:
-            oneb['attributes'][a] = lsattributes[i][a]
-        
-        oneb['geometry'] = [] #-- a cityobject can have > 1
-        #-- the geometry
-        g = {} 
-        g['type'] = 'Solid'
-        g['lod'] = 1
-        allsurfaces = [] #-- list of surfaces forming the oshell of the solid
         #-- exterior ring of each footprint
         oring = list(footprint.exterior.coords)
         oring.pop() #-- remove last point since first==last
@@ -718,27 +1280,15 @@ def doVcBndGeomB(lsgeom, lsattributes, extent, minz, maxz, T, pts, jparams, min_
             #-- to get proper orientation of the normals
             oring.reverse() 
         
-        if lsattributes[i]['osm_building'] == 'bridge':
-            #--- make sure the list of heights at each vertex do not go higher than the roof height
-            edges = [[ele for ele in sub if ele <= lsattributes[i]['roof_height']] for sub in poly]
-            extrude_walls(oring, lsattributes[i]['roof_height'], lsattributes[i]['bottom_bridge_height'], 
-                          allsurfaces, cm, edges)
-            count = count + 1
-
-        if lsattributes[i]['osm_building'] == 'roof':
-            #--- make sure the list of heights at each vertex do not go higher than the roof height
-            edges = [[ele for ele in sub if ele <= lsattributes[i]['roof_height']] for sub in poly]
-            extrude_walls(oring, lsattributes[i]['roof_height'], lsattributes[i]['bottom_roof_height'], 
-                          allsurfaces, cm, edges)
+        #--- make sure the list of heights at each vertex do not go higher than the roof height
+        edges = [[ele for ele in sub if ele <= attributes['roof_height']] for sub in poly]
+        if attributes['osm_building'] == 'bridge' or attributes['osm_building'] == 'roof':
+            bottom = attributes['bottom_' + attributes['osm_building'] + '_height']
             count = count + 1
-
-        if lsattributes[i]['osm_building'] != 'bridge' and lsattributes[i]['osm_building'] != 'roof':
-            #--- make sure the list of heights at each vertex do not go higher than the roof height
-            new_edges = [[ele for ele in sub if ele <= lsattributes[i]['roof_height']] for sub in poly]
+        else:
+            bottom = min_zbld[i-count]
             #--- add the height of the ground level to each vertex in the list
-            new_edges = [[min_zbld[i-count]] + sub_list for sub_list in new_edges]
-            extrude_walls(oring, lsattributes[i]['roof_height'], min_zbld[i-count], 
-                          allsurfaces, cm, new_edges)
+            edges = [[bottom] + sub_list for sub_list in edges]
         
         #-- interior rings of each footprint
         irings = []
@@ -750,142 +1300,211 @@ def doVcBndGeomB(lsgeom, lsattributes, extent, minz, maxz, T, pts, jparams, min_
                 #-- to get proper orientation of the normals
                 iring.reverse() 
             irings.append(iring)
-            extrude_int_walls(iring, lsattributes[i]['roof_height'], min_zbld[i-count], allsurfaces, cm)
-        #-- top-bottom surfaces
-
-        if lsattributes[i]['osm_building'] == 'bridge':
-            extrude_roof_ground(oring, irings, lsattributes[i]['roof_height'], 
-                                False, allsurfaces, cm)
-            extrude_roof_ground(oring, irings, lsattributes[i]['bottom_bridge_height'], 
-                                True, allsurfaces, cm)
-        if lsattributes[i]['osm_building'] == 'roof':
-            extrude_roof_ground(oring, irings, lsattributes[i]['roof_height'], 
-                                False, allsurfaces, cm)
-            extrude_roof_ground(oring, irings, lsattributes[i]['bottom_roof_height'], 
-                                True, allsurfaces, cm)
-        if lsattributes[i]['osm_building'] != 'bridge' and lsattributes[i]['osm_building'] != 'roof':
-        #else:
-            extrude_roof_ground(oring, irings, lsattributes[i]['roof_height'], 
-                            False, allsurfaces, cm)
-            extrude_roof_ground(oring, irings, min_zbld[i-count], True, allsurfaces, cm)
+        ground = min_zbld[i-count] if len(irings) > 0 else None
         
-        #-- add the extruded surfaces to the geometry
-        g['boundaries'] = []
-        g['boundaries'].append(allsurfaces)
-        #g['boundaries'] = allsurfaces
-        #-- add the geom to the building 
-        oneb['geometry'].append(g)
-        #-- insert the building as one new city object
-        cm['CityObjects'][lsattributes[i]['osm_id']] = oneb
+        yield attributes, (oring, irings, edges, attributes['roof_height'], bottom, ground)
 
-    return cm
+def extrudeBld(oring, irings, edges, height, bottom, ground):
+    """
+    extrusion kernel ~ one footprint to a block of vertices and the surfaces over it
+    - oring and irings are oriented rings without the closing vertex
+    - edges: the stack of heights at each vertex of oring; the walls run up these stacks
+    - interior walls from ground to height; roof at height and floor at bottom
+    - returns the (m, 3) vertex block and the surfaces as indices into the block
+    """
+    oring = np.asarray(oring, dtype='float64')[:, :2]
+    irings = [np.asarray(each, dtype='float64')[:, :2] for each in irings]
+    n = len(oring)
+    k = np.fromiter((len(e) for e in edges), dtype='int64', count=n)
+    off = np.concatenate([[0], np.cumsum(k)])
+    blocks = [np.column_stack([np.repeat(oring, k, axis=0), 
+                               np.fromiter((z for e in edges for z in e), dtype='float64', count=off[-1])])]
+    base = int(off[-1])
+    #-- exterior walls ~ up the stack at one end and down the other
+    if (k == 2).all():
+        a = np.arange(n)
+        b = np.roll(a, -1)
+        surfaces = [[w] for w in np.stack([2 * a, 2 * b, 2 * b + 1, 2 * a + 1], axis=1).tolist()]
+    else:
+        surfaces = []
+        k, off = k.tolist(), off.tolist()
+        for a in range(n):
+            b = (a + 1) % n
+            if k[a] > 2 or k[b] > 2 or (k[a] == 2 and k[b] == 2):
+                surfaces.append([[off[a]] + list(range(off[b], off[b] + k[b])) 
+                                 + list(range(off[a] + k[a] - 1, off[a], -1))])
+    #-- interior walls ~ rectangles
+    for iring in irings:
+        m = len(iring)
+        blocks.append(np.column_stack([np.vstack([iring, iring]), np.repeat([ground, height], m)]))
+        g = base + np.arange(m)
+        g1 = base + np.roll(np.arange(m), -1)
+        surfaces.extend([w] for w in np.stack([g, g1, g1 + m, g + m], axis=1).tolist())
+        base = base + 2 * m
+    #-- roof and floor ~ the floor is reversed
+    rings = [oring] + irings
+    for z, reverse in ((height, False), (bottom, True)):
+        s = []
+        for ring in rings:
+            r = list(range(base, base + len(ring)))
+            s.append(r[::-1] if reverse else r)
+            base = base + len(ring)
+        surfaces.append(s)
+    xy = np.concatenate(rings)
+    blocks.append(np.column_stack([np.vstack([xy, xy]), np.repeat([height, bottom], len(xy))]))
+    
+    return np.concatenate(blocks), surfaces
+
+def bldBatch(batch, cm):
+    """
+    add the vertices of a batch of extruded buildings at once
+    - yield the Building CityObjects with their surfaces indexed to cm['vertices']
+    """
+    if len(batch) == 0:
+        return
+    ids = cm['vertices'].addBlock(np.concatenate([V for attributes, V, surfaces in batch]))
+    o = 0
+    for attributes, V, surfaces in batch:
+        m = ids[o:o + len(V)]
+        oneb = {}
+        oneb['type'] = 'Building'
+        oneb['attributes'] = attributes
+        #-- the geometry
+        g = {} 
+        g['type'] = 'Solid'
+        g['lod'] = 1
+        g['boundaries'] = [[[[m[j] for j in r] for r in s] for s in surfaces]]
+        oneb['geometry'] = [g]
+        o = o + len(V)
+        yield attributes['osm_id'], oneb
+
+def extrudeChunk(chunk):
+    """
+    extrude a chunk of footprints ~ the unit of work of the process pool
+    - args None (an unchanged building) is passed over
+    """
+    return [None if args is None else extrudeBld(*args) for args in chunk]
+
+def extrudeBatches(blds, batch, workers):
+    """
+    extrude (attributes, args) footprints in chunks of batch ~ (chunk, extruded)
+    - workers > 1: chunks are extruded in a process pool, at most 2 per worker in flight
+    - chunks come back in input order so the merged City Model is the same as the serial one
+    """
+    chunks = iter(lambda: list(islice(blds, batch)), [])
+    if workers <= 1:
+        for chunk in chunks:
+            yield chunk, extrudeChunk([args for attributes, args in chunk])
+        return
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        pending = deque()
+        for chunk in chunks:
+            pending.append((chunk, ex.submit(extrudeChunk, [args for attributes, args in chunk])))
+            if len(pending) >= 2 * workers:
+                chunk, fut = pending.popleft()
+                yield chunk, fut.result()
+        while len(pending) > 0:
+            chunk, fut = pending.popleft()
+            yield chunk, fut.result()
 
-def add_terrain_v(pts, cm):
-    for p in pts:
-        cm['vertices'].append([p[0], p[1], p[2]])
+class VertexIndex:
+    """
+    the vertices of the City Model ~ shared and quantized to the transform
+    - addBlock() returns the index of each vertex (a list); a vertex already present (at the scale, 0.001 m) keeps its index
+    - the integer vertices are spooled to a temporary binary file; only the index stays in memory
+    """
+    def __init__(self, translate, scale=0.001, size=100000):
+        self.translate = [float(t) for t in translate]
+        self.scale = scale
+        self.size = size
+        self.index = {}
+        self.tmp = tempfile.TemporaryFile()
+        self.buf = []
     
-def add_terrain_b(Terr, allsurfaces):
-    for i in Terr:
-        allsurfaces.append([[i[0], i[1], i[2]]]) 
+    def addBlock(self, V):
+        #-- quantize the whole block in one go; only the lookup is per vertex
+        q = np.rint((np.asarray(V, dtype='float64').reshape(-1, 3) - self.translate) / self.scale).astype('int64')
+        n = len(self.index)
+        index = self.index
+        ids = [index.setdefault(key, len(index)) for key in zip(*q.T.tolist())]
+        #-- the new vertices are the last entries of the index
+        self.buf.extend(reversed(list(islice(reversed(index), len(index) - n))))
+        if len(self.buf) >= self.size:
+            self.flush()
+        
+        return ids
+    
+    def __len__(self):
+        return len(self.index)
+    
+    def transform(self):
+        return {"scale": [self.scale, self.scale, self.scale], "translate": self.translate}
+    
+    def flush(self):
+        if len(self.buf) > 0:
+            self.tmp.write(np.asarray(self.buf, dtype='int64').tobytes())
+            self.buf = []
+    
+    def blocks(self):
+        self.flush()
+        self.tmp.seek(0)
+        while True:
+            b = self.tmp.read(self.size * 24)
+            if not b:
+                break
+            yield np.frombuffer(b, dtype='int64').reshape(-1, 3)
+    
+    def close(self):
+        self.tmp.close()
 
-def extrude_walls(ring, height, ground, allsurfaces, cm, edges): 
-    dps = 3
-    #-- each edge become a wall, ie a rectangle
-    for (j, v) in enumerate(ring[:-1]):
+def writeCityjson(fname, cm, T, buildings):
+    """
+    stream the City Model to file
+    - the header, the terrain, each building as it is generated and, last, the spooled vertices
+    """
+    with open(fname, 'w') as fout:
+        fout.write('{')
+        for k, v in cm.items():
+            if k not in ('CityObjects', 'vertices'):
+                fout.write('%s: %s, ' % (json.dumps(k), json.dumps(v)))
         
-        if len(edges[j]) > 2 or len(edges[j+1]) > 2:
-            cm['vertices'].append([round(ring[j][0], dps), round(ring[j][1], dps), edges[j][0]])
-            cm['vertices'].append([round(ring[j+1][0], dps), round(ring[j+1][1], dps), edges[j+1][0]])
-            c = 0
-            for i, o in enumerate(edges[j+1][1:]):
-                cm['vertices'].append([round(ring[j+1][0], dps), round(ring[j+1][1], dps), o])
-                c = c + 1
-            for i in edges[j][::-1][:-1]:
-                cm['vertices'].append([round(ring[j][0], dps), round(ring[j][1], dps), i])
-                c = c + 1
-            t = len(cm['vertices'])
-            c = c + 2
-            b = c
-            l = []
-            for i in range(c):
-                l.append(t-b)
-                b = b - 1 
-            allsurfaces.append([l])
-
-        if len(edges[j]) == 2 and len(edges[j+1]) == 2:
-            cm['vertices'].append([round(ring[j][0], dps),   round(ring[j][1], dps),   edges[j][0]])
-            cm['vertices'].append([round(ring[j+1][0], dps), round(ring[j+1][1], dps), edges[j+1][0]])
-            cm['vertices'].append([round(ring[j+1][0], dps), round(ring[j+1][1], dps), edges[j+1][1]])
-            cm['vertices'].append([round(ring[j][0], dps),   round(ring[j][1], dps),   edges[j][1]])
-            t = len(cm['vertices'])
-            allsurfaces.append([[t-4, t-3, t-2, t-1]])
-            
-    if len(edges[-1]) == 2 and len(edges[0]) == 2:
-        cm['vertices'].append([round(ring[-1][0], dps),  round(ring[-1][1], dps), edges[-1][0]]) 
-        cm['vertices'].append([round(ring[0][0], dps), round(ring[0][1], dps), edges[0][0]])
-        cm['vertices'].append([round(ring[0][0], dps),  round(ring[0][1], dps),  edges[0][1]])
-        cm['vertices'].append([round(ring[-1][0], dps), round(ring[-1][1], dps), edges[-1][1]])
-        t = len(cm['vertices'])
-        allsurfaces.append([[t-4, t-3, t-2, t-1]])
+        ##-- terrain ~ triangles in chunks
+        fout.write('"CityObjects": {"terrain01": {"type": "TINRelief", "geometry": '
+                   '[{"type": "CompositeSurface", "lod": 1, "boundaries": [')
+        for k in range(0, len(T), 100000):
+            allsurfaces = [] #-- list of surfaces
+            add_terrain_b(T[k:k + 100000].tolist(), allsurfaces)
+            fout.write((', ' if k else '') + json.dumps(allsurfaces)[1:-1])
+        fout.write(']}]}')
         
-    if len(edges[-1]) > 2 or len(edges[0]) > 2:
-        c = 0
-        cm['vertices'].append([round(ring[-1][0], dps),   round(ring[-1][1], dps),   edges[-1][0]])
-        cm['vertices'].append([round(ring[0][0], dps), round(ring[0][1], dps), edges[0][0]])
-        for i, o in enumerate(edges[0][1:]):
-            cm['vertices'].append([round(ring[0][0], dps), round(ring[0][1], dps), o])
-            c = c + 1
-        for i in edges[-1][::-1][:-1]:
-            cm['vertices'].append([round(ring[-1][0], dps),   round(ring[-1][1], dps),   i])
-            c = c + 1
-        t = len(cm['vertices'])
-        c = c + 2
-        b = c
-        l = []
-        for i in range(c): 
-            l.append(t-b)
-            b = b - 1 
-        allsurfaces.append([l])
-     
-def extrude_int_walls(ring, height, ground, allsurfaces, cm):
+        ##-- then buildings
+        for oid, oneb in buildings:
+            fout.write(', %s: %s' % (json.dumps(str(oid)), json.dumps(oneb)))
+        
+        ##-- and the vertices
+        fout.write('}, "vertices": [')
+        first = True
+        for block in cm['vertices'].blocks():
+            if len(block) == 0:
+                continue
+            fout.write(('' if first else ', ') + json.dumps(block.tolist())[1:-1])
+            first = False
+        fout.write(']}')
+    cm['vertices'].close()
+
+def add_terrain_v(pts, T, cm):
+    """
+    add the terrain vertices the triangles use
+    - return the triangles re-indexed to the shared vertices
+    """
+    T = np.asarray(T, dtype='int64').reshape(-1, 3)
+    used = np.unique(T)
+    vi = np.full(len(pts), -1, dtype='int64')
+    vi[used] = cm['vertices'].addBlock(pts[used])
     
-    dps = 3
-    #-- each edge become a wall, ie a rectangle
-    for (j, v) in enumerate(ring[:-1]):
-        cm['vertices'].append([round(ring[j][0], dps),   round(ring[j][1], dps),   ground])
-        #values.append(0)
-        cm['vertices'].append([round(ring[j+1][0], dps), round(ring[j+1][1], dps), ground])
-        #values.append(0)
-        cm['vertices'].append([round(ring[j+1][0], dps), round(ring[j+1][1], dps), height])
-        cm['vertices'].append([round(ring[j][0], dps),   round(ring[j][1], dps),   height])
-        t = len(cm['vertices'])
-        allsurfaces.append([[t-4, t-3, t-2, t-1]])    
-    #-- last-first edge
-    cm['vertices'].append([round(ring[-1][0], dps), round(ring[-1][1], dps), ground])
-    #values.append(0)
-    cm['vertices'].append([round(ring[0][0], dps),  round(ring[0][1], dps),  ground])
-    cm['vertices'].append([round(ring[0][0], dps),  round(ring[0][1], dps),  height])
-    #values.append(0)
-    cm['vertices'].append([round(ring[-1][0], dps), round(ring[-1][1], dps), height])
-    t = len(cm['vertices'])
-    allsurfaces.append([[t-4, t-3, t-2, t-1]])
-    
-def extrude_roof_ground(orng, irngs, height, reverse, allsurfaces, cm):
-    oring = copy.deepcopy(orng)
-    irings = copy.deepcopy(irngs)
-    if reverse == True:
-        oring.reverse()
-        for each in irings:
-            each.reverse()
-    for (i, pt) in enumerate(oring):
-        cm['vertices'].append([round(pt[0], 3), round(pt[1], 3), height])
-        oring[i] = (len(cm['vertices']) - 1)
-    for (i, iring) in enumerate(irings):
-        for (j, pt) in enumerate(iring):
-            cm['vertices'].append([round(pt[0], 3), round(pt[1], 3), height])
-            irings[i][j] = (len(cm['vertices']) - 1)
-    output = []
-    output.append(oring)
-    for each in irings:
-        output.append(each)
-    allsurfaces.append(output)
\ No newline at end of file
+    return vi[T]
+    
+def add_terrain_b(Terr, allsurfaces):
+    for i in Terr:
+        allsurfaces.append([[i[0], i[1], i[2]]]) 
+
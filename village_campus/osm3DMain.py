@@ -8,129 +8,427 @@
 
 import os
 import sys
-from pynput import keyboard
 import json
+import csv
+import pickle
+import shutil
+import cProfile
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+try:
+    import resource
+except ImportError:
+    #-- windows
+    resource = None
 
 from osgeo import gdal
 
 import time
 from datetime import timedelta
 
-from osm3DCode import (requestOsmBld, requestOsmAoi, getOsmArea, 
-                       prepareDEM, createXYZ, 
-                       assignZ, writegjson, 
-                       getXYZ, 
+from osm3DCode import (requestOsmBld, requestOsmAoi, getOsmArea,
+                       prepareDEM, createXYZ,
+                       assignZ, writegjson,
+                       getXYZ,
                        mtPlot02, getOsmBld,
-                       getBldVertices, createSgmts, concatCoords, getAOIVertices, 
-                       executeDelaunay, 
+                       getBldVertices, createSgmts, TerrainMesh, getAOIVertices,
+                       executeDelaunay, addCrossings, decimateTerrain,
                        outputCityjsonB)
 
 
-def on_press(key, ts, gt_forward, rb, extent, aoi, aoibuffer, jparams):
-    if key == keyboard.Key.enter:
-        print("\nYou pressed Enter... we continue with osm_LoD1_3DCityModel.")
-        
-        ts = assignZ(ts, gt_forward, rb)
-        writegjson(ts, jparams)
-        
-        dis, hs, result = getOsmBld(jparams)
-
-        gdf = getXYZ(dis, aoibuffer, jparams)
-        
-        ac, c, min_zbld = getBldVertices(dis, gt_forward, rb)
-        idx = []
-        idx, idx01 = createSgmts(ac, c, gdf, idx)
-        df2 = concatCoords(gdf, ac)
-
-        acoi, ca = getAOIVertices(aoi, gt_forward, rb)
-        idx, idx01 = createSgmts(acoi, ca, df2, idx)
-        df4 = concatCoords(df2, acoi)
-                    
-        pts = df4[['x', 'y', 'z']].values
-        pts = pts.astype('float64')
-    
-        t = executeDelaunay(hs, df4, idx)
-                   
-        minz = df4['z'].min()
-        maxz = df4['z'].max()
-        
-        outputCityjsonB(extent, minz, maxz, t, pts, jparams, min_zbld, result)
-        
-        sys.exit(0)
-    
-
-def on_release(key):
-    
-    if key == keyboard.Key.esc:
-        # Stop listener
+class RunReport:
+    """
+    wall time, peak RSS and the cardinalities (buildings, vertices, segments, triangles, cells) of every 
+    pipeline function in a run
+    - "profile": "cProfile" or "pyinstrument" keeps a profile of every call next to the report
+    - write() ~ <report>.json and <report>.csv
+    """
+    columns = ['stage', 'function', 'seconds', 'peak_rss_mb', 'buildings', 'vertices', 'segments', 'triangles', 'cells']
+
+    def __init__(self, base, profile=None):
+        self.base = base
+        self.profile = profile
+        self.stage = None
+        self.rows = []
+
+    def call(self, f, *args, count=None):
+        """
+        f(*args) ~ count(result, *args) returns the cardinalities
+        """
+        if self.profile == 'cProfile':
+            profiler = cProfile.Profile()
+            profiler.enable()
+        elif self.profile == 'pyinstrument':
+            from pyinstrument import Profiler
+            profiler = Profiler()
+            profiler.start()
+        reset = resetPeakRSS()
+        before = peakRSS()
+        start = time.perf_counter()
+        result = f(*args)
+        seconds = time.perf_counter() - start
+        peak = peakRSS()
+        if not reset and peak is not None and peak <= before:
+            #-- the process peaked before this call (an earlier stage or param.json); its own peak is not known
+            peak = None
+        fname = '{}_{}_{}'.format(self.base, self.stage, f.__name__)
+        if self.profile == 'cProfile':
+            profiler.disable()
+            profiler.dump_stats(fname + '.prof')
+        elif self.profile == 'pyinstrument':
+            profiler.stop()
+            with open(fname + '.html', 'w') as out:
+                out.write(profiler.output_html())
+
+        row = {'stage': self.stage, 'function': f.__name__, 'seconds': round(seconds, 6), 'peak_rss_mb': peak}
+        if count is not None:
+            row.update(count(result, *args))
+        self.rows.append(row)
+
+        return result
+
+    def write(self, fname, timings, restored):
+        report = {'params': fname, 'stages': timings, 'checkpoint': sorted(restored), 'functions': self.rows}
+        with open(self.base + '.json', 'w') as out:
+            json.dump(report, out, indent=2, default=int)
+        with open(self.base + '.csv', 'w', newline='') as out:
+            w = csv.DictWriter(out, fieldnames=self.columns)
+            w.writeheader()
+            w.writerows(self.rows)
+
+def resetPeakRSS():
+    """
+    start the peak resident memory again from what is resident now ~ linux (/proc/self/clear_refs) only;
+    False where it cannot be done
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
         return False
-    
-def main():
-    start = time.time()
-    
+
+    return True
+
+def peakRSS():
+    """
+    peak resident memory (MB) ~ since the last resetPeakRSS() on linux, of the process so far elsewhere;
+    None where the platform has no resource module
+    """
     try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #-- bytes on macOS, kilobytes elsewhere
+    return round(rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
 
-        #jparams = json.load(open('osm3DuEstate_param.json'))
-        #jparams = json.load(open('osm3Dcput_param.json'))
-        jparams = json.load(open('osm3Dmamre_param.json'))
+def rasterCells(fname):
+    src_ds = gdal.Open(fname)
+    cells = src_ds.RasterXSize * src_ds.RasterYSize
+    src_ds = None
 
-    except Exception as e:
-        print("ERROR: something is wrong with the param.json file. {e}")
-        sys.exit()
-        
-    path = os.getcwd()
-    d_name = 'data'
-    path = os.path.join(path, d_name)
-    os.makedirs(path, exist_ok=True)
-    
-    ts = requestOsmBld(jparams)
-    aoi = requestOsmAoi(jparams)
-    aoi, aoibuffer, extent = getOsmArea(aoi, jparams['aoi'], jparams['osm_type'], jparams['crs'])
-       
-    path = os.getcwd()
-    r_name = 'result'
-    path = os.path.join(path, r_name)
-    os.makedirs(path, exist_ok=True)
-
-    prepareDEM(extent, jparams)
-    createXYZ(jparams['xyz'], jparams['projClip_raster'])
-    
+    return cells
+
+def stageOsmBld(state, jparams, report):
+    return {'ts': report.call(requestOsmBld, jparams, count=lambda ts, jp: {'buildings': len(ts)})}
+
+def stageOsmAoi(state, jparams, report):
+    aoi = report.call(requestOsmAoi, jparams)
+    aoi, aoibuffer, extent = report.call(getOsmArea, aoi, jparams['aoi'], jparams['osm_type'], jparams['crs'])
+
+    return {'aoi': aoi, 'aoibuffer': aoibuffer, 'extent': extent}
+
+def stageTopology(state, jparams, report):
+    """
+    the gate ~ report the footprints that overlap; stop only when there are more than "topology_errors"
+    - "topology_errors" not set: report and carry on ~ the terrain takes the vertices Triangle adds
+      where walls cross (addCrossings); the overlapping solids stay as osm has them
+    """
+    errors = report.call(mtPlot02, state['ts'], jparams, count=lambda e, ts, jp: {'buildings': len(ts)})
+    if len(errors) > 0:
+        print('topology: {} overlapping buildings in {}'.format(len(errors), jparams.get('FocusArea', '')))
+    if 'topology_errors' not in jparams:
+        return {'topology': len(errors)}
+    limit = int(jparams['topology_errors'])
+    if len(errors) > limit:
+        raise RuntimeError('topology: {} overlapping buildings (more than "topology_errors": {}); '
+                           'fix them in osm or raise the limit'.format(len(errors), limit))
+
+    return {'topology': len(errors)}
+
+def stageDEM(state, jparams, report):
+    report.call(prepareDEM, state['extent'], jparams, 
+                count=lambda r, e, jp: {'cells': rasterCells(jp['projClip_raster'])})
+    if jparams.get('xyz_export') == 'True':
+        report.call(createXYZ, jparams['xyz'], jparams['projClip_raster'], 
+                    count=lambda r, fout, fin: {'cells': rasterCells(fin)})
+
+def stageFootprints(state, jparams, report):
     #-- read raster
-    src_filename = jparams['projClip_raster']
-    src_ds = gdal.Open(src_filename) 
-    gt_forward = src_ds.GetGeoTransform()
-    #gt_reverse=gdal.InvGeoTransform(gt_forward)
-    rb = src_ds.GetRasterBand(1)
-    
-    mtPlot02(ts, jparams)
-    print('')
-    print("Have a look at the matplotlib render that might highlight errors (red) in the 2D vectors.\n\nIf there are no challenges press 'Enter' to continue; else press 'Esc' to exit: ")
-
-    with keyboard.Listener(
-            on_press=lambda key: on_press(key, ts, gt_forward, rb, extent, aoi, aoibuffer, jparams),
-            on_release=on_release) as listener:
-        listener.join()
-
-
-    src_ds = None      
+    src_ds = gdal.Open(jparams['projClip_raster'])
+    ts = report.call(assignZ, state['ts'], src_ds.GetGeoTransform(), src_ds.GetRasterBand(1), 
+                     count=lambda ts, *a: {'buildings': len(ts)})
+    src_ds = None
+    report.call(writegjson, ts, jparams, count=lambda r, ts, jp: {'buildings': len(ts)})
+    dis, hs, result = report.call(getOsmBld, jparams, count=lambda r, jp: {'buildings': len(r[0])})
+
+    return {'dis': dis, 'hs': hs, 'result': result}
+
+def stageTerrain(state, jparams, report):
+    src_ds = gdal.Open(jparams['projClip_raster'])
+    gt_forward, rb = src_ds.GetGeoTransform(), src_ds.GetRasterBand(1)
+    dis = state['dis']
+    ac, c, min_zbld = report.call(getBldVertices, dis, gt_forward, rb, 
+                                  count=lambda r, dis, *a: {'buildings': len(dis), 'vertices': len(r[0]), 'segments': len(r[1])})
+    acoi, ca = report.call(getAOIVertices, state['aoi'], gt_forward, rb, 
+                           count=lambda r, *a: {'vertices': len(r[0]), 'segments': len(r[1])})
+
+    #-- one preallocated mesh: dem points, then footprint and aoi vertices with their segments
+    mesh = TerrainMesh(len(ac) + len(acoi), len(c) + len(ca), len(state['hs']))
+    n = report.call(getXYZ, dis, state['aoibuffer'], jparams, mesh, count=lambda n, *a: {'vertices': n})
+    report.call(createSgmts, ac, c, mesh, count=lambda r, *a: {'vertices': len(ac), 'segments': len(r)})
+    report.call(createSgmts, acoi, ca, mesh, count=lambda r, *a: {'vertices': len(acoi), 'segments': len(r)})
+    mesh.addHoles(state['hs'][['x', 'y', 'ground_height']].round({'x': 3, 'y': 3}).values)
+    if jparams.get('terrain_tolerance'):
+         #-- thin the dem points to those the surface needs within "terrain_tolerance" (m)
+        report.call(decimateTerrain, mesh, n, float(jparams['terrain_tolerance']), 
+                    count=lambda r, mesh, n, tol: {'cells': n, 'vertices': mesh.nv, 'segments': mesh.ns})
+
+    t, V = report.call(executeDelaunay, mesh, 
+                       count=lambda r, mesh: {'buildings': mesh.nh, 'vertices': len(r[1]), 
+                                              'segments': mesh.ns, 'triangles': len(r[0])})
+    #-- where footprints overlap Triangle adds vertices; the triangles index them after the mesh vertices
+    report.call(addCrossings, mesh, V, gt_forward, rb, count=lambda n, *a: {'vertices': n})
+    pts = mesh.vertices
+    src_ds = None
+
+    return {'t': t, 'pts': pts, 'min_zbld': min_zbld, 'minz': pts[:, 2].min(), 'maxz': pts[:, 2].max()}
+
+def stageCityjson(state, jparams, report):
+    report.call(outputCityjsonB, state['extent'], state['minz'], state['maxz'], state['t'], state['pts'], jparams,
+                state['min_zbld'], state['result'], 
+                count=lambda r, e, mn, mx, t, pts, *a: {'buildings': len(state['result']), 'vertices': len(pts), 
+                                                        'triangles': len(t)})
+
+#-- the pipeline as a DAG ~ name: stage
+#--   needs: the stages it needs; params: the parameters it reads (prefix*); None is never checkpointed
+#--   reads: parameters that are input files; writes: parameters that are files it writes
+STAGES = {
+    'osm_bld': dict(needs=(), run=stageOsmBld, params=None, reads=(), writes=()),
+    'osm_aoi': dict(needs=(), run=stageOsmAoi, params=None, reads=(), writes=('aoi',)),
+    'topology': dict(needs=('osm_bld',), run=stageTopology, 
+                     params=('topology_errors', 'topology_plot'), reads=(), writes=()),
+    'dem': dict(needs=('osm_aoi',), run=stageDEM, 
+                params=('crs', 'in_raster', 'nodata', 'dem_resampling', 'dem_cog', 'dem_compress', 'projClip_raster', 
+                        'xyz_export', 'xyz'),
+                reads=('in_raster',), writes=('projClip_raster', 'xyz')),
+    'footprints': dict(needs=('osm_bld', 'dem', 'topology'), run=stageFootprints, 
+                       params=('crs', 'osm_bldings'), reads=(), writes=('osm_bldings',)),
+    'terrain': dict(needs=('footprints', 'osm_aoi', 'dem'), run=stageTerrain, 
+                    params=('crs', 'nodata', 'terrain_filter', 'terrain_tolerance'), reads=(), writes=()),
+    'cityjson': dict(needs=('terrain', 'footprints', 'osm_aoi'), run=stageCityjson, 
+                     params=('cjsn_*', 'incremental', 'workers'), reads=(), writes=('cjsn_solid',)),
+    }
+
+def fileDigest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for b in iter(lambda: f.read(1 << 20), b''):
+            h.update(b)
+
+    return h.hexdigest()
+
+def stageKey(name, stage, digests, jparams):
+    """
+    content hash of what a stage gets ~ its name, the parameters it reads, the input files
+    and the digests of the stages it needs
+    """
+    params = {k: v for k, v in jparams.items() 
+              if any(k == p or (p.endswith('*') and k.startswith(p[:-1])) for p in stage['params'])}
+    h = hashlib.sha256(json.dumps([name, params, [digests[n] for n in stage['needs']]], 
+                                  sort_keys=True, default=str).encode('utf-8'))
+    for p in stage['reads']:
+        for path in str(jparams.get(p, '')).split():
+            h.update(fileDigest(path).encode('utf-8'))
+
+    return h.hexdigest()
+
+def storeObject(objects, data=None, path=None):
+    """
+    put bytes or a file in the content-addressed store ~ returns its sha256
+    """
+    sha = hashlib.sha256(data).hexdigest() if path is None else fileDigest(path)
+    fname = os.path.join(objects, sha)
+    if not os.path.exists(fname):
+        #-- runs in parallel (batch) may share the checkpoints; each writes to a file of its own
+        tmp = '{}.{}.tmp'.format(fname, os.getpid())
+        if path is None:
+            with open(tmp, 'wb') as f:
+                f.write(data)
+        else:
+            shutil.copyfile(path, tmp)
+        os.replace(tmp, fname)
+
+    return sha
+
+def runStage(name, stage, state, digests, jparams, checkpoints, report):
+    """
+    run one stage or take it from its checkpoint ~ returns (new state, digest of the output, from checkpoint)
+    - checkpoints: <dir>/<stage key>.json lists the objects (by sha256) of the state and the files of a stage;
+      the objects themselves are in <dir>/objects
+    """
+    if checkpoints is None:
+        return stage['run'](state, jparams, report) or {}, None, False
+    if stage['params'] is None:
+        #-- not kept; the digest of what it returns still tells the stages after it whether anything changed
+        new = stage['run'](state, jparams, report) or {}
+        h = hashlib.sha256(pickle.dumps(new))
+        for p in stage['writes']:
+            if os.path.exists(str(jparams.get(p))):
+                h.update(fileDigest(jparams[p]).encode('utf-8'))
+        return new, h.hexdigest(), False
+
+    objects = os.path.join(checkpoints, 'objects')
+    os.makedirs(objects, exist_ok=True)
+    key = stageKey(name, stage, digests, jparams)
+    fname = os.path.join(checkpoints, key + '.json')
+
+    if os.path.exists(fname):
+        with open(fname) as f:
+            point = json.load(f)
+        shas = [point['state']] + [sha for path, sha in point['files'].values()]
+        if all(os.path.exists(os.path.join(objects, sha)) for sha in shas):
+            #-- bring the files back where they are missing or different
+            for path, sha in point['files'].values():
+                if not os.path.exists(path) or fileDigest(path) != sha:
+                    tmp = '{}.{}.tmp'.format(path, os.getpid())
+                    shutil.copyfile(os.path.join(objects, sha), tmp)
+                    os.replace(tmp, path)
+            with open(os.path.join(objects, point['state']), 'rb') as f:
+                new = pickle.load(f)
+            return new, point['digest'], True
+
+    new = stage['run'](state, jparams, report) or {}
+    point = {'state': storeObject(objects, data=pickle.dumps(new)), 'files': {}}
+    for p in stage['writes']:
+        if os.path.exists(str(jparams.get(p))):
+            point['files'][p] = [jparams[p], storeObject(objects, path=jparams[p])]
+    point['digest'] = hashlib.sha256(json.dumps(point, sort_keys=True).encode('utf-8')).hexdigest()
+    tmp = '{}.{}.tmp'.format(fname, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(point, f)
+    os.replace(tmp, fname)
+
+    return new, point['digest'], False
+
+def runStages(stages, jparams, report):
+    """
+    run the stages in dependency order; a stage gets the state of the stages before it
+    - "checkpoint": "True" takes a stage whose inputs did not change from "checkpoint_dir" (default ./data/checkpoints);
+      "incremental": "True" does as well ~ only the stages after a change run again
+    - the pipeline functions of every stage are measured in report (RunReport)
+    - returns the time (seconds) of each stage and the stages taken from a checkpoint
+    """
+    checkpoints = None
+    if jparams.get('checkpoint') == 'True' or jparams.get('incremental') == 'True':
+        checkpoints = jparams.get('checkpoint_dir', './data/checkpoints')
+    state = {}
+    digests = {}
+    timings = {}
+    restored = set()
+    while len(timings) < len(stages):
+        ready = [name for name, stage in stages.items()
+                 if name not in timings and all(n in timings for n in stage['needs'])]
+        if len(ready) == 0:
+            raise ValueError('stages: a cycle in {}'.format([n for n in stages if n not in timings]))
+        for name in ready:
+            start = time.time()
+            report.stage = name
+            new, digests[name], hit = runStage(name, stages[name], state, digests, jparams, checkpoints, report)
+            state.update(new)
+            timings[name] = time.time() - start
+            if hit:
+                restored.add(name)
+
+    return timings, restored
+
+def runParams(fname):
+    """
+    the whole pipeline for one param.json ~ (param.json, stage timings, stages from a checkpoint, error)
+    """
+    timings, restored = {}, set()
+    report = None
+    try:
+        with open(fname) as f:
+            jparams = json.load(f)
+        #-- <cjsn_solid>_report.json / .csv unless "report" says where
+        report = RunReport(jparams.get('report', os.path.splitext(jparams['cjsn_solid'])[0] + '_report'), 
+                           jparams.get('profile'))
+        timings, restored = runStages(STAGES, jparams, report)
+    except Exception as e:
+        return fname, timings, restored, '{}: {}'.format(type(e).__name__, e)
+    finally:
+        if report is not None:
+            report.write(fname, timings, restored)
+
+    return fname, timings, restored, None
+
+def main():
+    start = time.time()
+
+    parser = argparse.ArgumentParser(description='LoD1 3D City Model from osm and a raster DEM')
+    parser.add_argument('params', nargs='*', default=['osm3Dmamre_param.json'],
+                        help='one or more param.json (default: osm3Dmamre_param.json)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='param.json run at once (processes)')
+    args = parser.parse_args()
+
+    for d_name in ('data', 'result'):
+        os.makedirs(os.path.join(os.getcwd(), d_name), exist_ok=True)
+
+    if args.jobs <= 1:
+        runs = map(runParams, args.params)
+    else:
+        executor = ProcessPoolExecutor(max_workers=args.jobs)
+        runs = executor.map(runParams, args.params)
+
+    failed = 0
+    for fname, timings, restored, error in runs:
+        print('')
+        print(fname)
+        for name, seconds in timings.items():
+            print('  {:<12}{}{}'.format(name, timedelta(seconds=seconds), ' (checkpoint)' if name in restored else ''))
+        if error is not None:
+            print('  ERROR: {}'.format(error))
+            failed = failed + 1
+    if args.jobs > 1:
+        executor.shutdown()
+
     end = time.time()
-    print('runtime:', str(timedelta(seconds=(end - start))))  
-   
+    print('runtime:', str(timedelta(seconds=(end - start))))
+    if failed > 0:
+        sys.exit(1)
+
    #--25-meter DEM
    #-- cput runtime: 0:00:08.472202 ~ university campus: 50 buildings
    #-- rural runtime: 0:03:46.493492 ~ rural village: population 9 000, 2159 buildings
-   #-- neighbourhood runtime: 0:00:13.330248 ~ urban neighbourhood: population ~ 1 000, 305 buildings 
+   #-- neighbourhood runtime: 0:00:13.330248 ~ urban neighbourhood: population ~ 1 000, 305 buildings
 
    #--10-metre DEM
-   #-- cput runtime: 0:00:15.770822 ~ university campus: 50 buildings / 
+   #-- cput runtime: 0:00:15.770822 ~ university campus: 50 buildings /
    #-- rural runtime: 0:14:55.993314 ~ rural village: population 9 000, 2159 buildings /
    #-- neighbourhood runtime: 00:00:26.079256 ~ urban neighbourhood: population ~ 1 000, 305 buildings /
-   
+
    #--5-metre DEM -- need to redo these
-   #-- cput runtime: 0:05:12.451642 ~ university campus: 50 buildings / 
+   #-- cput runtime: 0:05:12.451642 ~ university campus: 50 buildings /
    #-- rural runtime:               ~ rural village: population 9 000 /
    #-- neighbourhood runtime: 0:07:29.521754 ~ urban neighbourhood: population ~ 1 000, 305 buildings /
-   
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
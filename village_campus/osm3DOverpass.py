@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+# env/osm3D_vc-env
+######################
+# a local stand-in for the Overpass API ~ for the tests and air-gapped build nodes
+# github: https://github.com/AdrianKriger/osm_LoD1_3DCityModel
+#
+# python osm3DOverpass.py --responses ./data/overpass --port 8080
+#   - answers <url>/api/interpreter?data=<query> (GET or POST) with <responses>/<sha256 of the query>.json
+#   - point "overpass_url" at http://127.0.0.1:8080/api/interpreter
+#####################
+
+import os
+import json
+import hashlib
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+def queryName(query):
+    return hashlib.sha256(query.encode('utf-8')).hexdigest() + '.json'
+
+class OverpassStandIn(ThreadingHTTPServer):
+    """
+    the stand-in server ~ started in a thread of its own with start() or as a context manager
+    - responses: {query: response (dict)}; a query not in it is looked up in directory (<sha256 of the query>.json)
+    - status: http status codes to answer first, one per request (429, 504, ...) ~ to try the backoff
+    - queries: every query it got, in order
+    """
+    def __init__(self, responses=None, directory=None, status=(), port=0):
+        super().__init__(('127.0.0.1', port), OverpassHandler)
+        self.responses = dict(responses or {})
+        self.directory = directory
+        self.status = list(status)
+        self.queries = []
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/api/interpreter'.format(self.server_address[1])
+
+    def answer(self, query):
+        #-- (status, body)
+        with self.lock:
+            self.queries.append(query)
+            if self.status:
+                return self.status.pop(0), b'{}'
+        if query in self.responses:
+            return 200, json.dumps(self.responses[query]).encode('utf-8')
+        if self.directory:
+            fname = os.path.join(self.directory, queryName(query))
+            if os.path.exists(fname):
+                with open(fname, 'rb') as f:
+                    return 200, f.read()
+        return 400, b'{"remark": "runtime error: no response for this query"}'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+class OverpassHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.reply(parse_qs(urlparse(self.path).query).get('data', [''])[0])
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+        self.reply(parse_qs(body).get('data', [''])[0])
+
+    def reply(self, query):
+        status, body = self.server.answer(query)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description='a local stand-in for the Overpass API')
+    parser.add_argument('--responses', required=True, help='directory of <sha256 of the query>.json responses')
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+
+    server = OverpassStandIn(directory=args.responses, port=args.port)
+    print('overpass stand-in:', server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
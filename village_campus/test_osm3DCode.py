@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+# env/osm3D_vc-env
+######################
+# tests for osm3DCode ~ small synthetic inputs, no network and no files from osm
+#
+# python -m pytest test_osm3DCode.py
+#####################
+
+import json
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pytest
+from shapely.geometry import box, Polygon
+
+from osm3DCode import (TerrainMesh, VertexIndex, executeDelaunay, addCrossings, add_terrain_v,
+                       doVcBndGeomB, doBldGeomB, writeCityjson, SolidStore, writegjson, sgmtIndex,
+                       extrudeBld, heightStacks)
+
+#-- a 10 x 10 dem of 1 m cells, rising 0.5 m a column
+GT = (0.0, 1.0, 0.0, 10.0, 0.0, -1.0)
+DEM = np.tile(np.arange(10, dtype='float64') * 0.5, (10, 1))
+
+def square(x0, y0, x1, y1, z):
+    return [(x0, y0, z), (x1, y0, z), (x1, y1, z), (x0, y1, z)]
+
+def test_crossing_footprints():
+    #-- two footprints that overlap: their walls cross at (4, 5) and (5, 4) without a vertex there
+    mesh = TerrainMesh()
+    mesh.addVertices([(0.5, 0.5, 0.25), (9.5, 0.5, 4.75), (9.5, 9.5, 4.75), (0.5, 9.5, 0.25)])
+    for ring in (square(2, 2, 5, 5, 1.0), square(4, 4, 7, 7, 2.0)):
+        start = mesh.addVertices(ring)
+        mesh.addSegments([(i, (i + 1) % 4) for i in range(4)], offset=start)
+    mesh.addSegments([(i, (i + 1) % 4) for i in range(4)])
+    
+    t, V = executeDelaunay(mesh)
+    n = mesh.nv
+    assert len(V) == n + 2
+    assert addCrossings(mesh, V, GT, DEM) == 2
+    
+    pts = mesh.vertices
+    assert len(pts) == len(V) and t.max() < len(pts)
+    np.testing.assert_allclose(pts[n:, :2], [(4, 5), (5, 4)] if pts[n, 0] < pts[n + 1, 0] else [(5, 4), (4, 5)])
+    #-- the dem under them (bilinear between cell centres)
+    np.testing.assert_allclose(pts[n:, 2], (pts[n:, 0] - 0.5) * 0.5)
+    
+    cm = {'vertices': VertexIndex([0.0, 0.0, 0.0])}
+    T = add_terrain_v(pts, t, cm)
+    assert T.min() >= 0 and T.max() < len(cm['vertices'])
+    cm['vertices'].close()
+
+def cityModel(fname, heights, store=None, **kw):
+    """
+    terrain and a row of houses through doBldGeomB and writeCityjson ~ as outputCityjsonB, without fiona
+    """
+    jparams = {k: 'test' for k in ['cjsn_title', 'cjsn_referenceDate', 'cjsn_referenceSystem', 'cjsn_contactName', 
+                                   'cjsn_emailAddress', 'cjsn_contactType', 'cjsn_website', 'cjsn_+meta-description', 
+                                   'cjsn_+meta-sourceSpatialResolution', 'cjsn_+meta-sourceReferenceSystem', 
+                                   'cjsn_+meta-sourceCitation']}
+    geoms = [box(i * 20, 0, i * 20 + 10, 10) for i in range(len(heights))]
+    attributes = [{'osm_id': i + 1, 'osm_building': 'house', 'roof_height': h} for i, h in enumerate(heights)]
+    #-- the height stack at every vertex
+    result = {a['osm_id']: {v: [a['roof_height']] for v in g.exterior.coords[:-1]} for g, a in zip(geoms, attributes)}
+    pts = np.array([(-5, -5, 100.0), (200, -5, 101.0), (200, 20, 102.0), (-5, 20, 101.5)])
+    
+    cm = doVcBndGeomB([-5, -5, 200, 20], 100.0, 120.0, jparams)
+    T = add_terrain_v(pts, [(0, 1, 2), (0, 2, 3)], cm)
+    writeCityjson(fname, cm, T, doBldGeomB(zip(geoms, attributes), cm, [100.0] * len(geoms), result, store=store, **kw))
+    if store is not None:
+        store.close()
+
+def test_incremental(tmp_path):
+    heights = [103.0 + i % 4 for i in range(12)]
+    inc, full = str(tmp_path / 'inc.city.json'), str(tmp_path / 'full.city.json')
+    cityModel(inc, heights, SolidStore(inc))
+    
+    #-- one house higher
+    heights[5] = heights[5] + 3
+    store = SolidStore(inc)
+    cityModel(inc, heights, store)
+    cityModel(full, heights)
+    
+    assert store.kept == len(heights) - 1
+    with open(inc, 'rb') as a, open(full, 'rb') as b:
+        assert a.read() == b.read()
+    
+    #-- nothing changed: every house from the store
+    store = SolidStore(inc)
+    cityModel(inc, heights, store)
+    assert store.kept == len(heights)
+    with open(inc, 'rb') as a, open(full, 'rb') as b:
+        assert a.read() == b.read()
+
+def test_workers(tmp_path):
+    #-- small chunks over two processes: the same file as one chunk in this one
+    heights = [103.0 + i % 4 for i in range(12)]
+    one, two = str(tmp_path / 'one.city.json'), str(tmp_path / 'two.city.json')
+    cityModel(one, heights)
+    cityModel(two, heights, batch=5, workers=2)
+    
+    with open(one, 'rb') as a, open(two, 'rb') as b:
+        assert a.read() == b.read()
+
+def test_writegjson(tmp_path):
+    #-- the attributes of the baseline iterrows() loop; a roof no longer gets the address of the row before it
+    x0, y0 = 260000.0, 6240000.0
+    rows = [(11, 'house', {'building': 'house', 'building:levels': '2', 'addr:housenumber': '12', 
+                           'addr:street': 'Main Road', 'addr:city': 'Mamre', 'name': 'Kerk'}, 101.234),
+            (12, 'yes', {'building': 'yes', 'building:levels': '1'}, 102.5),
+            (13, 'bridge', {'building': 'bridge', 'building:levels': '1', 'min_height': '4', 'building:min_level': '1'}, 100.0),
+            #-- 1 * 2.8 + 99.875 is 102.675 ~ round() takes it down, numpy up
+            (14, 'roof', {'building': 'roof', 'building:levels': '1'}, 99.875),
+            #-- no building:levels
+            (15, 'house', {'building': 'house'}, 100.0)]
+    ts = gpd.GeoDataFrame({'type': 'way', 'id': [r[0] for r in rows], 'bld': [r[1] for r in rows], 
+                           'tags': [r[2] for r in rows], 'mean': [r[3] for r in rows]}, 
+                          geometry=[box(x0 + k * 20, y0, x0 + k * 20 + 10, y0 + 8) for k in range(len(rows))], 
+                          crs='EPSG:32734')
+    fname = str(tmp_path / 'footprints.geojson')
+    writegjson(ts, {'crs': 'EPSG:32734', 'osm_bldings': fname})
+    
+    with open(fname) as f:
+        features = json.load(f)['features']
+    for f in features:
+        assert f['properties'].pop('footprint') == f['geometry']
+    assert [f['properties'] for f in features] == [
+        {'osm_id': 11, 'osm_building': 'house', 'osm_building:levels': '2', 'osm_name': 'Kerk', 
+         'osm_address': '12 Main Road Mamre', 'plus_code': '4FRW2CW3+Q54', 
+         'ground_height': 101.23, 'building_height': 6.9, 'roof_height': 108.13},
+        {'osm_id': 12, 'osm_building': 'yes', 'osm_building:levels': '1', 'osm_address': '', 
+         'plus_code': '4FRW2CW3+Q73', 'ground_height': 102.5, 'building_height': 4.1, 'roof_height': 106.6},
+        {'osm_id': 13, 'osm_building': 'bridge', 'osm_building:levels': '1', 'osm_min_height': '4', 
+         'osm_building:min_level': '1', 'plus_code': '4FRW2CW3+Q92', 'ground_height': 100.0, 
+         'bottom_bridge_height': 104.0, 'building_height': 2.8, 'roof_height': 102.8},
+        {'osm_id': 14, 'osm_building': 'roof', 'osm_building:levels': '1', 'plus_code': '4FRW2CW3+QC5', 
+         'ground_height': 99.88, 'bottom_roof_height': 102.67, 'roof_height': 104.17}]
+
+def test_sgmtIndex():
+    #-- vertices with an index of their own (as getBldVertices / getAOIVertices make them)
+    rng = np.random.default_rng(2)
+    xy = np.round(rng.random((40, 2)) * 100, 3)
+    ac = pd.DataFrame({'x': xy[:, 0], 'y': xy[:, 1]}, index=np.arange(40) + 7)
+    pairs = rng.integers(0, 40, (60, 2))
+    c = pd.DataFrame({'coords': [(xy[a, 0], xy[a, 1], xy[b, 0], xy[b, 1]) for a, b in pairs]})
+    
+    #-- the baseline: scan the vertices for both ends of every segment
+    idx01 = []
+    for i, row in c.iterrows():
+        frx, fry, tox, toy = row.coords
+        [index_f] = ac[(ac['x'] == frx) & (ac['y'] == fry)].index.values
+        [index_t] = ac[(ac['x'] == tox) & (ac['y'] == toy)].index.values
+        idx01.append([index_f, index_t])
+    
+    np.testing.assert_array_equal(sgmtIndex(ac, c), idx01)
+    
+    c.loc[3, 'coords'] = (-1.0, -1.0, xy[0, 0], xy[0, 1])
+    with pytest.raises(ValueError):
+        sgmtIndex(ac, c)
+
+def test_heightStacks():
+    #-- a row of houses sharing walls (one drawn clockwise), a bridge over them and a roof on its own
+    dis = gpd.GeoDataFrame({'osm_id': [1, 2, 3, 4, 5], 
+                            'roof_height': [9.0, 12.0, 9.0, 15.5, 4.0],
+                            'bottom_bridge_height': [np.nan, np.nan, np.nan, 7.0, np.nan],
+                            'bottom_roof_height': [np.nan, np.nan, np.nan, np.nan, 3.0]},
+                           geometry=[box(0, 0, 4, 4), Polygon([(4, 0), (4, 4), (8, 4), (8, 0)]), box(8, 0, 12, 4), 
+                                     Polygon([(8, 4), (4, 4), (4, 9), (8, 9)]), box(20, 20, 22, 23)])
+    
+    #-- the baseline: a dict of every vertex of every ring
+    dict_vertices = {}
+    cols = ['bottom_bridge_height', 'bottom_roof_height', 'roof_height']
+    for i, row in dis.iterrows():
+        oring = list(row.geometry.exterior.coords)
+        if row.geometry.exterior.is_ccw == False:
+            oring.reverse()
+        for (j, v) in enumerate(oring[:-1]):
+            vertex = (oring[j][0], oring[j][1])
+            attr = [x for x in [row[c] for c in cols] if not np.isnan(x)]
+            if vertex in dict_vertices.keys():
+                dict_vertices[vertex][row['osm_id']] = attr
+            else:
+                dict_vertices[vertex] = {row['osm_id']: attr}
+    baseline = {}
+    for k1, d in dict_vertices.items():
+        for k2 in d:
+            baseline.setdefault(k2, {})[k1] = sorted(list(set([j for i in d.values() for j in i])))
+    
+    result = heightStacks(dis)
+    assert result == baseline
+    assert result[2][(4.0, 4.0)] == [7.0, 9.0, 12.0, 15.5]
+    
+    #-- the baseline keys came in the order the vertices were first met; these follow each ring
+    for geom, oid in zip(dis.geometry, dis['osm_id']):
+        oring = list(geom.exterior.coords)[:-1]
+        if not geom.exterior.is_ccw:
+            oring.reverse()
+        assert list(result[oid]) == [(x, y) for x, y in oring]
+
+def baselineSolid(oring, irings, edges, height, bottom, ground):
+    #-- the baseline extrude_walls, extrude_int_walls and extrude_roof_ground ~ a surface as a list of rounded (x, y, z)
+    def pt(p, z):
+        return (round(p[0], 3), round(p[1], 3), round(z, 3))
+    def wall(a, b, ea, eb):
+        if len(ea) > 2 or len(eb) > 2:
+            return [[pt(a, ea[0]), pt(b, eb[0])] + [pt(b, o) for o in eb[1:]] + [pt(a, o) for o in ea[::-1][:-1]]]
+        return [[pt(a, ea[0]), pt(b, eb[0]), pt(b, eb[1]), pt(a, ea[1])]]
+    def cap(z, reverse):
+        rings = [list(r) for r in [oring] + irings]
+        if reverse:
+            for r in rings:
+                r.reverse()
+        return [[pt(p, z) for p in r] for r in rings]
+    
+    n = len(oring)
+    surfaces = [wall(oring[j], oring[(j + 1) % n], edges[j], edges[(j + 1) % n]) for j in range(n)]
+    for iring in irings:
+        m = len(iring)
+        surfaces.extend([[pt(iring[j], ground), pt(iring[(j + 1) % m], ground), 
+                          pt(iring[(j + 1) % m], height), pt(iring[j], height)]] for j in range(m))
+    return surfaces + [cap(height, False), cap(bottom, True)]
+
+@pytest.mark.parametrize('oring, irings, edges, height, bottom, ground', [
+    #-- a house on its own: ground and roof at every vertex
+    ([(0, 0), (4, 0), (4, 3), (0, 3)], [], [[1.5, 9.0]] * 4, 9.0, 1.5, None),
+    #-- against taller and lower neighbours: the stacks carry their heights
+    ([(0, 0), (4.1234, 0), (4.1234, 3), (0, 3)], [], [[1.5, 4.0, 9.0], [1.5, 9.0], [1.5, 6.0, 7.25, 9.0], [1.5, 9.0]],
+     9.0, 1.5, None),
+    #-- a courtyard
+    ([(0, 0), (10, 0), (10, 10), (0, 10)], [[(3, 3), (3, 7), (7, 7), (7, 3)]], [[2.0, 12.0]] * 4, 12.0, 2.0, 2.0),
+    #-- a bridge: the floor is the bottom of the deck
+    ([(0, 0), (8, 0), (8, 2), (0, 2)], [], [[5.0, 6.0]] * 2 + [[5.0, 5.5, 6.0]] * 2, 6.0, 5.0, None),
+])
+def test_extrudeBld(oring, irings, edges, height, bottom, ground):
+    V, surfaces = extrudeBld(oring, irings, edges, height, bottom, ground)
+    V = [tuple(v) for v in np.round(V, 3).tolist()]
+    
+    assert [[[V[j] for j in r] for r in s] for s in surfaces] == baselineSolid(oring, irings, edges, height, bottom, ground)
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# env/osm3D_vc-env
+######################
+# tests for osm3DMain ~ the run report
+#
+# python -m pytest test_osm3DMain.py
+#####################
+
+import numpy as np
+
+from osm3DMain import RunReport, resetPeakRSS
+
+def big(n):
+    a = np.ones(n)
+    return float(a.sum())
+
+def small():
+    return 1
+
+def test_peak_per_call(tmp_path):
+    report = RunReport(str(tmp_path / 'report'))
+    report.stage = 'test'
+    report.call(big, 50000000)
+    report.call(small)
+    first, second = [row['peak_rss_mb'] for row in report.rows]
+    
+    #-- 400 MB for big; small does not get it too
+    assert first > 300
+    if resetPeakRSS():
+        assert second < first - 300
+    else:
+        assert second is None
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# env/osm3D_vc-env
+######################
+# tests for the overpass response cache ~ against the local stand-in (osm3DOverpass.py), no network
+#
+# python -m pytest test_osm3DOverpass.py
+#####################
+
+import os
+import time
+
+import pytest
+
+from osm3DCode import overpassQuery
+from osm3DOverpass import OverpassStandIn
+
+A = '[out:json];way["building"](1,1,2,2);out geom;'
+B = '[out:json];way["building"](2,2,3,3);out geom;'
+C = '[out:json];way["building"](3,3,4,4);out geom;'
+
+def response(name, pad=0):
+    return {'version': 0.6, 'elements': [{'type': 'way', 'id': 1, 'tags': {'name': name}}], 'pad': 'x' * pad}
+
+@pytest.fixture
+def server():
+    with OverpassStandIn(responses={A: response('a'), B: response('b'), C: response('c')}) as s:
+        yield s
+
+@pytest.fixture
+def jparams(server, tmp_path):
+    return {'overpass_url': server.url, 'osm_cache': str(tmp_path / 'cache'),
+            'osm_retries': 1, 'osm_backoff': 0, 'osm_timeout': 5}
+
+def cached(jparams):
+    return sorted(os.listdir(jparams['osm_cache']))
+
+def test_hit(server, jparams):
+    first = overpassQuery(A, jparams)
+    second = overpassQuery(A, jparams)
+
+    assert first == second == response('a')
+    assert server.queries == [A]
+    assert len(cached(jparams)) == 1
+
+def test_url_in_key(server, jparams):
+    #-- the same query against another instance is another response
+    overpassQuery(A, jparams)
+    with OverpassStandIn(responses={A: response('other')}) as other:
+        assert overpassQuery(A, dict(jparams, overpass_url=other.url)) == response('other')
+    assert len(cached(jparams)) == 2
+
+def test_expiry(server, jparams):
+    jparams['osm_cache_ttl'] = 1
+    overpassQuery(A, jparams)
+    overpassQuery(A, jparams)
+    assert server.queries == [A]
+
+    #-- requested two hours ago
+    fname = os.path.join(jparams['osm_cache'], cached(jparams)[0])
+    then = time.time() - 2 * 3600
+    os.utime(fname, (then, then))
+    overpassQuery(A, jparams)
+
+    assert server.queries == [A, A]
+    assert os.path.getmtime(fname) > then
+
+def test_trim(server, jparams):
+    #-- ~40 kB a response; room for two
+    for q, name in ((A, 'a'), (B, 'b'), (C, 'c')):
+        server.responses[q] = response(name, pad=40000)
+    jparams['osm_cache_size'] = 0.1
+
+    overpassQuery(A, jparams)
+    overpassQuery(B, jparams)
+    overpassQuery(A, jparams)
+    overpassQuery(C, jparams)
+    assert len(cached(jparams)) == 2
+
+    #-- b was the least recently used
+    overpassQuery(A, jparams)
+    overpassQuery(C, jparams)
+    assert server.queries == [A, B, C]
+    overpassQuery(B, jparams)
+    assert server.queries == [A, B, C, B]
+
+def test_offline(server, jparams):
+    jparams['osm_cache_ttl'] = 1
+    overpassQuery(A, jparams)
+    fname = os.path.join(jparams['osm_cache'], cached(jparams)[0])
+    then = time.time() - 2 * 3600
+    os.utime(fname, (then, then))
+    server.stop()
+
+    #-- expired, and the server is gone; offline answers from the cache anyway
+    offline = dict(jparams, osm_offline='True')
+    assert overpassQuery(A, offline) == response('a')
+    with pytest.raises(RuntimeError):
+        overpassQuery(B, offline)
+    with pytest.raises(RuntimeError):
+        overpassQuery(A, dict(offline, osm_cache='False'))
+
+def test_error_remark(server, jparams):
+    #-- overpass answers a timeout with a 200 and a remark; tried again, never cached
+    server.responses[A] = dict(response('a'), remark='runtime error: Query timed out in "query" at line 1')
+    with pytest.raises(RuntimeError):
+        overpassQuery(A, jparams)
+
+    assert server.queries == [A, A]
+    assert cached(jparams) == []
+
+def test_backoff(server, jparams):
+    server.status = [429, 504]
+    jparams['osm_retries'] = 2
+
+    assert overpassQuery(A, jparams) == response('a')
+    assert server.queries == [A, A, A]